@@ -2,21 +2,112 @@ import os
 import json
 import time
 import secrets
-from flask import Flask, render_template, redirect, url_for, session, request, jsonify
-from flask_session import Session
-import requests
+from flask import Flask, current_app, render_template, redirect, url_for, session, request, jsonify
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
 from datetime import datetime
-from database import init_database, create_or_update_user, get_user, get_all_users, create_custom_rpc, get_user_rpcs, delete_custom_rpc, generate_api_key, verify_api_key
-from rpc_persistent import activate_user_rpc, deactivate_user_rpc, start_background_tasks, rpc_manager
+from database import init_database, get_user, get_all_users, create_custom_rpc, get_user_rpcs, delete_custom_rpc, login_user, verify_api_key, get_pool_stats, get_write_queue_stats, get_api_key_cache_stats, add_rpcs_changed_listener, get_rpcs_version, get_rpc_changes, get_rpc_feed_cursor, start_change_feed_compactor, get_rpc_job
+from cache import ResponseCache, SharedResponseStore
+from presence_payload import compile_presence, PresenceConfigError
+from rpc_persistent import queue_user_rpc_activation, queue_user_rpc_deactivation, start_background_tasks, rpc_manager, service_stats, SERVICE_STATS
+from rpc_jobs import serialize_rpc_job
+from discord_api import DISCORD_API_BASE, DISCORD_TOKEN_URL, discord_http, join_guild_later
+from token_refresh import start_token_refresher
+from session_store import SessionStore, start_session_purger, SESSION_ANONYMOUS_LIFETIME
+from config import flask_config
+from rpc_control import PROCESS_ROLE
+from rpc_workers import RPCWorkerError
 
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_PERMANENT'] = True
-app.config['PERMANENT_SESSION_LIFETIME'] = 31536000  # 1 year
-Session(app)
+class DatabaseSession(CallbackDict, SessionMixin):
+    """Session dict that knows its ID, its stored expiry and whether the request changed it"""
+
+    def __init__(self, initial=None, sid=None, stored_expires_at=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.stored_expires_at = stored_expires_at
+        self.new = stored_expires_at is None
+        self.modified = False
+
+class DatabaseSessionInterface(SessionInterface):
+    """Keeps sessions in session_store instead of files; the cookie holds only the session ID"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        loaded = self.store.load(sid)
+        if loaded is None:
+            # Not stored until something is put in it
+            return DatabaseSession(sid=self.store.new_id())
+        data, expires_at = loaded
+        return DatabaseSession(data, sid, expires_at)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if 'user_id' in session:
+            lifetime = app.permanent_session_lifetime.total_seconds()
+        else:
+            lifetime = SESSION_ANONYMOUS_LIFETIME
+        expires_at = time.time() + lifetime
+        if self.store.save(session.sid, dict(session), expires_at, session.modified, session.stored_expires_at) == 'skipped':
+            return
+        permanent = session.permanent or app.config['SESSION_PERMANENT']
+        response.set_cookie(
+            name, session.sid,
+            expires=expires_at if permanent else None,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+session_store = SessionStore(serializer=session_json_serializer)
+
+# Views and error handlers every app built by create_app() gets
+_views = []
+_error_handlers = []
+
+def route(rule, **options):
+    """Like app.route, for the apps create_app() builds"""
+    def decorator(view):
+        _views.append((rule, view, options))
+        return view
+    return decorator
+
+def errorhandler(code):
+    """Like app.errorhandler, for the apps create_app() builds"""
+    def decorator(handler):
+        _error_handlers.append((code, handler))
+        return handler
+    return decorator
+
+def create_app(config=None):
+    """Build the web app from the environment's settings (see config.py), updated with config"""
+    app = Flask(__name__)
+    app.config.from_mapping(flask_config())
+    app.config.from_prefixed_env()
+    if config:
+        app.config.update(config)
+    app.session_interface = DatabaseSessionInterface(session_store)
+    app.add_template_filter(fromjson_filter, 'fromjson')
+    for rule, view, options in _views:
+        app.add_url_rule(rule, view_func=view, **options)
+    for code, handler in _error_handlers:
+        app.register_error_handler(code, handler)
+    return app
 
-@app.template_filter('fromjson')
 def fromjson_filter(value):
     if value:
         return json.loads(value)
@@ -24,16 +115,12 @@ def fromjson_filter(value):
 
 DISCORD_CLIENT_ID = os.getenv('DISCORD_CLIENT_ID', '1419030874640613446')
 DISCORD_CLIENT_SECRET = os.getenv('DISCORD_CLIENT_SECRET')
-DISCORD_REDIRECT_URI = 'http://localhost:5000/api/auth/callback'
-DISCORD_API_BASE = 'https://discord.com/api/v10'
+DISCORD_REDIRECT_URI = os.getenv('DISCORD_REDIRECT_URI', 'http://localhost:5000/api/auth/callback')
 DISCORD_OAUTH_URL = f'{DISCORD_API_BASE}/oauth2/authorize'
-DISCORD_TOKEN_URL = f'{DISCORD_API_BASE}/oauth2/token'
-GUILD_ID = '1036197746417340496'
 
 # Debug information
 print(f"Discord Client ID: {DISCORD_CLIENT_ID}")
 print(f"Discord Redirect URI: {DISCORD_REDIRECT_URI}")
-print("App running on: http://localhost:5000")
 
 DEFAULT_RPC = {
     'app_id': '1419030874640613446',
@@ -41,7 +128,64 @@ DEFAULT_RPC = {
     'button_url': 'https://discord.gg/9HC8RANtJ9'
 }
 
-@app.route('/')
+DEFAULT_RPC_CONFIG = {
+    'app_id': DEFAULT_RPC['app_id'],
+    'details': 'DrakLeafX Community',
+    'state': 'Join us!',
+    'buttons': json.dumps([{
+        'label': DEFAULT_RPC['button_name'],
+        'url': DEFAULT_RPC['button_url']
+    }])
+}
+DEFAULT_RPC_CONFIG['presence_payload'] = compile_presence(DEFAULT_RPC_CONFIG)
+
+RPC_RESPONSE_FIELDS = (
+    'id', 'app_id', 'rpc_type', 'details', 'state', 'timestamp_type',
+    'custom_timestamp', 'large_image_url', 'large_image_text',
+    'small_image_url', 'small_image_text', 'buttons', 'presence_payload'
+)
+
+# Serialized /api/user/<id>/rpcs bodies keyed by users.rpcs_version, shared
+# with the dashboard. Set RPC_RESPONSE_CACHE_PATH to let worker processes
+# reuse each other's bodies.
+RPC_RESPONSE_CACHE_BYTES = int(os.getenv('RPC_RESPONSE_CACHE_BYTES', str(16 * 1024 * 1024)))
+RPC_RESPONSE_CACHE_PATH = os.getenv('RPC_RESPONSE_CACHE_PATH')
+rpc_response_cache = ResponseCache(
+    max_bytes=RPC_RESPONSE_CACHE_BYTES,
+    store=SharedResponseStore(RPC_RESPONSE_CACHE_PATH) if RPC_RESPONSE_CACHE_PATH else None
+)
+add_rpcs_changed_listener(rpc_response_cache.invalidate)
+
+def build_rpcs_response(user_id):
+    """Serialize a user's RPC configurations for the client API"""
+    # Read the feed position first; replaying changes the snapshot already has is harmless
+    seq = get_rpc_feed_cursor(user_id)
+    user = get_user(user_id)
+    rpcs_list = [{field: rpc[field] for field in RPC_RESPONSE_FIELDS} for rpc in get_user_rpcs(user_id)]
+    return json.dumps({
+        'success': True,
+        'rpcs': rpcs_list,
+        'default_rpc': DEFAULT_RPC_CONFIG,
+        'active_rpc_id': user['active_rpc_id'] if user else None,
+        'seq': seq
+    }, separators=(',', ':')).encode()
+
+def serialize_rpc_change(change):
+    item = {'seq': change['seq'], 'op': change['op'], 'rpc_id': change['rpc_id']}
+    if change['op'] == 'insert' and change['id'] is not None:
+        item['rpc'] = {field: change[field] for field in RPC_RESPONSE_FIELDS}
+    return item
+
+def get_rpcs_response(user_id, version=None):
+    """Get the serialized RPC configurations for a user, building them on a cache miss"""
+    if version is None:
+        version = get_rpcs_version(user_id)
+    return rpc_response_cache.get_or_build(user_id, version, lambda: build_rpcs_response(user_id))
+
+def rpcs_etag(user_id, version):
+    return f'{user_id}-{version}'
+
+@route('/')
 def index():
     if 'user_id' in session:
         user = get_user(session['user_id'])
@@ -49,7 +193,7 @@ def index():
             return redirect(url_for('dashboard'))
     return render_template('index.html')
 
-@app.route('/login')
+@route('/login')
 def login():
     state = secrets.token_urlsafe(32)
     session['oauth_state'] = state
@@ -69,7 +213,7 @@ def login():
     print(f"Discord OAuth URL: {auth_url}")
     return redirect(auth_url)
 
-@app.route('/api/auth/callback')
+@route('/api/auth/callback')
 def callback():
     try:
         print(f"Callback received with args: {dict(request.args)}")
@@ -109,7 +253,7 @@ def callback():
         
         print(f"Exchanging code for token with Discord...")
         headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        response = requests.post(DISCORD_TOKEN_URL, data=data, headers=headers)
+        response = discord_http.post(DISCORD_TOKEN_URL, data=data, headers=headers)
         
         print(f"Discord token response: {response.status_code}")
         if response.status_code != 200:
@@ -121,7 +265,7 @@ def callback():
         
         # Get user info
         headers = {'Authorization': f'Bearer {access_token}'}
-        user_response = requests.get(f'{DISCORD_API_BASE}/users/@me', headers=headers)
+        user_response = discord_http.get(f'{DISCORD_API_BASE}/users/@me', headers=headers)
         
         if user_response.status_code != 200:
             print(f"Failed to get user info: {user_response.status_code} - {user_response.text}")
@@ -129,23 +273,11 @@ def callback():
         
         user_data = user_response.json()
         
-        # Add user to guild
-        try:
-            guild_url = f'{DISCORD_API_BASE}/guilds/{GUILD_ID}/members/{user_data["id"]}'
-            guild_data = {'access_token': access_token}
-            bot_headers = {
-                'Authorization': f'Bot {os.getenv("DISCORD_BOT_TOKEN")}',
-                'Content-Type': 'application/json'
-            }
-            requests.put(guild_url, json=guild_data, headers=bot_headers)
-        except Exception as e:
-            print(f"Failed to add user to guild: {e}")
+        # Add user to guild without holding up the login
+        join_guild_later(user_data['id'], access_token)
         
-        # Save to database
-        create_or_update_user(user_data, tokens)
-        
-        # Generate API key for RPC client
-        api_key = generate_api_key(int(user_data['id']))
+        # Save to database and generate API key for RPC client
+        api_key = login_user(user_data, tokens)
         
         # Set session
         session['user_id'] = int(user_data['id'])
@@ -160,7 +292,7 @@ def callback():
         print(f"Callback error: {str(e)}")
         return redirect(url_for('index'))
 
-@app.route('/dashboard')
+@route('/dashboard')
 def dashboard():
     if 'user_id' not in session:
         return redirect(url_for('index'))
@@ -170,20 +302,26 @@ def dashboard():
         session.clear()
         return redirect(url_for('index'))
     
-    custom_rpcs = get_user_rpcs(session['user_id'])
+    rpc_manager.touch(session['user_id'])
+    custom_rpcs = json.loads(get_rpcs_response(session['user_id']))['rpcs']
     
-    return render_template('dashboard.html', user=user, custom_rpcs=custom_rpcs, default_rpc=DEFAULT_RPC)
+    # Only the key's hash is stored, so the plaintext key comes from the login session
+    return render_template('dashboard.html', user=user, custom_rpcs=custom_rpcs, default_rpc=DEFAULT_RPC, api_key=session.get('api_key'))
 
-@app.route('/create_rpc', methods=['POST'])
+@route('/create_rpc', methods=['POST'])
 def create_rpc():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
     data = request.json or {}
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Expected a JSON object'}), 400
     buttons = []
     
     # Parse buttons
     if data.get('buttons'):
+        if not isinstance(data['buttons'], list) or not all(isinstance(btn, dict) for btn in data['buttons']):
+            return jsonify({'success': False, 'error': 'buttons must be a list of objects'}), 400
         for btn in data['buttons']:
             if btn.get('name') and btn.get('url'):
                 buttons.append({'label': btn['name'], 'url': btn['url']})
@@ -202,18 +340,18 @@ def create_rpc():
         'buttons': json.dumps(buttons) if buttons else None
     }
     
+    try:
+        rpc_data['presence_payload'] = compile_presence(rpc_data)
+    except PresenceConfigError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
     rpc_id = create_custom_rpc(session['user_id'], rpc_data)
     
-    # Try to activate RPC directly from server
-    try:
-        from rpc_manager import activate_user_rpc
-        activate_user_rpc(session['user_id'], rpc_data)
-        return jsonify({'success': True, 'rpc_id': rpc_id, 'activated': True})
-    except Exception as e:
-        print(f"Failed to activate RPC directly: {e}")
-        return jsonify({'success': True, 'rpc_id': rpc_id, 'activated': False, 'message': 'RPC saved but requires client activation'})
+    # Activate it on the server in the background; /rpc_jobs/<job_id> reports the result
+    job_id = queue_user_rpc_activation(session['user_id'], rpc_id)
+    return jsonify({'success': True, 'rpc_id': rpc_id, 'job_id': job_id}), 202
 
-@app.route('/delete_rpc/<int:rpc_id>', methods=['POST'])
+@route('/delete_rpc/<int:rpc_id>', methods=['POST'])
 def delete_rpc(rpc_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -221,43 +359,52 @@ def delete_rpc(rpc_id):
     delete_custom_rpc(rpc_id, session['user_id'])
     return jsonify({'success': True})
 
-@app.route('/activate_rpc/<int:rpc_id>', methods=['POST'])
+@route('/activate_rpc/<int:rpc_id>', methods=['POST'])
 def activate_rpc_route(rpc_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        from rpc_manager import activate_user_rpc
         from database import get_rpc_by_id
         
         rpc_config = get_rpc_by_id(rpc_id, session['user_id'])
         if not rpc_config:
             return jsonify({'error': 'RPC not found'}), 404
         
-        activate_user_rpc(session['user_id'], rpc_config)
-        return jsonify({'success': True})
+        job_id = queue_user_rpc_activation(session['user_id'], rpc_id)
+        return jsonify({'success': True, 'job_id': job_id}), 202
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/deactivate_rpcs', methods=['POST'])
+@route('/deactivate_rpcs', methods=['POST'])
 def deactivate_rpcs_route():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        deactivate_user_rpc(session['user_id'])
-        return jsonify({'success': True})
+        job_id = queue_user_rpc_deactivation(session['user_id'])
+        return jsonify({'success': True, 'job_id': job_id}), 202
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/logout')
+@route('/rpc_jobs/<int:job_id>')
+def rpc_job_status(job_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    job = get_rpc_job(job_id, session['user_id'])
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'success': True, 'job': serialize_rpc_job(job)})
+
+@route('/logout')
 def logout():
     session.clear()
     return redirect(url_for('index'))
 
-@app.route('/api/user/<int:user_id>/rpcs')
+@route('/api/user/<int:user_id>/rpcs')
 def get_user_rpcs_api(user_id):
     """API endpoint to fetch user's RPC configurations for client-side application"""
     api_key = request.headers.get('X-API-Key') or request.args.get('api_key')
@@ -269,61 +416,79 @@ def get_user_rpcs_api(user_id):
     if not authenticated_user_id or authenticated_user_id != user_id:
         return jsonify({'success': False, 'error': 'Invalid API key'}), 401
     
+    # The client polling counts as the user being around
+    rpc_manager.touch(user_id)
     try:
-        custom_rpcs = get_user_rpcs(user_id)
-        
-        rpcs_list = []
-        for rpc in custom_rpcs:
-            rpcs_list.append({
-                'id': rpc['id'],
-                'app_id': rpc['app_id'],
-                'rpc_type': rpc['rpc_type'],
-                'details': rpc['details'],
-                'state': rpc['state'],
-                'timestamp_type': rpc['timestamp_type'],
-                'custom_timestamp': rpc['custom_timestamp'],
-                'large_image_url': rpc['large_image_url'],
-                'large_image_text': rpc['large_image_text'],
-                'small_image_url': rpc['small_image_url'],
-                'small_image_text': rpc['small_image_text'],
-                'buttons': rpc['buttons']
-            })
+        # ?since=<seq> returns only the changes after that feed position, or
+        # the full snapshot below if they have been compacted away
+        since = request.args.get('since', type=int)
+        if since is not None:
+            feed = get_rpc_changes(user_id, since)
+            if feed is not None:
+                changes, cursor = feed
+                return jsonify({
+                    'success': True,
+                    'changes': [serialize_rpc_change(change) for change in changes],
+                    'seq': cursor
+                })
         
-        default_rpc_config = {
-            'app_id': DEFAULT_RPC['app_id'],
-            'details': 'DrakLeafX Community',
-            'state': 'Join us!',
-            'buttons': json.dumps([{
-                'label': DEFAULT_RPC['button_name'],
-                'url': DEFAULT_RPC['button_url']
-            }])
-        }
-        
-        return jsonify({
-            'success': True,
-            'rpcs': rpcs_list,
-            'default_rpc': default_rpc_config
-        })
+        version = get_rpcs_version(user_id)
+        etag = rpcs_etag(user_id, version)
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(get_rpcs_response(user_id, version), mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/health')
+@route('/health')
 def health():
-    return jsonify({'status': 'ok'})
+    """This process's stats, with those of the RPC service fetched in one call when this is an HTTP worker
+
+    An HTTP worker that cannot reach the RPC service still reports its own
+    stats, with status 'degraded' and the error in place of the service's.
+    """
+    status = 'ok'
+    if PROCESS_ROLE == 'web':
+        try:
+            services = rpc_manager.service_stats()
+        except RPCWorkerError as e:
+            status = 'degraded'
+            services = {key: {'error': str(e)} for key in SERVICE_STATS}
+            services['rpc_restore']['ready'] = False
+    else:
+        services = service_stats()
+    return jsonify({
+        'status': status,
+        'ready': services['rpc_restore']['ready'],
+        'db_pool': get_pool_stats(),
+        'db_writes': get_write_queue_stats(),
+        'api_key_cache': get_api_key_cache_stats(),
+        'rpc_response_cache': rpc_response_cache.stats(),
+        'web_sessions': session_store.stats(),
+        **services
+    })
 
-@app.route('/test')
+@route('/test')
 def test():
     return '<h1>Website is working!</h1><p>If you can see this, the Flask app is running correctly.</p>'
 
-@app.errorhandler(404)
+@errorhandler(404)
 def not_found(error):
     return f'<h1>404 - Page Not Found</h1><p>Requested URL: {request.url}</p><p>Available routes: /, /login, /api/auth/callback, /dashboard, /logout, /test</p>', 404
 
-@app.errorhandler(500)
+@errorhandler(500)
 def internal_error(error):
     return f'<h1>500 - Internal Server Error</h1><p>Error: {str(error)}</p>', 500
 
 if __name__ == '__main__':
+    # Everything in one process on the development server; main.py runs the site for real
     init_database()
+    start_change_feed_compactor()
     start_background_tasks()
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    start_token_refresher()
+    start_session_purger(session_store)
+    create_app().run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,187 @@
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """Thread-safe LRU cache with an optional per-entry time to live"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[0] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+class SharedResponseStore:
+    """SQLite file that lets web workers reuse each other's serialized responses"""
+
+    def __init__(self, path):
+        from db_backends import ConnectionPool
+        self.pool = ConnectionPool(path)
+        conn = self.pool.acquire()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    user_id INTEGER PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    body BLOB NOT NULL
+                )
+            ''')
+            conn.commit()
+        finally:
+            self.pool.release(conn)
+
+    def load(self, user_id, version):
+        conn = self.pool.acquire()
+        try:
+            row = conn.execute(
+                'SELECT body FROM response_cache WHERE user_id = ? AND version = ?',
+                (user_id, version)
+            ).fetchone()
+            return row['body'] if row else None
+        finally:
+            self.pool.release(conn)
+
+    def save(self, user_id, version, body):
+        """Store body unless a newer version is already stored"""
+        conn = self.pool.acquire()
+        try:
+            conn.execute('''
+                INSERT INTO response_cache (user_id, version, body) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET version = excluded.version, body = excluded.body
+                WHERE excluded.version > response_cache.version
+            ''', (user_id, version, body))
+            conn.commit()
+        finally:
+            self.pool.release(conn)
+
+class ResponseCache:
+    """Per-user cache of serialized response bodies with a memory cap and LRU eviction
+
+    Entries are tagged with the user's RPC version (users.rpcs_version), so a
+    body is only served while the version it was built for is current, in
+    every worker process.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, store=None):
+        self.max_bytes = max_bytes
+        self.store = store
+        self._entries = OrderedDict()  # user_id -> (version, body)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_build(self, user_id, version, build):
+        """Return the cached body for user_id at version, calling build() to produce it on a miss"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+
+        body = self.store.load(user_id, version) if self.store else None
+        if body is not None:
+            with self._lock:
+                self.shared_hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+            body = build()
+            if self.store:
+                self.store.save(user_id, version, body)
+
+        with self._lock:
+            current = self._entries.get(user_id)
+            if current is None or current[0] <= version:
+                self._put(user_id, version, body)
+        return body
+
+    def _put(self, user_id, version, body):
+        old = self._entries.pop(user_id, None)
+        if old:
+            self._bytes -= len(old[1])
+        if len(body) > self.max_bytes:
+            return
+        self._entries[user_id] = (version, body)
+        self._bytes += len(body)
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        """Drop a user's entry early; stale entries are never served either way
+
+        Runs on the database writer thread after each commit, so the shared
+        store is left alone: its row no longer matches the user's version and
+        is replaced when the next response is built.
+        """
+        with self._lock:
+            old = self._entries.pop(user_id, None)
+            if old:
+                self._bytes -= len(old[1])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'shared': self.store is not None,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,43 @@
+"""
+Web app configuration from the environment
+
+create_app() takes its Flask settings from here; FLASK_-prefixed variables
+(FLASK_SESSION_COOKIE_SECURE=true, say) override them. Every process serving
+the app must share one secret key: it comes from SESSION_SECRET, or when
+that is unset, from SECRET_KEY_PATH, which the first process to start fills
+with a new random key for the others, and the next start, to read.
+"""
+
+import os
+import secrets
+import tempfile
+
+SECRET_KEY_PATH = os.getenv('SECRET_KEY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.secret_key'))
+PERMANENT_SESSION_LIFETIME = int(os.getenv('PERMANENT_SESSION_LIFETIME', '31536000'))  # 1 year
+
+def load_secret_key(path=SECRET_KEY_PATH):
+    """SESSION_SECRET, or the key shared through path, generated by whichever process gets there first"""
+    secret = os.getenv('SESSION_SECRET')
+    if secret:
+        return secret
+    if not os.path.exists(path):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            # Links only if no other process created the file first, so every process reads the same key
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+def flask_config():
+    """Settings for create_app()"""
+    return {
+        'SECRET_KEY': load_secret_key(),
+        'SESSION_PERMANENT': True,
+        'PERMANENT_SESSION_LIFETIME': PERMANENT_SESSION_LIFETIME
+    }
@@ -1,24 +1,49 @@
 import os
-import sqlite3
-from contextlib import contextmanager
 import json
+import calendar
+import datetime
+import hashlib
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from db_backends import create_backend, WriteQueue
+from migrations import run_migrations
+from cache import LRUCache
+from presence_payload import compile_presence
 
 DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rpc_database.sqlite')
+DATABASE_URL = os.getenv('DATABASE_URL') or f'sqlite:///{DATABASE_PATH}'
 
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+_backend = create_backend(DATABASE_URL)
 
-def init_database():
-    """Initialize database tables"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = dict_factory
-    cur = conn.cursor()
+# Small hot-path writes are group-committed by one writer thread per shard
+_writers = {id(shard): WriteQueue(shard) for shard in _backend.shards}
 
-    # Users table
-    cur.execute('''
+# Runs queries over all users on every shard at once
+_fan_out_pool = ThreadPoolExecutor(max_workers=len(_backend.shards)) if len(_backend.shards) > 1 else None
+
+API_KEY_CACHE_SIZE = int(os.getenv('API_KEY_CACHE_SIZE', '10000'))
+API_KEY_CACHE_TTL = float(os.getenv('API_KEY_CACHE_TTL', '300'))
+API_KEY_NEGATIVE_CACHE_TTL = float(os.getenv('API_KEY_NEGATIVE_CACHE_TTL', '60'))
+
+# Change feed rows kept behind the newest one; older rows are compacted away
+RPC_CHANGES_RETAIN = int(os.getenv('RPC_CHANGES_RETAIN', '100000'))
+RPC_CHANGES_COMPACT_INTERVAL = int(os.getenv('RPC_CHANGES_COMPACT_INTERVAL', '3600'))
+
+# Keys come from secrets.token_urlsafe(32); anything else is rejected without a lookup
+API_KEY_PATTERN = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+# Both caches are keyed by the key's hash, never the plaintext key
+_api_key_cache = LRUCache(maxsize=API_KEY_CACHE_SIZE, ttl=API_KEY_CACHE_TTL)
+_bad_api_key_cache = LRUCache(maxsize=API_KEY_CACHE_SIZE, ttl=API_KEY_NEGATIVE_CACHE_TTL)
+
+# Table definitions per backend dialect. Discord snowflakes need BIGINT in
+# PostgreSQL, and users.active_rpc_id can't reference custom_rpcs there
+# because that table is created afterwards.
+SCHEMA = {
+    'sqlite': (
+        '''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY,
             username TEXT,
@@ -34,11 +59,8 @@ def init_database():
             active_rpc_id INTEGER,
             FOREIGN KEY (active_rpc_id) REFERENCES custom_rpcs(id)
         )
-    ''')
-
-
-    # Custom RPCs table
-    cur.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS custom_rpcs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -58,79 +80,464 @@ def init_database():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         )
-    ''')
+        ''',
+    ),
+    'postgres': (
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT PRIMARY KEY,
+            username TEXT,
+            discriminator TEXT,
+            avatar TEXT,
+            email TEXT,
+            access_token TEXT,
+            refresh_token TEXT,
+            token_expiry TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            api_key TEXT UNIQUE,
+            active_rpc_id BIGINT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS custom_rpcs (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            app_id TEXT NOT NULL,
+            rpc_type TEXT DEFAULT 'Playing',
+            details TEXT,
+            state TEXT,
+            timestamp_type TEXT DEFAULT 'live',
+            custom_timestamp BIGINT,
+            large_image_url TEXT,
+            large_image_text TEXT,
+            small_image_url TEXT,
+            small_image_text TEXT,
+            buttons TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+}
+
+# Called with a user_id after a committed write changes that user's RPC set
+_rpcs_changed_listeners = []
+
+def add_rpcs_changed_listener(callback):
+    """Register callback(user_id) to run after a user's RPCs or active RPC change"""
+    _rpcs_changed_listeners.append(callback)
+
+def notify_rpcs_changed(user_id):
+    """Run the RPC change listeners for user_id, e.g. after another process changed its RPCs"""
+    for callback in _rpcs_changed_listeners:
+        try:
+            callback(user_id)
+        except Exception as e:
+            print(f"RPC change listener failed for user {user_id}: {e}")
+
+def get_pool_stats():
+    """Get connection pool hit/miss and wait-time counters"""
+    return _backend.stats()
+
+def get_write_queue_stats():
+    """Get batch counters of the group-commit writers, one dict per shard when sharded"""
+    stats = [writer.stats() for writer in _writers.values()]
+    return stats[0] if len(stats) == 1 else stats
+
+def get_api_key_cache_stats():
+    """Get hit/miss counters of the API key caches"""
+    return {
+        'valid': _api_key_cache.stats(),
+        'invalid': _bad_api_key_cache.stats()
+    }
+
+def hash_api_key(api_key):
+    """Hash an API key for storage and cache lookups"""
+    return hashlib.sha256(api_key.encode()).hexdigest()
 
-    conn.commit()
-    cur.close()
-    conn.close()
+def init_database(backend=None):
+    """Initialize database tables on every shard of backend (the configured database by default)"""
+    backend = backend or _backend
+    for index, shard in enumerate(backend.shards):
+        init_shard(shard, index, len(backend.shards))
     print("Database initialized successfully!")
 
-@contextmanager
-def get_db():
-    """Context manager for database connections"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = dict_factory
-    try:
-        yield conn
-    finally:
-        conn.close()
+def init_shard(shard, index, shards):
+    """Create and migrate the tables of one database file, shard index of shards"""
+    with shard.connection() as conn:
+        cur = conn.cursor()
+        for statement in SCHEMA[shard.dialect]:
+            cur.execute(statement)
+        conn.commit()
+        run_migrations(conn, shard.dialect)
+        _check_shard_layout(cur, index, shards)
+        conn.commit()
+        cur.close()
+
+def _check_shard_layout(cur, index, shards):
+    """Record which shard a database is, or refuse to start if DB_SHARDS changed"""
+    cur.execute(GET_SHARD_LAYOUT_SQL)
+    layout = cur.fetchone()
+    if layout is None:
+        cur.execute(SET_SHARD_LAYOUT_SQL, (index, shards))
+    elif (layout['shard'], layout['shards']) != (index, shards):
+        raise RuntimeError(
+            f"Database file is shard {layout['shard']} of {layout['shards']} but DB_SHARDS={shards}; "
+            f"run python reshard.py {layout['shards']} {shards} first"
+        )
+
+def get_db(user_id=None):
+    """Context manager for a pooled connection to the database holding user_id's rows
+
+    Without a user_id only works when the database is not sharded.
+    """
+    if user_id is None:
+        return _backend.connection()
+    return _backend.shard_for(user_id).connection()
+
+def _fan_out(query):
+    """Run query(conn) on every shard in parallel and return the results in shard order"""
+    def run(shard):
+        with shard.connection() as conn:
+            return query(conn)
+    if _fan_out_pool is None:
+        return [run(shard) for shard in _backend.shards]
+    return list(_fan_out_pool.map(run, _backend.shards))
+
+def _write(user_id, write, wait=True, changed_user_id=None):
+    """Queue write(cursor) for the next group commit on user_id's shard
+
+    Returns write's result once committed, or with wait=False a Future for
+    it. RPC change listeners for changed_user_id run after the commit.
+    """
+    # Writes that change a user's RPCs append to the change feed, which readers page through by seq
+    future = _writers[id(_backend.shard_for(user_id))].submit(write, ordered=changed_user_id is not None)
+    if changed_user_id is not None:
+        def notify(done):
+            if done.exception() is None:
+                notify_rpcs_changed(changed_user_id)
+        future.add_done_callback(notify)
+    return future.result() if wait else future
+
+GET_USER_SQL = 'SELECT * FROM users WHERE id = ?'
+
+UPSERT_USER_SQL = '''
+    INSERT INTO users (id, username, discriminator, avatar, email, access_token, refresh_token, token_expiry, last_login)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT (id) DO UPDATE SET
+        username = EXCLUDED.username,
+        discriminator = EXCLUDED.discriminator,
+        avatar = EXCLUDED.avatar,
+        email = EXCLUDED.email,
+        access_token = EXCLUDED.access_token,
+        refresh_token = EXCLUDED.refresh_token,
+        token_expiry = EXCLUDED.token_expiry,
+        last_login = CURRENT_TIMESTAMP
+'''
+
+GET_ALL_USERS_SQL = 'SELECT * FROM users ORDER BY last_login DESC'
+
+INSERT_CUSTOM_RPC_SQL = '''
+    INSERT INTO custom_rpcs (
+        user_id, app_id, rpc_type, details, state, timestamp_type,
+        custom_timestamp, large_image_url, large_image_text,
+        small_image_url, small_image_text, buttons, presence_payload
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    RETURNING id
+'''
+
+GET_USER_RPCS_SQL = '''
+    SELECT * FROM custom_rpcs 
+    WHERE user_id = ? AND is_active = 1 
+    ORDER BY created_at DESC
+'''
+
+DELETE_CUSTOM_RPC_SQL = '''
+    DELETE FROM custom_rpcs 
+    WHERE id = ? AND user_id = ? AND is_active = 1
+'''
+
+GET_RPC_BY_ID_SQL = '''
+    SELECT * FROM custom_rpcs 
+    WHERE id = ? AND user_id = ? AND is_active = 1
+'''
+
+GET_RPC_CONFIG_SQL = 'SELECT * FROM custom_rpcs WHERE id = ? AND user_id = ?'
+
+UPDATE_USER_TOKENS_SQL = '''
+    UPDATE users SET access_token = ?, refresh_token = ?, last_login = CURRENT_TIMESTAMP
+    WHERE id = ?
+'''
+
+GET_EXPIRING_TOKENS_SQL = '''
+    SELECT id, token_expiry FROM users
+    WHERE token_expiry IS NOT NULL AND token_expiry <= ?
+'''
+
+REFRESH_TOKENS_BATCH_SIZE = 100
+
+GET_REFRESH_TOKENS_SQL = f'''
+    SELECT id, refresh_token, token_expiry FROM users
+    WHERE id IN ({', '.join(['?'] * REFRESH_TOKENS_BATCH_SIZE)})
+'''
+
+# Matching on the refresh token that was used keeps a login in the meantime from being overwritten
+SAVE_REFRESHED_TOKENS_SQL = '''
+    UPDATE users SET access_token = ?, refresh_token = ?, token_expiry = ?
+    WHERE id = ? AND refresh_token = ?
+'''
+
+DROP_TOKEN_EXPIRY_SQL = 'UPDATE users SET token_expiry = NULL WHERE id = ? AND refresh_token = ?'
+
+GET_API_KEY_SQL = 'SELECT api_key FROM users WHERE id = ?'
+
+SET_API_KEY_SQL = 'UPDATE users SET api_key = ? WHERE id = ?'
+
+VERIFY_API_KEY_SQL = 'SELECT id FROM users WHERE api_key = ?'
+
+GET_ACTIVE_RPC_ID_SQL = 'SELECT active_rpc_id FROM users WHERE id = ?'
+
+SET_ACTIVE_RPC_ID_SQL = 'UPDATE users SET active_rpc_id = ? WHERE id = ?'
+
+GET_RPCS_VERSION_SQL = 'SELECT rpcs_version FROM users WHERE id = ?'
+
+# Fixed-size IN list so the statement is prepared once; short batches are padded with NULL
+RPCS_VERSIONS_BATCH_SIZE = 100
+
+GET_RPCS_VERSIONS_SQL = f'''
+    SELECT id, rpcs_version FROM users
+    WHERE id IN ({', '.join(['?'] * RPCS_VERSIONS_BATCH_SIZE)})
+'''
+
+BUMP_RPCS_VERSION_SQL = 'UPDATE users SET rpcs_version = rpcs_version + 1 WHERE id = ?'
+
+RECORD_RPC_CHANGE_SQL = 'INSERT INTO rpc_changes (user_id, rpc_id, op) VALUES (?, ?, ?)'
+
+GET_RPC_CHANGES_SQL = '''
+    SELECT rpc_changes.seq, rpc_changes.op, rpc_changes.rpc_id, custom_rpcs.*
+    FROM rpc_changes
+    LEFT JOIN custom_rpcs ON rpc_changes.op = 'insert' AND custom_rpcs.id = rpc_changes.rpc_id
+    WHERE rpc_changes.user_id = ? AND rpc_changes.seq > ?
+    ORDER BY rpc_changes.seq
+'''
+
+GET_USER_FEED_SEQ_SQL = 'SELECT MAX(seq) AS seq FROM rpc_changes WHERE user_id = ?'
+
+GET_LATEST_FEED_SEQ_SQL = 'SELECT MAX(seq) AS seq FROM rpc_changes'
+
+GET_COMPACTED_THROUGH_SQL = 'SELECT compacted_through FROM rpc_changes_meta WHERE id = 1'
+
+SET_COMPACTED_THROUGH_SQL = 'UPDATE rpc_changes_meta SET compacted_through = ? WHERE id = 1'
+
+COMPACT_RPC_CHANGES_SQL = 'DELETE FROM rpc_changes WHERE seq <= ?'
+
+GET_SHARD_LAYOUT_SQL = 'SELECT shard, shards FROM shard_layout WHERE id = 1'
+
+SET_SHARD_LAYOUT_SQL = 'INSERT INTO shard_layout (id, shard, shards) VALUES (1, ?, ?) ON CONFLICT (id) DO NOTHING'
+
+GET_ACTIVE_RPC_CONFIGS_SQL = '''
+    SELECT users.id as user_id, custom_rpcs.* 
+    FROM users 
+    JOIN custom_rpcs ON users.active_rpc_id = custom_rpcs.id 
+    WHERE users.active_rpc_id IS NOT NULL
+'''
+
+GET_UNLEASED_RPC_CONFIGS_SQL = '''
+    SELECT users.id as user_id, custom_rpcs.*
+    FROM users
+    JOIN custom_rpcs ON users.active_rpc_id = custom_rpcs.id
+    LEFT JOIN rpc_leases ON rpc_leases.user_id = users.id
+    WHERE users.active_rpc_id IS NOT NULL
+    AND (rpc_leases.user_id IS NULL OR rpc_leases.expires_at < ?)
+'''
+
+GET_ACTIVE_RPC_CHANGES_SQL = "SELECT seq, user_id, rpc_id FROM rpc_changes WHERE seq > ? AND op = 'activate' ORDER BY seq"
+
+HEARTBEAT_INSTANCE_SQL = '''
+    INSERT INTO rpc_instances (id, started_at, expires_at) VALUES (?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET expires_at = EXCLUDED.expires_at
+'''
+
+EXPIRE_INSTANCES_SQL = 'DELETE FROM rpc_instances WHERE expires_at < ?'
+
+GET_LIVE_INSTANCES_SQL = 'SELECT id FROM rpc_instances WHERE expires_at >= ? ORDER BY id'
+
+COUNT_LIVE_LEASES_SQL = 'SELECT owner, COUNT(*) AS leases FROM rpc_leases WHERE expires_at >= ? GROUP BY owner'
+
+DELETE_INSTANCE_SQL = 'DELETE FROM rpc_instances WHERE id = ?'
+
+# Only takes a lease that is expired or already the claimant's
+CLAIM_LEASE_SQL = '''
+    INSERT INTO rpc_leases (user_id, owner, expires_at) VALUES (?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+    WHERE rpc_leases.expires_at < ? OR rpc_leases.owner = EXCLUDED.owner
+'''
+
+RENEW_LEASES_SQL = 'UPDATE rpc_leases SET expires_at = ? WHERE owner = ?'
+
+GET_OWNED_LEASES_SQL = 'SELECT user_id FROM rpc_leases WHERE owner = ?'
+
+RELEASE_LEASE_SQL = 'DELETE FROM rpc_leases WHERE user_id = ? AND owner = ?'
+
+RELEASE_ALL_LEASES_SQL = 'DELETE FROM rpc_leases WHERE owner = ?'
+
+# rpc_jobs.run_at is when a queued job may run, when a running job's claim
+# goes stale, and when a finished job finished
+
+# Locks the user's row, so that on PostgreSQL queueing, claiming and retrying
+# one user's jobs take turns
+LOCK_USER_RPC_JOBS_SQL = 'UPDATE users SET rpcs_version = rpcs_version WHERE id = ?'
+
+GET_PENDING_RPC_JOB_SQL = '''
+    SELECT * FROM rpc_jobs
+    WHERE user_id = ? AND status IN ('queued', 'running')
+    ORDER BY id DESC LIMIT 1
+'''
+
+SUPERSEDE_RPC_JOBS_SQL = '''
+    UPDATE rpc_jobs SET status = 'superseded', updated_at = ?, run_at = ?
+    WHERE user_id = ? AND status = 'queued'
+'''
+
+INSERT_RPC_JOB_SQL = '''
+    INSERT INTO rpc_jobs (user_id, kind, rpc_id, status, created_at, updated_at, run_at)
+    VALUES (?, ?, ?, 'queued', ?, ?, ?)
+    RETURNING id
+'''
+
+GET_RPC_JOB_SQL = 'SELECT * FROM rpc_jobs WHERE id = ? AND user_id = ?'
+
+GET_DUE_RPC_JOBS_SQL = '''
+    SELECT * FROM rpc_jobs
+    WHERE status IN ('queued', 'running') AND run_at <= ?
+    ORDER BY run_at LIMIT ?
+'''
+
+CLAIM_RPC_JOB_SQL = '''
+    UPDATE rpc_jobs SET status = 'running', attempts = attempts + 1, updated_at = ?, run_at = ?
+    WHERE id = ? AND status = ? AND run_at = ?
+    AND NOT EXISTS (
+        SELECT 1 FROM rpc_jobs AS running
+        WHERE running.user_id = ? AND running.status = 'running' AND running.run_at > ? AND running.id <> ?
+    )
+'''
+
+SUPERSEDE_STALE_RPC_JOB_SQL = '''
+    UPDATE rpc_jobs SET status = 'superseded', updated_at = ?, run_at = ?
+    WHERE id = ? AND status = 'running' AND run_at = ?
+'''
+
+FINISH_RPC_JOB_SQL = '''
+    UPDATE rpc_jobs SET status = ?, error = ?, updated_at = ?, run_at = ?
+    WHERE id = ? AND status = 'running'
+'''
+
+PURGE_RPC_JOBS_SQL = '''
+    DELETE FROM rpc_jobs
+    WHERE status IN ('done', 'failed', 'superseded') AND run_at < ?
+'''
+
+# Web sessions are keyed by a hash of the session ID and live on the shard that hash maps to
+GET_WEB_SESSION_SQL = 'SELECT data, expires_at FROM web_sessions WHERE id = ? AND expires_at > ?'
+
+SAVE_WEB_SESSION_SQL = '''
+    INSERT INTO web_sessions (id, data, expires_at) VALUES (?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+'''
+
+TOUCH_WEB_SESSION_SQL = 'UPDATE web_sessions SET expires_at = ? WHERE id = ?'
+
+DELETE_WEB_SESSION_SQL = 'DELETE FROM web_sessions WHERE id = ?'
+
+# Deletes a bounded batch so a large purge doesn't hold the write lock for long
+PURGE_WEB_SESSIONS_SQL = '''
+    DELETE FROM web_sessions WHERE id IN (
+        SELECT id FROM web_sessions WHERE expires_at <= ? LIMIT ?
+    )
+'''
 
 def get_user(user_id):
     """Get user by ID"""
-    with get_db() as conn:
+    with get_db(user_id) as conn:
         cur = conn.cursor()
-        cur.execute('SELECT * FROM users WHERE id = ?', (user_id,))
+        cur.execute(GET_USER_SQL, (user_id,))
         user = cur.fetchone()
         cur.close()
         return user
 
-def create_or_update_user(user_data, tokens):
+def format_token_expiry(tokens, now=None):
+    """token_expiry for an OAuth token response, in UTC like CURRENT_TIMESTAMP; None without expires_in"""
+    if not tokens.get('expires_in'):
+        return None
+    expires_at = (now or time.time()) + float(tokens['expires_in'])
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(expires_at))
+
+def token_expiry_epoch(value):
+    """Unix time of a token_expiry as read back from SQLite (text) or PostgreSQL (datetime)"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    return calendar.timegm(value.timetuple())
+
+def _upsert_user(cur, user_data, tokens):
+    cur.execute(UPSERT_USER_SQL, (
+        user_data['id'],
+        user_data.get('username', ''),
+        user_data.get('discriminator', '0'),
+        user_data.get('avatar', ''),
+        user_data.get('email', ''),
+        tokens.get('access_token', ''),
+        tokens.get('refresh_token', ''),
+        format_token_expiry(tokens)
+    ))
+
+def create_or_update_user(user_data, tokens, wait=True):
     """Create or update user in database"""
-    with get_db() as conn:
-        cur = conn.cursor()
-        cur.execute('''
-            INSERT INTO users (id, username, discriminator, avatar, email, access_token, refresh_token, last_login)
-            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT (id) DO UPDATE SET
-                username = EXCLUDED.username,
-                discriminator = EXCLUDED.discriminator,
-                avatar = EXCLUDED.avatar,
-                email = EXCLUDED.email,
-                access_token = EXCLUDED.access_token,
-                refresh_token = EXCLUDED.refresh_token,
-                last_login = CURRENT_TIMESTAMP
-        ''', (
-            user_data['id'],
-            user_data.get('username', ''),
-            user_data.get('discriminator', '0'),
-            user_data.get('avatar', ''),
-            user_data.get('email', ''),
-            tokens.get('access_token', ''),
-            tokens.get('refresh_token', '')
-        ))
-        conn.commit()
-        cur.close()
+    def write(cur):
+        _upsert_user(cur, user_data, tokens)
+    return _write(user_data['id'], write, wait)
+
+def login_user(user_data, tokens):
+    """Save a user who just logged in and give them a new API key, in one transaction"""
+    import secrets
+    user_id = int(user_data['id'])
+    api_key = secrets.token_urlsafe(32)
+    key_hash = hash_api_key(api_key)
+
+    def write(cur):
+        _upsert_user(cur, user_data, tokens)
+        return _replace_api_key(cur, user_id, key_hash)
+    previous = _write(user_id, write)
+
+    _forget_api_key(previous, key_hash)
+    return api_key
 
 def get_all_users():
     """Get all users from database"""
-    with get_db() as conn:
+    def query(conn):
         cur = conn.cursor()
-        cur.execute('SELECT * FROM users ORDER BY last_login DESC')
+        cur.execute(GET_ALL_USERS_SQL)
         users = cur.fetchall()
         cur.close()
         return users
+    results = _fan_out(query)
+    if len(results) == 1:
+        return results[0]
+    return sorted((user for users in results for user in users), key=lambda user: user['last_login'], reverse=True)
 
 def create_custom_rpc(user_id, rpc_data):
-    """Create a custom RPC for user"""
-    with get_db() as conn:
-        cur = conn.cursor()
-        cur.execute('''
-            INSERT INTO custom_rpcs (
-                user_id, app_id, rpc_type, details, state, timestamp_type,
-                custom_timestamp, large_image_url, large_image_text,
-                small_image_url, small_image_text, buttons
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+    """Create a custom RPC for user
+
+    The presence payload is compiled (and the config validated) here unless
+    rpc_data already carries one; raises PresenceConfigError for invalid configs.
+    """
+    presence_payload = rpc_data.get('presence_payload') or compile_presence(rpc_data)
+
+    def write(cur):
+        cur.execute(INSERT_CUSTOM_RPC_SQL, (
             user_id,
             rpc_data.get('app_id'),
             rpc_data.get('rpc_type', 'Playing'),
@@ -142,84 +549,596 @@ def create_custom_rpc(user_id, rpc_data):
             rpc_data.get('large_image_text'),
             rpc_data.get('small_image_url'),
             rpc_data.get('small_image_text'),
-            rpc_data.get('buttons')
+            rpc_data.get('buttons'),
+            presence_payload
         ))
-        rpc_id = cur.lastrowid
-        conn.commit()
-        cur.close()
+        rpc_id = cur.fetchone()['id']
+        cur.execute(BUMP_RPCS_VERSION_SQL, (user_id,))
+        cur.execute(RECORD_RPC_CHANGE_SQL, (user_id, rpc_id, 'insert'))
         return rpc_id
+    return _write(user_id, write, changed_user_id=user_id)
 
 def get_user_rpcs(user_id):
     """Get all RPCs for a user"""
-    with get_db() as conn:
+    with get_db(user_id) as conn:
         cur = conn.cursor()
-        cur.execute('''
-            SELECT * FROM custom_rpcs 
-            WHERE user_id = ? AND is_active = 1 
-            ORDER BY created_at DESC
-        ''', (user_id,))
+        cur.execute(GET_USER_RPCS_SQL, (user_id,))
         rpcs = cur.fetchall()
         cur.close()
         return rpcs
 
 def delete_custom_rpc(rpc_id, user_id):
     """Delete a custom RPC"""
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute('''
-        DELETE FROM custom_rpcs 
-        WHERE id = ? AND user_id = ? AND is_active = 1
-    ''', (rpc_id, user_id))
-
-    conn.commit()
-    cur.close()
+    def write(cur):
+        cur.execute(DELETE_CUSTOM_RPC_SQL, (rpc_id, user_id))
+        if cur.rowcount:
+            cur.execute(BUMP_RPCS_VERSION_SQL, (user_id,))
+            cur.execute(RECORD_RPC_CHANGE_SQL, (user_id, rpc_id, 'delete'))
+    _write(user_id, write, changed_user_id=user_id)
 
 def get_rpc_by_id(rpc_id, user_id):
     """Get a specific RPC by ID"""
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute('''
-        SELECT * FROM custom_rpcs 
-        WHERE id = ? AND user_id = ? AND is_active = 1
-    ''', (rpc_id, user_id))
-
-    rpc = cur.fetchone()
-    cur.close()
-
-    return dict(rpc) if rpc else None
+    with get_db(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute(GET_RPC_BY_ID_SQL, (rpc_id, user_id))
+        rpc = cur.fetchone()
+        cur.close()
+        return dict(rpc) if rpc else None
 
+def get_rpc_config(rpc_id, user_id):
+    """Get one of a user's RPCs by ID, including deleted ones"""
+    with get_db(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute(GET_RPC_CONFIG_SQL, (rpc_id, user_id))
+        rpc = cur.fetchone()
+        cur.close()
+        return rpc
 
-def update_user_tokens(user_id, access_token, refresh_token):
+def update_user_tokens(user_id, access_token, refresh_token, wait=True):
     """Update user tokens"""
-    with get_db() as conn:
+    def write(cur):
+        cur.execute(UPDATE_USER_TOKENS_SQL, (access_token, refresh_token, user_id))
+    return _write(user_id, write, wait)
+
+def get_expiring_tokens(before):
+    """Get (user_id, expiry as Unix time) for every token expiring before the Unix time before"""
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(before))
+    def query(conn):
         cur = conn.cursor()
-        cur.execute('''
-            UPDATE users SET access_token = ?, refresh_token = ?, last_login = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (access_token, refresh_token, user_id))
-        conn.commit()
+        cur.execute(GET_EXPIRING_TOKENS_SQL, (cutoff,))
+        rows = cur.fetchall()
         cur.close()
+        return rows
+    return [(row['id'], token_expiry_epoch(row['token_expiry'])) for rows in _fan_out(query) for row in rows]
+
+def get_refresh_tokens(user_ids):
+    """Get refresh_token and token_expiry for many users, as a dict of user_id -> row"""
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(id(_backend.shard_for(user_id)), []).append(user_id)
+
+    tokens = {}
+    for shard in _backend.shards:
+        shard_user_ids = by_shard.get(id(shard))
+        if not shard_user_ids:
+            continue
+        with shard.connection() as conn:
+            cur = conn.cursor()
+            for start in range(0, len(shard_user_ids), REFRESH_TOKENS_BATCH_SIZE):
+                batch = shard_user_ids[start:start + REFRESH_TOKENS_BATCH_SIZE]
+                batch += [None] * (REFRESH_TOKENS_BATCH_SIZE - len(batch))
+                cur.execute(GET_REFRESH_TOKENS_SQL, batch)
+                for row in cur.fetchall():
+                    tokens[row['id']] = row
+            cur.close()
+    return tokens
+
+def save_token_refreshes(refreshed, revoked=()):
+    """Store refreshed tokens and stop refreshing revoked ones, in one transaction per shard
+
+    refreshed holds (user_id, refresh token used, token response) and
+    revoked holds (user_id, refresh token Discord rejected). Users whose
+    refresh token changed in the meantime are left alone. Returns the set of
+    user_ids on shards whose transaction failed; the other shards are saved.
+    """
+    now = time.time()
+    by_shard = {}
+    for user_id, used, tokens in refreshed:
+        saved = by_shard.setdefault(id(_backend.shard_for(user_id)), ([], [], []))
+        saved[0].append(user_id)
+        saved[1].append((tokens['access_token'], tokens.get('refresh_token', used),
+                         format_token_expiry(tokens, now), user_id, used))
+    for user_id, used in revoked:
+        dropped = by_shard.setdefault(id(_backend.shard_for(user_id)), ([], [], []))
+        dropped[0].append(user_id)
+        dropped[2].append((user_id, used))
+
+    futures = []
+    for user_ids, saved, dropped in by_shard.values():
+        def write(cur, saved=saved, dropped=dropped):
+            if saved:
+                cur.executemany(SAVE_REFRESHED_TOKENS_SQL, saved)
+            if dropped:
+                cur.executemany(DROP_TOKEN_EXPIRY_SQL, dropped)
+        futures.append((user_ids, _write(user_ids[0], write, wait=False)))
+
+    failed = set()
+    for user_ids, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Failed to save refreshed OAuth tokens for {len(user_ids)} user(s): {e}")
+            failed.update(user_ids)
+    return failed
 
 def generate_api_key(user_id):
-    """Generate an API key for user"""
+    """Generate an API key for user, replacing the previous one"""
     import secrets
     api_key = secrets.token_urlsafe(32)
-    with get_db() as conn:
+    key_hash = hash_api_key(api_key)
+
+    def write(cur):
+        return _replace_api_key(cur, user_id, key_hash)
+    previous = _write(user_id, write)
+
+    _forget_api_key(previous, key_hash)
+    return api_key
+
+def _replace_api_key(cur, user_id, key_hash):
+    """Set user_id's API key hash and return the user's row as it was before"""
+    cur.execute(GET_API_KEY_SQL, (user_id,))
+    previous = cur.fetchone()
+    cur.execute(SET_API_KEY_SQL, (key_hash, user_id))
+    return previous
+
+def _get_api_key_hash(user_id):
+    """Get the hash of the user's current API key"""
+    with get_db(user_id) as conn:
         cur = conn.cursor()
-        cur.execute('''
-            UPDATE users SET api_key = ? WHERE id = ?
-        ''', (api_key, user_id))
-        conn.commit()
+        cur.execute(GET_API_KEY_SQL, (user_id,))
+        result = cur.fetchone()
         cur.close()
-    return api_key
+        return result['api_key'] if result else None
+
+def _forget_api_key(previous, key_hash):
+    """Drop a replaced key from the cache, and the new key from the negative cache, after the commit"""
+    if previous and previous['api_key']:
+        _api_key_cache.pop(previous['api_key'])
+    _bad_api_key_cache.pop(key_hash)
 
 def verify_api_key(api_key):
-    """Verify API key and return user ID"""
-    with get_db() as conn:
+    """Verify API key and return user ID
+
+    A cached key is confirmed against the user's stored key hash, a primary
+    key lookup on their shard instead of a search of every shard, so a key
+    rotated by any process stops working everywhere at once.
+    """
+    if not api_key or not API_KEY_PATTERN.match(api_key):
+        return None
+
+    key_hash = hash_api_key(api_key)
+    user_id = _api_key_cache.get(key_hash)
+    if user_id is not None:
+        if _get_api_key_hash(user_id) == key_hash:
+            return user_id
+        _api_key_cache.pop(key_hash)
+        _bad_api_key_cache.set(key_hash, True)
+        return None
+    if _bad_api_key_cache.get(key_hash):
+        return None
+
+    def query(conn):
         cur = conn.cursor()
-        cur.execute('SELECT id FROM users WHERE api_key = ?', (api_key,))
+        cur.execute(VERIFY_API_KEY_SQL, (key_hash,))
         result = cur.fetchone()
         cur.close()
-        return result['id'] if result else None
\ No newline at end of file
+        return result
+    result = next((result for result in _fan_out(query) if result), None)
+
+    if result:
+        _api_key_cache.set(key_hash, result['id'])
+        return result['id']
+    _bad_api_key_cache.set(key_hash, True)
+    return None
+
+def get_active_rpc_id(user_id):
+    """Get the active RPC ID for a user"""
+    with get_db(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute(GET_ACTIVE_RPC_ID_SQL, (user_id,))
+        result = cur.fetchone()
+        cur.close()
+        return result['active_rpc_id'] if result else None
+
+def set_active_rpc_id(user_id, rpc_id, wait=True):
+    """Set the active RPC ID for a user; with wait=False returns a Future for the commit"""
+    def write(cur):
+        cur.execute(SET_ACTIVE_RPC_ID_SQL, (rpc_id, user_id))
+        cur.execute(BUMP_RPCS_VERSION_SQL, (user_id,))
+        cur.execute(RECORD_RPC_CHANGE_SQL, (user_id, rpc_id, 'activate'))
+    return _write(user_id, write, wait, changed_user_id=user_id)
+
+def get_rpcs_version(user_id):
+    """Get the counter bumped on every change to a user's RPCs or active RPC"""
+    with get_db(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute(GET_RPCS_VERSION_SQL, (user_id,))
+        result = cur.fetchone()
+        cur.close()
+        return result['rpcs_version'] if result else 0
+
+def get_rpcs_versions(user_ids):
+    """Get rpcs_version for many users, as a dict of user_id -> version"""
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(id(_backend.shard_for(user_id)), []).append(user_id)
+
+    versions = {}
+    for shard in _backend.shards:
+        shard_user_ids = by_shard.get(id(shard))
+        if not shard_user_ids:
+            continue
+        with shard.connection() as conn:
+            cur = conn.cursor()
+            for start in range(0, len(shard_user_ids), RPCS_VERSIONS_BATCH_SIZE):
+                batch = shard_user_ids[start:start + RPCS_VERSIONS_BATCH_SIZE]
+                batch += [None] * (RPCS_VERSIONS_BATCH_SIZE - len(batch))
+                cur.execute(GET_RPCS_VERSIONS_SQL, batch)
+                for row in cur.fetchall():
+                    versions[row['id']] = row['rpcs_version']
+            cur.close()
+    return versions
+
+def get_rpc_feed_cursor(user_id):
+    """Get the change feed position a full snapshot of a user's RPCs corresponds to"""
+    with get_db(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute(GET_USER_FEED_SEQ_SQL, (user_id,))
+        user_seq = cur.fetchone()['seq'] or 0
+        cur.execute(GET_COMPACTED_THROUGH_SQL)
+        compacted_through = cur.fetchone()['compacted_through']
+        cur.close()
+        return max(user_seq, compacted_through)
+
+def get_rpc_changes(user_id, since):
+    """Get a user's RPC changes after feed position `since`
+
+    Returns (changes, cursor), or None when changes after `since` have been
+    compacted away and the caller needs a full snapshot instead. Changes are
+    dicts with seq, op ('insert', 'delete' or 'activate'), rpc_id and, for
+    inserts of RPCs that still exist, the custom_rpcs columns.
+
+    Paging by seq relies on rows committing in seq order. SQLite has one
+    writer at a time; on PostgreSQL the writes that append to the feed are
+    ordered writes, which take an advisory lock for their whole transaction.
+    """
+    with get_db(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute(GET_COMPACTED_THROUGH_SQL)
+        if since < cur.fetchone()['compacted_through']:
+            cur.close()
+            return None
+        cur.execute(GET_RPC_CHANGES_SQL, (user_id, since))
+        changes = cur.fetchall()
+        cur.close()
+    cursor = changes[-1]['seq'] if changes else since
+    return changes, cursor
+
+def compact_rpc_changes(retain=RPC_CHANGES_RETAIN):
+    """Delete change feed rows older than the newest `retain` ones on each shard"""
+    def compact(conn):
+        cur = conn.cursor()
+        cur.execute(GET_LATEST_FEED_SEQ_SQL)
+        cutoff = (cur.fetchone()['seq'] or 0) - retain
+        cur.execute(GET_COMPACTED_THROUGH_SQL)
+        if cutoff <= cur.fetchone()['compacted_through']:
+            cur.close()
+            return 0
+        cur.execute(SET_COMPACTED_THROUGH_SQL, (cutoff,))
+        cur.execute(COMPACT_RPC_CHANGES_SQL, (cutoff,))
+        removed = cur.rowcount
+        conn.commit()
+        cur.close()
+        return removed
+    return sum(_fan_out(compact))
+
+def _compact_rpc_changes_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            removed = compact_rpc_changes()
+            if removed:
+                print(f"Compacted {removed} RPC change feed entries")
+        except Exception as e:
+            print(f"Failed to compact RPC change feed: {e}")
+
+def start_change_feed_compactor(interval=RPC_CHANGES_COMPACT_INTERVAL):
+    """Start the background thread that compacts the RPC change feed"""
+    thread = threading.Thread(target=_compact_rpc_changes_forever, args=(interval,), daemon=True)
+    thread.start()
+    return thread
+
+def get_active_rpc_configs():
+    """Get the active RPC of every user that has one"""
+    def query(conn):
+        cur = conn.cursor()
+        cur.execute(GET_ACTIVE_RPC_CONFIGS_SQL)
+        rpcs = cur.fetchall()
+        cur.close()
+        return rpcs
+    return [rpc for rpcs in _fan_out(query) for rpc in rpcs]
+
+def get_unleased_rpc_configs():
+    """Get the active RPC of every user whose session no instance holds a live lease on"""
+    now = time.time()
+    def query(conn):
+        cur = conn.cursor()
+        cur.execute(GET_UNLEASED_RPC_CONFIGS_SQL, (now,))
+        rpcs = cur.fetchall()
+        cur.close()
+        return rpcs
+    return [rpc for rpcs in _fan_out(query) for rpc in rpcs]
+
+def get_feed_positions():
+    """Get the newest change feed position on each shard"""
+    def query(conn):
+        cur = conn.cursor()
+        cur.execute(GET_LATEST_FEED_SEQ_SQL)
+        seq = cur.fetchone()['seq'] or 0
+        cur.close()
+        return seq
+    return _fan_out(query)
+
+def get_active_rpc_changes(positions):
+    """Get active RPC changes after the given per-shard feed positions
+
+    Returns each changed user's latest active rpc_id (None once deactivated)
+    as a dict, and the new positions. Pages by seq like get_rpc_changes.
+    """
+    changes = {}
+    positions = list(positions)
+    for index, shard in enumerate(_backend.shards):
+        with shard.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(GET_ACTIVE_RPC_CHANGES_SQL, (positions[index],))
+            for row in cur.fetchall():
+                changes[row['user_id']] = row['rpc_id']
+                positions[index] = row['seq']
+            cur.close()
+    return changes, positions
+
+def heartbeat_instance(instance_id, started_at, ttl):
+    """Register or refresh a running instance and return the sorted IDs of every live one
+
+    The instance registry lives on the first shard.
+    """
+    now = time.time()
+    with _backend.shards[0].connection() as conn:
+        cur = conn.cursor()
+        cur.execute(HEARTBEAT_INSTANCE_SQL, (instance_id, started_at, now + ttl))
+        cur.execute(EXPIRE_INSTANCES_SQL, (now,))
+        conn.commit()
+        cur.execute(GET_LIVE_INSTANCES_SQL, (now,))
+        instances = [row['id'] for row in cur.fetchall()]
+        cur.close()
+        return instances
+
+def get_live_instances():
+    """Get the sorted IDs of every running instance"""
+    with _backend.shards[0].connection() as conn:
+        cur = conn.cursor()
+        cur.execute(GET_LIVE_INSTANCES_SQL, (time.time(),))
+        instances = [row['id'] for row in cur.fetchall()]
+        cur.close()
+        return instances
+
+def get_live_lease_counts():
+    """Get how many live leases each instance holds, as a dict of owner -> count"""
+    now = time.time()
+    def query(conn):
+        cur = conn.cursor()
+        cur.execute(COUNT_LIVE_LEASES_SQL, (now,))
+        rows = cur.fetchall()
+        cur.close()
+        return rows
+    counts = {}
+    for rows in _fan_out(query):
+        for row in rows:
+            counts[row['owner']] = counts.get(row['owner'], 0) + row['leases']
+    return counts
+
+def remove_instance(instance_id):
+    """Unregister an instance and drop its leases so other instances can take its users at once"""
+    with _backend.shards[0].connection() as conn:
+        cur = conn.cursor()
+        cur.execute(DELETE_INSTANCE_SQL, (instance_id,))
+        conn.commit()
+        cur.close()
+
+    def release(conn):
+        cur = conn.cursor()
+        cur.execute(RELEASE_ALL_LEASES_SQL, (instance_id,))
+        conn.commit()
+        cur.close()
+    _fan_out(release)
+
+def claim_leases(owner, user_ids, ttl):
+    """Take the leases on user_ids that are free, expired or already owner's; returns the user IDs taken"""
+    now = time.time()
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(id(_backend.shard_for(user_id)), []).append(user_id)
+
+    claimed = []
+    for shard in _backend.shards:
+        shard_user_ids = by_shard.get(id(shard))
+        if not shard_user_ids:
+            continue
+        with shard.connection() as conn:
+            cur = conn.cursor()
+            for user_id in shard_user_ids:
+                cur.execute(CLAIM_LEASE_SQL, (user_id, owner, now + ttl, now))
+                if cur.rowcount:
+                    claimed.append(user_id)
+            conn.commit()
+            cur.close()
+    return claimed
+
+def renew_leases(owner, ttl):
+    """Extend every lease owner holds, one statement per shard, and return the user IDs it still holds"""
+    expires_at = time.time() + ttl
+    def renew(conn):
+        cur = conn.cursor()
+        cur.execute(RENEW_LEASES_SQL, (expires_at, owner))
+        conn.commit()
+        cur.execute(GET_OWNED_LEASES_SQL, (owner,))
+        rows = cur.fetchall()
+        cur.close()
+        return rows
+    return {row['user_id'] for rows in _fan_out(renew) for row in rows}
+
+def release_lease(owner, user_id):
+    """Give up owner's lease on user_id"""
+    with get_db(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute(RELEASE_LEASE_SQL, (user_id, owner))
+        conn.commit()
+        cur.close()
+
+def enqueue_rpc_job(user_id, kind, rpc_id=None):
+    """Queue an activation ('activate' with rpc_id) or deactivation of user_id's RPC; returns the job ID
+
+    A job identical to the user's newest pending one is not queued again;
+    otherwise the new job supersedes the user's queued jobs. A job already
+    running is left to finish, and the new one waits for it (see
+    claim_rpc_job), so the user's newest job is always the last to apply.
+    """
+    def write(cur):
+        now = time.time()
+        cur.execute(LOCK_USER_RPC_JOBS_SQL, (user_id,))
+        cur.execute(GET_PENDING_RPC_JOB_SQL, (user_id,))
+        pending = cur.fetchone()
+        if pending and pending['kind'] == kind and pending['rpc_id'] == rpc_id:
+            return pending['id']
+        cur.execute(SUPERSEDE_RPC_JOBS_SQL, (now, now, user_id))
+        cur.execute(INSERT_RPC_JOB_SQL, (user_id, kind, rpc_id, now, now, now))
+        return cur.fetchone()['id']
+    return _write(user_id, write)
+
+def get_rpc_job(job_id, user_id):
+    """Get one of a user's RPC jobs"""
+    with get_db(user_id) as conn:
+        cur = conn.cursor()
+        cur.execute(GET_RPC_JOB_SQL, (job_id, user_id))
+        job = cur.fetchone()
+        cur.close()
+        return job
+
+def get_due_rpc_jobs(limit):
+    """Get up to limit jobs per shard that are queued and due, or whose claim has gone stale"""
+    now = time.time()
+    def query(conn):
+        cur = conn.cursor()
+        cur.execute(GET_DUE_RPC_JOBS_SQL, (now, limit))
+        jobs = cur.fetchall()
+        cur.close()
+        return jobs
+    return sorted((job for jobs in _fan_out(query) for job in jobs), key=lambda job: job['run_at'])
+
+def claim_rpc_job(job, timeout):
+    """Mark a job returned by get_due_rpc_jobs running for up to timeout seconds
+
+    False if someone else got it, or if another of the user's jobs is still
+    running in any process; the job is claimed once that one ends or its
+    claim goes stale. A stale claim is superseded instead of run again when
+    the user has queued a newer job since.
+    """
+    def write(cur):
+        now = time.time()
+        cur.execute(LOCK_USER_RPC_JOBS_SQL, (job['user_id'],))
+        if job['status'] == 'running':
+            cur.execute(GET_PENDING_RPC_JOB_SQL, (job['user_id'],))
+            newest = cur.fetchone()
+            if newest and newest['id'] != job['id']:
+                cur.execute(SUPERSEDE_STALE_RPC_JOB_SQL, (now, now, job['id'], job['run_at']))
+                return False
+        cur.execute(CLAIM_RPC_JOB_SQL, (
+            now, now + timeout, job['id'], job['status'], job['run_at'],
+            job['user_id'], now, job['id']
+        ))
+        return cur.rowcount == 1
+    return _write(job['user_id'], write)
+
+def finish_rpc_job(job, status, error=None, run_at=None):
+    """Record a running job as done, failed, or queued again at run_at; False if it was superseded meanwhile
+
+    A job to be retried is superseded instead when the user queued a newer
+    job while it ran.
+    """
+    def write(cur):
+        now = time.time()
+        if status == 'queued':
+            cur.execute(LOCK_USER_RPC_JOBS_SQL, (job['user_id'],))
+            cur.execute(GET_PENDING_RPC_JOB_SQL, (job['user_id'],))
+            newest = cur.fetchone()
+            if newest and newest['id'] != job['id']:
+                cur.execute(FINISH_RPC_JOB_SQL, ('superseded', error, now, now, job['id']))
+                return False
+        cur.execute(FINISH_RPC_JOB_SQL, (status, error, now, run_at or now, job['id']))
+        return cur.rowcount == 1
+    return _write(job['user_id'], write)
+
+def purge_rpc_jobs(older_than):
+    """Delete jobs that finished more than older_than seconds ago on each shard"""
+    cutoff = time.time() - older_than
+    def purge(conn):
+        cur = conn.cursor()
+        cur.execute(PURGE_RPC_JOBS_SQL, (cutoff,))
+        removed = cur.rowcount
+        conn.commit()
+        cur.close()
+        return removed
+    return sum(_fan_out(purge))
+
+def get_web_session(session_key):
+    """Get the stored data and expiry of an unexpired web session, or None"""
+    with get_db(session_key) as conn:
+        cur = conn.cursor()
+        cur.execute(GET_WEB_SESSION_SQL, (session_key, time.time()))
+        row = cur.fetchone()
+        cur.close()
+        return row
+
+def save_web_session(session_key, data, expires_at, wait=True):
+    """Create or replace a web session"""
+    def write(cur):
+        cur.execute(SAVE_WEB_SESSION_SQL, (session_key, data, expires_at))
+    return _write(session_key, write, wait)
+
+def touch_web_session(session_key, expires_at):
+    """Move a web session's expiry without rewriting its data"""
+    def write(cur):
+        cur.execute(TOUCH_WEB_SESSION_SQL, (expires_at, session_key))
+    return _write(session_key, write)
+
+def delete_web_session(session_key):
+    def write(cur):
+        cur.execute(DELETE_WEB_SESSION_SQL, (session_key,))
+    return _write(session_key, write)
+
+def purge_web_sessions(batch_size):
+    """Delete expired web sessions on each shard, batch_size rows per transaction"""
+    now = time.time()
+    def purge(conn):
+        removed = 0
+        cur = conn.cursor()
+        while True:
+            cur.execute(PURGE_WEB_SESSIONS_SQL, (now, batch_size))
+            batch = cur.rowcount
+            conn.commit()
+            removed += batch
+            if batch < batch_size:
+                break
+        cur.close()
+        return removed
+    return sum(_fan_out(purge))
@@ -0,0 +1,501 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+# Number of SQLite files users are spread over; change it offline with reshard.py
+DB_SHARDS = int(os.getenv('DB_SHARDS', '1'))
+DB_STATEMENT_CACHE_SIZE = 256
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '256'))
+# How long the writer waits for more writes to join a batch before committing
+DB_WRITE_LATENCY_MS = float(os.getenv('DB_WRITE_LATENCY_MS', '2'))
+
+# Applied once per pooled connection instead of on every get_db() call
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',  # 16 MB page cache
+    'PRAGMA mmap_size = 268435456',  # 256 MB
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+)
+
+# PostgreSQL advisory lock held by every transaction with an ordered write (see WriteQueue._commit)
+ORDERED_WRITE_LOCK_ID = 0x52504346
+
+# Only these statement kinds can be server-side prepared in PostgreSQL
+PREPARABLE_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'VALUES')
+
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+class PoolStats:
+    """Hit/miss and wait-time counters shared by the pool implementations"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def record_wait(self, started):
+        with self.lock:
+            self.waits += 1
+            self.wait_time += time.monotonic() - started
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'waits': self.waits,
+            'wait_time_ms': round(self.wait_time * 1000, 3)
+        }
+
+class ConnectionPool:
+    """Bounded pool of pre-configured SQLite connections"""
+
+    def __init__(self, path, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = PoolStats()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = dict_factory
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        """Take an idle connection, opening a new one while under the size limit"""
+        try:
+            conn = self._idle.get_nowait()
+            with self._stats.lock:
+                self._stats.hits += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            with self._stats.lock:
+                self._stats.misses += 1
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        started = time.monotonic()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No database connection available after {self.timeout}s")
+        self._stats.record_wait(started)
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding any uncommitted work"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self.discard(conn)
+            return
+        self._idle.put(conn)
+
+    def discard(self, conn):
+        """Close a connection that must not be reused"""
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+    def stats(self):
+        stats = {'size': self.size, 'open': self._created, 'idle': self._idle.qsize()}
+        stats.update(self._stats.as_dict())
+        return stats
+
+class SQLiteBackend:
+    """Single-file SQLite storage behind a connection pool"""
+
+    dialect = 'sqlite'
+
+    def __init__(self, path, pool_size=DB_POOL_SIZE):
+        self.path = path
+        self.pool = ConnectionPool(path, size=pool_size)
+        self.shards = [self]
+
+    def shard_for(self, user_id):
+        return self
+
+    @contextmanager
+    def connection(self):
+        conn = self.pool.acquire()
+        try:
+            yield conn
+        finally:
+            self.pool.release(conn)
+
+    def stats(self):
+        stats = {'backend': self.dialect}
+        stats.update(self.pool.stats())
+        return stats
+
+    def close(self):
+        self.pool.close_all()
+
+def shard_path(path, index):
+    """File of shard index for a database at path: rpc_database.sqlite -> rpc_database.shard0.sqlite"""
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard{index}{ext}'
+
+def shard_index(user_id, shards):
+    """Shard a user's rows live in; stable across processes, unlike hash()"""
+    return zlib.crc32(str(user_id).encode()) % shards
+
+class ShardedSQLiteBackend:
+    """Users and their rows spread over several SQLite files by user_id
+
+    Each shard has its own file, pool and write lock. Queries for one user
+    go to shard_for(user_id); database.py fans queries over every user out
+    to all shards and merges the results.
+    """
+
+    dialect = 'sqlite'
+
+    def __init__(self, path, shards, pool_size=DB_POOL_SIZE):
+        self.path = path
+        self.shards = [SQLiteBackend(shard_path(path, index), pool_size) for index in range(shards)]
+
+    def shard_for(self, user_id):
+        return self.shards[shard_index(user_id, len(self.shards))]
+
+    def connection(self):
+        raise TypeError("A sharded database has no single connection; use shard_for(user_id)")
+
+    def stats(self):
+        return {'backend': 'sqlite-sharded', 'shards': [shard.stats() for shard in self.shards]}
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+def _to_numbered_params(sql):
+    """Rewrite qmark placeholders to PostgreSQL's $1, $2, ... form"""
+    parts = sql.split('?')
+    out = [parts[0]]
+    for idx, part in enumerate(parts[1:], start=1):
+        out.append(f'${idx}')
+        out.append(part)
+    return ''.join(out), len(parts) - 1
+
+class PostgresCursor:
+    """Cursor that runs qmark-style SQL through per-connection prepared statements"""
+
+    def __init__(self, conn):
+        from psycopg2.extras import RealDictCursor
+        self._conn = conn
+        self._cur = conn.raw.cursor(cursor_factory=RealDictCursor)
+
+    def execute(self, sql, params=()):
+        params = tuple(params)
+        keyword = sql.lstrip().split(None, 1)[0].upper()
+        if keyword not in PREPARABLE_STATEMENTS:
+            self._cur.execute(sql.replace('?', '%s'), params)
+            return self
+
+        name = self._conn.prepare(self._cur, sql)
+        if params:
+            placeholders = ', '.join(['%s'] * len(params))
+            self._cur.execute(f'EXECUTE {name} ({placeholders})', params)
+        else:
+            self._cur.execute(f'EXECUTE {name}')
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        for params in seq_of_params:
+            self.execute(sql, params)
+        return self
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    def close(self):
+        self._cur.close()
+
+class PostgresConnection:
+    """Wraps a pooled psycopg2 connection with the sqlite3-style API database.py uses"""
+
+    def __init__(self, raw, prepared):
+        self.raw = raw
+        self._prepared = prepared
+
+    def prepare(self, cur, sql):
+        """Return the prepared statement name for sql, preparing it on first use"""
+        name = self._prepared.get(sql)
+        if name is None:
+            name = f'stmt_{len(self._prepared) + 1}'
+            numbered, _ = _to_numbered_params(sql)
+            cur.execute(f'PREPARE {name} AS {numbered}')
+            self._prepared[sql] = name
+        return name
+
+    def cursor(self):
+        return PostgresCursor(self)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    @property
+    def in_transaction(self):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+        return self.raw.info.transaction_status != TRANSACTION_STATUS_IDLE
+
+class PostgresBackend:
+    """PostgreSQL storage behind a threaded psycopg2 connection pool"""
+
+    dialect = 'postgres'
+
+    def __init__(self, dsn, pool_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        from psycopg2.pool import ThreadedConnectionPool
+        self.dsn = dsn
+        self.size = pool_size
+        self.timeout = timeout
+        # minconn == maxconn so returned connections (and their prepared
+        # statements) are kept instead of being closed by the pool
+        self.pool = ThreadedConnectionPool(pool_size, pool_size, dsn)
+        # ThreadedConnectionPool raises instead of blocking when exhausted
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._prepared = {}
+        self._stats = PoolStats()
+        self.shards = [self]
+
+    def shard_for(self, user_id):
+        return self
+
+    def _acquire(self):
+        if not self._slots.acquire(blocking=False):
+            started = time.monotonic()
+            if not self._slots.acquire(timeout=self.timeout):
+                raise TimeoutError(f"No database connection available after {self.timeout}s")
+            self._stats.record_wait(started)
+        try:
+            raw = self.pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._stats.lock:
+            if id(raw) in self._prepared:
+                self._stats.hits += 1
+            else:
+                self._stats.misses += 1
+                self._prepared[id(raw)] = {}
+        return raw
+
+    def _release(self, raw):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+        broken = bool(raw.closed) or raw.info.transaction_status == TRANSACTION_STATUS_UNKNOWN
+        if not broken and raw.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            try:
+                raw.rollback()
+            except Exception:
+                broken = True
+        if broken:
+            with self._stats.lock:
+                self._prepared.pop(id(raw), None)
+        self.pool.putconn(raw, close=broken)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        raw = self._acquire()
+        try:
+            yield PostgresConnection(raw, self._prepared[id(raw)])
+        finally:
+            self._release(raw)
+
+    def stats(self):
+        stats = {'backend': self.dialect, 'size': self.size, 'open': len(self._prepared)}
+        stats.update(self._stats.as_dict())
+        return stats
+
+    def close(self):
+        self.pool.closeall()
+
+class WriteQueue:
+    """Single writer thread that commits queued writes in batches
+
+    A write is a callable taking a cursor. Each batch runs in one
+    transaction with a savepoint per write, so a failing write is rolled
+    back on its own and only its future gets the exception. A batch commits
+    when it holds batch_size writes or latency_ms after its first write
+    arrived, whichever comes first. Ordered writes commit in the order they
+    drew sequence values, across every process writing to the database.
+    """
+
+    def __init__(self, backend, batch_size=DB_WRITE_BATCH_SIZE, latency_ms=DB_WRITE_LATENCY_MS):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.latency = latency_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+        self.failures = 0
+        self.max_batch = 0
+        self.commit_time = 0.0
+
+    def submit(self, write, ordered=False):
+        """Queue write(cursor) and return a Future for its return value, set once committed"""
+        future = Future()
+        self._start()
+        self._queue.put((write, future, ordered))
+        return future
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # Writes whose callers cancelled them in the meantime are skipped
+            batch = [(write, future, ordered) for write, future, ordered in self._next_batch()
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self._commit(batch)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), (ok, value) in zip(batch, results):
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _commit(self, batch):
+        started = time.monotonic()
+        results = []
+        with self.backend.connection() as conn:
+            cur = conn.cursor()
+            if self.backend.dialect == 'sqlite':
+                # Take the write lock up front instead of upgrading mid-batch
+                cur.execute('BEGIN IMMEDIATE')
+            elif any(ordered for _, _, ordered in batch):
+                # A sequence value is drawn at INSERT, and transactions from other processes can commit in
+                # another order, so a reader paging by sequence could skip a row that commits late. Taking
+                # this lock first and holding it to commit runs these transactions one at a time, in sequence
+                # order; taking it before any row lock means a holder never waits on another batch.
+                cur.execute('SELECT pg_advisory_xact_lock(?)', (ORDERED_WRITE_LOCK_ID,))
+            for index, (write, _, _) in enumerate(batch):
+                cur.execute(f'SAVEPOINT write_{index}')
+                try:
+                    value = write(cur)
+                except Exception as e:
+                    cur.execute(f'ROLLBACK TO SAVEPOINT write_{index}')
+                    results.append((False, e))
+                else:
+                    results.append((True, value))
+                cur.execute(f'RELEASE SAVEPOINT write_{index}')
+            conn.commit()
+            cur.close()
+        with self._stats_lock:
+            self.batches += 1
+            self.writes += len(batch)
+            self.failures += sum(1 for ok, _ in results if not ok)
+            self.max_batch = max(self.max_batch, len(batch))
+            self.commit_time += time.monotonic() - started
+        return results
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'queued': self._queue.qsize(),
+                'batches': self.batches,
+                'writes': self.writes,
+                'failures': self.failures,
+                'max_batch': self.max_batch,
+                'avg_batch': round(self.writes / self.batches, 2) if self.batches else 0.0,
+                'avg_commit_ms': round(self.commit_time / self.batches * 1000, 3) if self.batches else 0.0
+            }
+
+def create_backend(url, shards=DB_SHARDS):
+    """Create the storage backend named by a DATABASE_URL-style string"""
+    if url.startswith('sqlite:///'):
+        if shards > 1:
+            return ShardedSQLiteBackend(url[len('sqlite:///'):], shards)
+        return SQLiteBackend(url[len('sqlite:///'):])
+    if url.startswith(('postgres://', 'postgresql://')):
+        return PostgresBackend(url)
+    raise ValueError(f"Unsupported DATABASE_URL scheme: {url.split(':', 1)[0]}")
@@ -0,0 +1,209 @@
+"""
+Discord HTTP API client
+
+All calls to Discord's HTTP API share one requests session, so logins reuse
+keep-alive connections from a pool of DISCORD_HTTP_POOL_SIZE instead of
+opening a new TLS connection per call. Every call has a timeout
+(DISCORD_HTTP_TIMEOUT). Failed connections, and rate limits or server
+errors on idempotent calls, are retried DISCORD_HTTP_RETRIES times with
+exponential backoff, and Retry-After is honoured. Adding a user to the
+community guild runs in the background after login, on
+DISCORD_GUILD_JOIN_WORKERS threads.
+
+Usage:
+    python discord_api.py bench [LOGINS] [CONCURRENCY]  Compare login throughput before and after against a local stand-in for Discord
+"""
+
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DISCORD_API_BASE = os.getenv('DISCORD_API_BASE', 'https://discord.com/api/v10')
+DISCORD_TOKEN_URL = f'{DISCORD_API_BASE}/oauth2/token'
+GUILD_ID = '1036197746417340496'
+
+DISCORD_HTTP_TIMEOUT = float(os.getenv('DISCORD_HTTP_TIMEOUT', '10'))
+DISCORD_HTTP_POOL_SIZE = int(os.getenv('DISCORD_HTTP_POOL_SIZE', '32'))
+DISCORD_HTTP_RETRIES = int(os.getenv('DISCORD_HTTP_RETRIES', '2'))
+DISCORD_HTTP_BACKOFF = float(os.getenv('DISCORD_HTTP_BACKOFF', '0.5'))
+DISCORD_GUILD_JOIN_WORKERS = int(os.getenv('DISCORD_GUILD_JOIN_WORKERS', '4'))
+
+class DiscordSession(requests.Session):
+    """requests.Session with pooled keep-alive connections, retries and a default timeout"""
+
+    def __init__(self, timeout=DISCORD_HTTP_TIMEOUT, pool_size=DISCORD_HTTP_POOL_SIZE,
+                 retries=DISCORD_HTTP_RETRIES, backoff=DISCORD_HTTP_BACKOFF):
+        super().__init__()
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # A POST may have been processed (an OAuth code is single-use), so
+            # it is only retried when the connection could not be made at all
+            allowed_methods=frozenset({'GET', 'PUT', 'DELETE'}),
+            # Hand the last response back instead of raising, so callers see Discord's error
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+# Shared by every thread; requests' connection pool is thread-safe
+discord_http = DiscordSession()
+
+_guild_joins = ThreadPoolExecutor(max_workers=DISCORD_GUILD_JOIN_WORKERS, thread_name_prefix='guild-join')
+
+def add_guild_member(user_id, access_token):
+    """Add a user to the community guild with their OAuth token"""
+    response = discord_http.put(
+        f'{DISCORD_API_BASE}/guilds/{GUILD_ID}/members/{user_id}',
+        json={'access_token': access_token},
+        headers={'Authorization': f'Bot {os.getenv("DISCORD_BOT_TOKEN")}'}
+    )
+    # 201 when added, 204 when already a member
+    if response.status_code not in (201, 204):
+        print(f"Failed to add user {user_id} to guild: {response.status_code} - {response.text}")
+    return response.status_code
+
+def join_guild_later(user_id, access_token):
+    """Add a user to the community guild in the background"""
+    def join():
+        try:
+            add_guild_member(user_id, access_token)
+        except Exception as e:
+            print(f"Failed to add user {user_id} to guild: {e}")
+    _guild_joins.submit(join)
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """Answers OAuth code exchanges and refreshes, /users/@me and guild joins like Discord, after a fixed delay
+
+    Refresh tokens starting with "revoked" are rejected with invalid_grant.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let them wait on a delayed ACK
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def _reply(self, status, payload=None):
+        time.sleep(self.latency)
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_POST(self):
+        form = {key: values[0] for key, values in parse_qs(self._read_body().decode()).items()}
+        if not self.path.endswith('/oauth2/token'):
+            self._reply(404, {'message': 'Unknown endpoint'})
+        elif form.get('grant_type') == 'refresh_token':
+            if form.get('refresh_token', '').startswith('revoked'):
+                self._reply(400, {'error': 'invalid_grant'})
+            else:
+                self._reply(200, {'access_token': secrets.token_urlsafe(16), 'refresh_token': secrets.token_urlsafe(16),
+                                  'token_type': 'Bearer', 'expires_in': 604800, 'scope': 'identify email'})
+        elif form.get('grant_type') == 'authorization_code':
+            # The code doubles as the user ID so the benchmark can make many users
+            self._reply(200, {'access_token': f'token-{form.get("code")}', 'refresh_token': 'refresh',
+                              'token_type': 'Bearer', 'expires_in': 604800, 'scope': 'identify email'})
+        else:
+            self._reply(400, {'error': 'unsupported_grant_type'})
+
+    def do_GET(self):
+        if self.path.endswith('/users/@me'):
+            user_id = self.headers.get('Authorization', '').rsplit('-', 1)[-1]
+            self._reply(200, {'id': user_id, 'username': f'user{user_id}', 'discriminator': '0',
+                              'avatar': None, 'email': f'user{user_id}@example.com'})
+        else:
+            self._reply(404, {'message': 'Unknown endpoint'})
+
+    def do_PUT(self):
+        self._read_body()
+        self._reply(201, {})
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stand_in(latency=0.0):
+    """Serve the stand-in Discord API on a free local port; returns the server and its API base URL"""
+    handler = type('Handler', (_StandInHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/api/v10'
+
+def benchmark(logins=300, concurrency=16, latency=0.02):
+    """Logins per second with the old inline flow and with the current one
+
+    The stand-in answers every request after `latency` seconds over plain
+    HTTP, so it models round trips but not TLS handshakes.
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Never write benchmark users to the real database
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(tmp_dir, "bench.sqlite")}'
+        import database
+        database.init_database()
+
+        server, base = start_stand_in(latency)
+
+        def old_login(code):
+            # One new connection per call, the guild join inline, three writes
+            tokens = requests.post(f'{base}/oauth2/token', data={'code': code, 'grant_type': 'authorization_code'},
+                                   headers={'Content-Type': 'application/x-www-form-urlencoded'}).json()
+            user_data = requests.get(f'{base}/users/@me',
+                                     headers={'Authorization': f'Bearer {tokens["access_token"]}'}).json()
+            requests.put(f'{base}/guilds/{GUILD_ID}/members/{user_data["id"]}',
+                         json={'access_token': tokens['access_token']})
+            database.create_or_update_user(user_data, tokens)
+            database.generate_api_key(int(user_data['id']))
+
+        session = DiscordSession()
+        guild_joins = ThreadPoolExecutor(max_workers=DISCORD_GUILD_JOIN_WORKERS)
+
+        def new_login(code):
+            tokens = session.post(f'{base}/oauth2/token', data={'code': code, 'grant_type': 'authorization_code'},
+                                  headers={'Content-Type': 'application/x-www-form-urlencoded'}).json()
+            user_data = session.get(f'{base}/users/@me',
+                                    headers={'Authorization': f'Bearer {tokens["access_token"]}'}).json()
+            guild_joins.submit(session.put, f'{base}/guilds/{GUILD_ID}/members/{user_data["id"]}',
+                               json={'access_token': tokens['access_token']})
+            database.login_user(user_data, tokens)
+
+        results = {}
+        for name, login, offset in (('inline, unpooled', old_login, 1), ('pooled, background join', new_login, 1 + logins)):
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(login, range(offset, offset + logins)))
+            results[name] = logins / (time.monotonic() - started)
+        guild_joins.shutdown()
+        server.shutdown()
+        return results
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        logins = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+        concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+        for name, rate in benchmark(logins, concurrency).items():
+            print(f"{name}: {rate:.0f} logins/s")
+    else:
+        print(__doc__)
@@ -0,0 +1,173 @@
+"""
+Per-session health check scheduling
+
+Instead of probing every presence session at once on a fixed sweep, each
+session gets its own due time in a heap. Intervals are jittered so checks
+spread out over time, and sessions whose checks keep failing back off
+exponentially up to RPC_HEALTH_MAX_BACKOFF. Both RPC engines drive a
+HealthScheduler and probe with ping_presence(), which does not touch the
+presence itself.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import struct
+import threading
+import time
+import uuid
+
+RPC_HEALTH_INTERVAL = float(os.getenv('RPC_HEALTH_INTERVAL', '30'))
+RPC_HEALTH_JITTER = float(os.getenv('RPC_HEALTH_JITTER', '0.2'))
+RPC_HEALTH_MAX_BACKOFF = float(os.getenv('RPC_HEALTH_MAX_BACKOFF', '600'))
+
+# Discord IPC opcodes
+OP_PING = 3
+OP_PONG = 4
+
+async def ping_presence(rpc, timeout):
+    """Send an IPC ping on a connected pypresence client and wait for the pong
+
+    Unlike re-sending the activity this leaves the presence (and its elapsed
+    timer) untouched. Raises on timeout, a closed pipe or an unexpected reply.
+    """
+    rpc.send_data(OP_PING, {'nonce': str(uuid.uuid4())})
+    preamble = await asyncio.wait_for(rpc.sock_reader.readexactly(8), timeout)
+    op, length = struct.unpack('<II', preamble)
+    await asyncio.wait_for(rpc.sock_reader.readexactly(length), timeout)
+    if op != OP_PONG:
+        raise ConnectionError(f"Expected pong from Discord, got opcode {op}")
+
+class HealthScheduler:
+    """Thread-safe heap of per-key due times with jitter and exponential backoff
+
+    Rescheduling a key leaves its old heap entry behind; stale entries are
+    skipped when they reach the top.
+    """
+
+    def __init__(self, interval=RPC_HEALTH_INTERVAL, jitter=RPC_HEALTH_JITTER, max_backoff=RPC_HEALTH_MAX_BACKOFF):
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self._heap = []  # (due_at, seq, key)
+        self._entries = {}  # key -> [due_at, seq, failures]
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self.checks = 0
+        self.failures = 0
+        self.lag_total = 0.0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+
+    def _jittered(self, delay):
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _push(self, key, delay, failures):
+        due_at = time.monotonic() + delay
+        seq = next(self._seq)
+        self._entries[key] = [due_at, seq, failures]
+        heapq.heappush(self._heap, (due_at, seq, key))
+        self._changed.notify_all()
+
+    def add(self, key, delay=None):
+        """Start checking key, first after delay seconds or by default at a random point within one interval"""
+        with self._lock:
+            self._push(key, random.uniform(0, self.interval) if delay is None else delay, 0)
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def succeeded(self, key):
+        """Schedule key's next check one jittered interval out and clear its backoff"""
+        with self._lock:
+            if key in self._entries:
+                self._push(key, self._jittered(self.interval), 0)
+
+    def failed(self, key):
+        """Schedule key's next check with exponential backoff"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self.failures += 1
+            failures = entry[2] + 1
+            delay = min(self.interval * 2 ** failures, self.max_backoff)
+            self._push(key, self._jittered(delay), failures)
+
+    def postpone(self, key):
+        """Check key again one interval out without changing its backoff"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._push(key, self._jittered(self.interval), entry[2])
+
+    def _discard_stale(self):
+        while self._heap:
+            due_at, seq, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == seq:
+                return
+            heapq.heappop(self._heap)
+
+    def pop_due(self, limit=None):
+        """Take every key whose check is due, or the limit most overdue, and record how late each is
+
+        Taken keys stay registered but are not due again until they are
+        passed to succeeded(), failed() or postpone().
+        """
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            self._discard_stale()
+            while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+                due_at, seq, key = heapq.heappop(self._heap)
+                # No heap entry matches None, so the key stays out of the heap until rescheduled
+                self._entries[key][1] = None
+                lag = now - due_at
+                self.checks += 1
+                self.lag_total += lag
+                self.lag_last = lag
+                self.lag_max = max(self.lag_max, lag)
+                due.append(key)
+                self._discard_stale()
+        return due
+
+    def next_delay(self, default=None):
+        """Seconds until the next check is due, or default when nothing is scheduled"""
+        with self._lock:
+            self._discard_stale()
+            if not self._heap:
+                return default
+            return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def wait(self, timeout):
+        """Block until a check may be due, for at most timeout seconds"""
+        with self._lock:
+            self._discard_stale()
+            if self._heap:
+                timeout = min(timeout, max(0.0, self._heap[0][0] - time.monotonic()))
+            self._changed.wait(timeout)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': len(self._entries),
+                'heap_size': len(self._heap),
+                'backing_off': sum(1 for entry in self._entries.values() if entry[2]),
+                'checks': self.checks,
+                'failures': self.failures,
+                'lag_ms_last': round(self.lag_last * 1000, 3),
+                'lag_ms_max': round(self.lag_max * 1000, 3),
+                'lag_ms_avg': round(self.lag_total / self.checks * 1000, 3) if self.checks else 0.0
+            }
@@ -1,23 +1,230 @@
+"""
+Production entry point
+
+Runs the site as supervised processes:
+  - WEB_WORKERS HTTP workers (default: one per CPU core) accepting from one
+    listening socket on WEB_HOST:WEB_PORT, each serving create_app() on a pool
+    of WEB_THREADS threads
+  - the RPC service: presence sessions and their health checks, queued RPC
+    jobs, OAuth token refresh, expired web session purging and change feed
+    compaction, reachable by the HTTP workers at RPC_CONTROL_ADDRESS
+  - the push server
+  - the Discord bot, when DISCORD_BOT_TOKEN is set
+A process that exits is started again, after a delay that doubles up to
+RESTART_MAX_DELAY seconds while it keeps dying within a minute of starting.
+SIGTERM or SIGINT stops the HTTP workers accepting connections and waits up
+to SHUTDOWN_TIMEOUT seconds for every process to finish before killing it.
+
+Usage:
+    python main.py         Run all of the above
+    python main.py ROLE    Run one process in the foreground: web, rpc, push or bot (for an external supervisor)
+"""
+
 import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
+WEB_PORT = int(os.getenv('WEB_PORT', '5000'))
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', str(os.cpu_count() or 1)))
+WEB_THREADS = int(os.getenv('WEB_THREADS', '16'))
+WEB_BACKLOG = int(os.getenv('WEB_BACKLOG', '1024'))
+WEB_KEEPALIVE_TIMEOUT = float(os.getenv('WEB_KEEPALIVE_TIMEOUT', '5'))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '30'))
+RESTART_MAX_DELAY = float(os.getenv('RESTART_MAX_DELAY', '30'))
+
+# A process that ran this long before exiting is restarted without backoff
+RESTART_RESET_AFTER = 60
+
+class _RequestHandler(WSGIRequestHandler):
+    # An idle keep-alive connection gives its thread back after this long
+    timeout = WEB_KEEPALIVE_TIMEOUT
+
+class PooledWSGIServer(BaseWSGIServer):
+    """werkzeug's WSGI server handling connections on a fixed pool of threads"""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=WEB_THREADS, fd=None):
+        super().__init__(host, port, app, handler=_RequestHandler, fd=fd)
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def drain(self):
+        """Wait for the connections already accepted to finish"""
+        self._pool.shutdown(wait=True)
+
+def _on_stop(stop):
+    """Call stop on SIGTERM or SIGINT, from a thread of its own"""
+    def handle(signum, frame):
+        threading.Thread(target=stop, daemon=True).start()
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
+
+def _stop_with_supervisor(supervisor_pid):
+    """SIGTERM this process once the supervisor that started it is gone, even if it was killed"""
+    def watch():
+        while os.getppid() == supervisor_pid:
+            time.sleep(1)
+        os.kill(os.getpid(), signal.SIGTERM)
+    threading.Thread(target=watch, daemon=True).start()
+
+def _wait_for_stop():
+    stopped = threading.Event()
+    _on_stop(stopped.set)
+    stopped.wait()
+
+def run_web():
+    """HTTP worker: serve the app on the supervisor's listening socket, or bind WEB_HOST:WEB_PORT alone"""
+    from app import create_app
+    fd = os.getenv('WEB_LISTEN_FD')
+    server = PooledWSGIServer(WEB_HOST, WEB_PORT, create_app(), fd=int(fd) if fd else None)
+    _on_stop(server.shutdown)
+    print(f"✓ Web worker started (pid {os.getpid()})")
+    server.serve_forever()
+    server.drain()
+
+def run_rpc():
+    """RPC service: every background task, plus the control channel the HTTP workers call"""
+    from database import start_change_feed_compactor
+    from rpc_control import serve_control, CONTROL_METHODS, RPC_CONTROL_ADDRESS
+    from rpc_persistent import rpc_manager, service_stats, start_background_tasks
+    from session_store import SessionStore, start_session_purger
+    from token_refresh import start_token_refresher
+
+    start_change_feed_compactor()
+    start_background_tasks()
+    start_token_refresher()
+    start_session_purger(SessionStore())
+    listener = None
+    if RPC_CONTROL_ADDRESS:
+        handlers = {method: getattr(rpc_manager, method) for method in CONTROL_METHODS}
+        handlers['service_stats'] = service_stats
+        listener = serve_control(handlers)
+    _wait_for_stop()
+    if listener is not None:
+        listener.close()
+    # Exiting runs the atexit snapshot of health-checked sessions, if RPC_SNAPSHOT_PATH is set
+
+def run_push():
+    """Push server, stopping gracefully on SIGTERM or SIGINT"""
+    from aiohttp import web
+    from push_server import create_push_app, PUSH_HOST, PUSH_PORT
+    web.run_app(create_push_app(), host=PUSH_HOST, port=PUSH_PORT, print=None)
 
 def run_bot():
-    """Run the Discord bot in a separate thread"""
+    """Discord bot"""
     from bot import bot
-    token = os.getenv('DISCORD_BOT_TOKEN')
-    if token:
-        bot.run(token)
+    bot.run(os.getenv('DISCORD_BOT_TOKEN'))
 
-if __name__ == '__main__':
+ROLES = {'web': run_web, 'rpc': run_rpc, 'push': run_push, 'bot': run_bot}
+
+class _Child:
+    """A supervised process running one role of this script"""
+
+    def __init__(self, name, role, env, pass_fds=()):
+        self.name = name
+        self.role = role
+        self.env = dict(env, PROCESS_ROLE=role, SUPERVISOR_PID=str(os.getpid()))
+        self.pass_fds = pass_fds
+        self.process = None
+        self.started_at = None
+        self.restart_at = None
+        self.delay = 1.0
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), self.role],
+                                        env=self.env, pass_fds=self.pass_fds)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+
+    def check(self):
+        """Schedule a restart if the process exited, and restart it when due"""
+        if self.restart_at is None:
+            code = self.process.poll()
+            if code is None:
+                return
+            if time.monotonic() - self.started_at >= RESTART_RESET_AFTER:
+                self.delay = 1.0
+            print(f"{self.name} (pid {self.process.pid}) exited with code {code}; restarting in {self.delay:.0f}s")
+            self.restart_at = time.monotonic() + self.delay
+            self.delay = min(self.delay * 2, RESTART_MAX_DELAY)
+        elif time.monotonic() >= self.restart_at:
+            self.start()
+
+def supervise():
+    """Start every process, keep them running until SIGTERM or SIGINT, then stop them"""
+    from config import load_secret_key
     from database import init_database
-    from app import app
-    
+
     print("Initializing database...")
     init_database()
-    
-    print("Starting Discord bot in background...")
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    bot_thread.start()
-    
-    print("Starting web server on port 5000...")
-    app.run(host='0.0.0.0', port=5000, debug=False)
+
+    # Every process signs sessions and authenticates the RPC control channel with the same key
+    env = dict(os.environ, SESSION_SECRET=load_secret_key())
+    env.setdefault('RPC_CONTROL_ADDRESS', os.path.join(tempfile.gettempdir(), f'rpc-control-{os.getpid()}.sock'))
+
+    listener = socket.create_server((WEB_HOST, WEB_PORT), backlog=WEB_BACKLOG)
+    web_env = dict(env, WEB_LISTEN_FD=str(listener.fileno()))
+    children = [_Child('RPC service', 'rpc', env), _Child('Push server', 'push', env)]
+    if os.getenv('DISCORD_BOT_TOKEN'):
+        children.append(_Child('Discord bot', 'bot', env))
+    else:
+        print("DISCORD_BOT_TOKEN is not set; the Discord bot will not run")
+    children += [_Child(f'Web worker {index}', 'web', web_env, pass_fds=(listener.fileno(),))
+                 for index in range(WEB_WORKERS)]
+
+    stopping = threading.Event()
+    _on_stop(stopping.set)
+    for child in children:
+        child.start()
+    print(f"Serving on http://{WEB_HOST}:{WEB_PORT} with {WEB_WORKERS} web worker(s)")
+
+    while not stopping.wait(0.5):
+        for child in children:
+            child.check()
+
+    print("Shutting down...")
+    listener.close()
+    for child in children:
+        if child.process.poll() is None:
+            child.process.terminate()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for child in children:
+        try:
+            child.process.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"{child.name} did not stop within {SHUTDOWN_TIMEOUT:.0f}s; killing it")
+            child.process.kill()
+            child.process.wait()
+    if os.path.exists(env['RPC_CONTROL_ADDRESS']):
+        os.unlink(env['RPC_CONTROL_ADDRESS'])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        if sys.argv[1] not in ROLES:
+            print(__doc__)
+            sys.exit(1)
+        os.environ.setdefault('PROCESS_ROLE', sys.argv[1])
+        if os.getenv('SUPERVISOR_PID'):
+            _stop_with_supervisor(int(os.environ['SUPERVISOR_PID']))
+        ROLES[sys.argv[1]]()
+    else:
+        supervise()
@@ -0,0 +1,310 @@
+"""
+Versioned schema migrations
+
+Each migration runs once per database, in order, and is recorded in the
+schema_migrations table. Steps must be idempotent so that two processes
+starting at the same time can both apply a migration safely.
+
+Usage:
+    python migrations.py              Apply pending migrations
+    python migrations.py check-plans  Fail if any query in database.py does a full table scan
+"""
+
+import hashlib
+import sqlite3
+import sys
+
+SCHEMA_MIGRATIONS_SQL = '''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+def _hash_plaintext_api_keys(cur):
+    """Replace stored plaintext API keys with their SHA-256 digest"""
+    cur.execute('SELECT id, api_key FROM users WHERE api_key IS NOT NULL')
+    for row in cur.fetchall():
+        # Already-hashed keys are 64 hex chars; issued keys are 43 chars
+        if len(row['api_key']) != 64:
+            digest = hashlib.sha256(row['api_key'].encode()).hexdigest()
+            cur.execute('UPDATE users SET api_key = ? WHERE id = ?', (digest, row['id']))
+
+def _compile_presence_payloads(cur):
+    """Store a compiled presence payload for every RPC saved before payloads existed"""
+    from presence_payload import compile_presence
+    cur.execute('SELECT * FROM custom_rpcs WHERE presence_payload IS NULL')
+    for row in cur.fetchall():
+        cur.execute('UPDATE custom_rpcs SET presence_payload = ? WHERE id = ?',
+                    (compile_presence(row, validate=False), row['id']))
+
+def _add_sqlite_column(table, column, definition):
+    """Build a step that adds a column unless it already exists (SQLite has no IF NOT EXISTS here)"""
+    def step(cur):
+        cur.execute(f'PRAGMA table_info({table})')
+        if column not in {row['name'] for row in cur.fetchall()}:
+            cur.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return step
+
+# (version, name, steps per dialect); a step is SQL or a callable taking a cursor
+MIGRATIONS = [
+    (1, 'index active rpcs per user', {
+        'sqlite': [
+            '''CREATE INDEX IF NOT EXISTS idx_custom_rpcs_user_active
+               ON custom_rpcs (user_id, created_at DESC, id) WHERE is_active = 1''',
+        ],
+        'postgres': [
+            '''CREATE INDEX IF NOT EXISTS idx_custom_rpcs_user_active
+               ON custom_rpcs (user_id, created_at DESC) INCLUDE (id) WHERE is_active = 1''',
+        ],
+    }),
+    (2, 'index users with an active rpc', {
+        'sqlite': [
+            '''CREATE INDEX IF NOT EXISTS idx_users_active_rpc
+               ON users (active_rpc_id) WHERE active_rpc_id IS NOT NULL''',
+        ],
+        'postgres': [
+            '''CREATE INDEX IF NOT EXISTS idx_users_active_rpc
+               ON users (active_rpc_id) WHERE active_rpc_id IS NOT NULL''',
+        ],
+    }),
+    (3, 'store api keys hashed', {
+        'sqlite': [_hash_plaintext_api_keys],
+        'postgres': [_hash_plaintext_api_keys],
+    }),
+    (4, 'per-user rpc version counter', {
+        'sqlite': [_add_sqlite_column('users', 'rpcs_version', 'INTEGER NOT NULL DEFAULT 0')],
+        'postgres': ['ALTER TABLE users ADD COLUMN IF NOT EXISTS rpcs_version INTEGER NOT NULL DEFAULT 0'],
+    }),
+    (5, 'rpc change feed', {
+        'sqlite': [
+            '''CREATE TABLE IF NOT EXISTS rpc_changes (
+                   seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                   user_id INTEGER NOT NULL,
+                   rpc_id INTEGER,
+                   op TEXT NOT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               )''',
+            'CREATE INDEX IF NOT EXISTS idx_rpc_changes_user_seq ON rpc_changes (user_id, seq)',
+            '''CREATE TABLE IF NOT EXISTS rpc_changes_meta (
+                   id INTEGER PRIMARY KEY CHECK (id = 1),
+                   compacted_through INTEGER NOT NULL
+               )''',
+            'INSERT INTO rpc_changes_meta (id, compacted_through) VALUES (1, 0) ON CONFLICT (id) DO NOTHING',
+        ],
+        'postgres': [
+            '''CREATE TABLE IF NOT EXISTS rpc_changes (
+                   seq BIGSERIAL PRIMARY KEY,
+                   user_id BIGINT NOT NULL,
+                   rpc_id BIGINT,
+                   op TEXT NOT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               )''',
+            'CREATE INDEX IF NOT EXISTS idx_rpc_changes_user_seq ON rpc_changes (user_id, seq)',
+            '''CREATE TABLE IF NOT EXISTS rpc_changes_meta (
+                   id INTEGER PRIMARY KEY CHECK (id = 1),
+                   compacted_through BIGINT NOT NULL
+               )''',
+            'INSERT INTO rpc_changes_meta (id, compacted_through) VALUES (1, 0) ON CONFLICT (id) DO NOTHING',
+        ],
+    }),
+    (6, 'precompiled presence payloads', {
+        'sqlite': [
+            _add_sqlite_column('custom_rpcs', 'presence_payload', 'TEXT'),
+            _compile_presence_payloads,
+        ],
+        'postgres': [
+            'ALTER TABLE custom_rpcs ADD COLUMN IF NOT EXISTS presence_payload TEXT',
+            _compile_presence_payloads,
+        ],
+    }),
+    (7, 'shard layout', {
+        'sqlite': [
+            '''CREATE TABLE IF NOT EXISTS shard_layout (
+                   id INTEGER PRIMARY KEY CHECK (id = 1),
+                   shard INTEGER NOT NULL,
+                   shards INTEGER NOT NULL
+               )''',
+        ],
+        'postgres': [
+            '''CREATE TABLE IF NOT EXISTS shard_layout (
+                   id INTEGER PRIMARY KEY CHECK (id = 1),
+                   shard INTEGER NOT NULL,
+                   shards INTEGER NOT NULL
+               )''',
+        ],
+    }),
+    (8, 'rpc session leases', {
+        'sqlite': [
+            '''CREATE TABLE IF NOT EXISTS rpc_instances (
+                   id TEXT PRIMARY KEY,
+                   started_at REAL NOT NULL,
+                   expires_at REAL NOT NULL
+               )''',
+            '''CREATE TABLE IF NOT EXISTS rpc_leases (
+                   user_id INTEGER PRIMARY KEY,
+                   owner TEXT NOT NULL,
+                   expires_at REAL NOT NULL
+               )''',
+            'CREATE INDEX IF NOT EXISTS idx_rpc_leases_owner ON rpc_leases (owner)',
+        ],
+        'postgres': [
+            '''CREATE TABLE IF NOT EXISTS rpc_instances (
+                   id TEXT PRIMARY KEY,
+                   started_at DOUBLE PRECISION NOT NULL,
+                   expires_at DOUBLE PRECISION NOT NULL
+               )''',
+            '''CREATE TABLE IF NOT EXISTS rpc_leases (
+                   user_id BIGINT PRIMARY KEY,
+                   owner TEXT NOT NULL,
+                   expires_at DOUBLE PRECISION NOT NULL
+               )''',
+            'CREATE INDEX IF NOT EXISTS idx_rpc_leases_owner ON rpc_leases (owner)',
+        ],
+    }),
+    (9, 'rpc activation jobs', {
+        'sqlite': [
+            '''CREATE TABLE IF NOT EXISTS rpc_jobs (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   user_id INTEGER NOT NULL,
+                   kind TEXT NOT NULL,
+                   rpc_id INTEGER,
+                   status TEXT NOT NULL,
+                   attempts INTEGER NOT NULL DEFAULT 0,
+                   error TEXT,
+                   created_at REAL NOT NULL,
+                   updated_at REAL NOT NULL,
+                   run_at REAL NOT NULL
+               )''',
+            'CREATE INDEX IF NOT EXISTS idx_rpc_jobs_due ON rpc_jobs (status, run_at)',
+            'CREATE INDEX IF NOT EXISTS idx_rpc_jobs_user ON rpc_jobs (user_id, status)',
+        ],
+        'postgres': [
+            '''CREATE TABLE IF NOT EXISTS rpc_jobs (
+                   id BIGSERIAL PRIMARY KEY,
+                   user_id BIGINT NOT NULL,
+                   kind TEXT NOT NULL,
+                   rpc_id BIGINT,
+                   status TEXT NOT NULL,
+                   attempts INTEGER NOT NULL DEFAULT 0,
+                   error TEXT,
+                   created_at DOUBLE PRECISION NOT NULL,
+                   updated_at DOUBLE PRECISION NOT NULL,
+                   run_at DOUBLE PRECISION NOT NULL
+               )''',
+            'CREATE INDEX IF NOT EXISTS idx_rpc_jobs_due ON rpc_jobs (status, run_at)',
+            'CREATE INDEX IF NOT EXISTS idx_rpc_jobs_user ON rpc_jobs (user_id, status)',
+        ],
+    }),
+    (10, 'index token expiry', {
+        'sqlite': [
+            '''CREATE INDEX IF NOT EXISTS idx_users_token_expiry
+               ON users (token_expiry) WHERE token_expiry IS NOT NULL''',
+        ],
+        'postgres': [
+            '''CREATE INDEX IF NOT EXISTS idx_users_token_expiry
+               ON users (token_expiry) WHERE token_expiry IS NOT NULL''',
+        ],
+    }),
+    (11, 'web sessions', {
+        'sqlite': [
+            '''CREATE TABLE IF NOT EXISTS web_sessions (
+                   id TEXT PRIMARY KEY,
+                   data TEXT NOT NULL,
+                   expires_at REAL NOT NULL
+               )''',
+            'CREATE INDEX IF NOT EXISTS idx_web_sessions_expires ON web_sessions (expires_at)',
+        ],
+        'postgres': [
+            '''CREATE TABLE IF NOT EXISTS web_sessions (
+                   id TEXT PRIMARY KEY,
+                   data TEXT NOT NULL,
+                   expires_at DOUBLE PRECISION NOT NULL
+               )''',
+            'CREATE INDEX IF NOT EXISTS idx_web_sessions_expires ON web_sessions (expires_at)',
+        ],
+    }),
+]
+
+# Queries that list a whole table on purpose; rpc_instances holds one row per running instance
+FULL_SCAN_ALLOWED = {'GET_ALL_USERS_SQL', 'GET_LIVE_INSTANCES_SQL', 'EXPIRE_INSTANCES_SQL'}
+
+def _run_step(cur, step):
+    if callable(step):
+        step(cur)
+    else:
+        cur.execute(step)
+
+def run_migrations(conn, dialect):
+    """Apply every migration newer than the database's schema version"""
+    cur = conn.cursor()
+    cur.execute(SCHEMA_MIGRATIONS_SQL)
+    conn.commit()
+
+    cur.execute('SELECT version FROM schema_migrations')
+    applied = {row['version'] for row in cur.fetchall()}
+
+    for version, name, steps in MIGRATIONS:
+        if version in applied:
+            continue
+        for step in steps[dialect]:
+            _run_step(cur, step)
+        cur.execute(
+            'INSERT INTO schema_migrations (version, name) VALUES (?, ?) ON CONFLICT (version) DO NOTHING',
+            (version, name)
+        )
+        conn.commit()
+        print(f"Applied migration {version}: {name}")
+    cur.close()
+
+def get_schema_version(conn):
+    """Get the newest applied migration version"""
+    cur = conn.cursor()
+    cur.execute('SELECT MAX(version) AS version FROM schema_migrations')
+    row = cur.fetchone()
+    cur.close()
+    return row['version'] or 0
+
+def check_query_plans():
+    """Run EXPLAIN QUERY PLAN on every *_SQL query in database.py
+
+    Uses a scratch in-memory SQLite database with the full schema, so the
+    check works the same whatever DATABASE_URL points at. Returns a list of
+    (query name, plan detail) pairs for queries that scan a whole table.
+    """
+    import database
+    from db_backends import dict_factory
+
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = dict_factory
+    for statement in database.SCHEMA['sqlite']:
+        conn.execute(statement)
+    run_migrations(conn, 'sqlite')
+    conn.execute('ANALYZE')
+
+    failures = []
+    for name in sorted(dir(database)):
+        if not name.endswith('_SQL') or name in FULL_SCAN_ALLOWED:
+            continue
+        sql = getattr(database, name)
+        params = (None,) * sql.count('?')
+        for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall():
+            detail = row['detail']
+            # "SCAN t USING INDEX ..." walks an index; a bare "SCAN t" reads every row
+            if detail.startswith('SCAN ') and ' USING ' not in detail:
+                failures.append((name, detail))
+    conn.close()
+    return failures
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'check-plans':
+        failures = check_query_plans()
+        for name, detail in failures:
+            print(f"FULL SCAN in {name}: {detail}")
+        if failures:
+            sys.exit(1)
+        print("All queries use an index")
+    else:
+        from database import init_database
+        init_database()
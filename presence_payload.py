@@ -0,0 +1,162 @@
+"""
+Precompiled presence payloads
+
+compile_presence() validates an RPC config once, when it is saved, and
+turns it into compact JSON holding the finished Presence.update() keyword
+arguments. Activations only parse that JSON (cached per payload) and fill in
+the start timestamp for live timers.
+
+Usage:
+    python presence_payload.py bench  Compare per-activation cost with and without a stored payload
+"""
+
+import json
+import sys
+import time
+from functools import lru_cache
+from urllib.parse import urlparse
+
+MAX_BUTTONS = 2
+
+# Discord's limits on activity strings
+MAX_TEXT_LENGTH = 128
+MAX_IMAGE_LENGTH = 256
+MAX_BUTTON_LABEL_LENGTH = 32
+MAX_BUTTON_URL_LENGTH = 512
+
+PRESENCE_PAYLOAD_CACHE_SIZE = 4096
+
+# Config fields holding activity strings
+TEXT_FIELDS = ('details', 'state', 'large_image_url', 'large_image_text', 'small_image_url', 'small_image_text')
+
+class PresenceConfigError(ValueError):
+    """An RPC config that Discord would reject"""
+
+def _check_string(name, value):
+    if not isinstance(value, str):
+        raise PresenceConfigError(f"{name} must be a string")
+
+def _check_length(name, value, limit):
+    if len(value) > limit:
+        raise PresenceConfigError(f"{name} must be at most {limit} characters")
+
+def _is_url(value):
+    parsed = urlparse(value)
+    return parsed.scheme in ('http', 'https') and bool(parsed.netloc)
+
+def _check_image(name, value):
+    _check_length(name, value, MAX_IMAGE_LENGTH)
+    # Anything else is an asset key uploaded to the application
+    if '://' in value and not _is_url(value):
+        raise PresenceConfigError(f"{name} must be an http(s) URL or an asset key")
+
+def compile_presence(rpc_config, validate=True):
+    """Compile an RPC config into a compact JSON presence payload
+
+    Raises PresenceConfigError when validate is set and the config breaks
+    Discord's limits. Stored rows from before validation existed are
+    compiled with validate=False.
+    """
+    if validate:
+        for field in TEXT_FIELDS:
+            if rpc_config.get(field) is not None:
+                _check_string(field, rpc_config[field])
+
+    args = {}
+    if rpc_config.get('details'):
+        args['details'] = rpc_config['details']
+    if rpc_config.get('state'):
+        args['state'] = rpc_config['state']
+
+    if rpc_config.get('large_image_url'):
+        args['large_image'] = rpc_config['large_image_url']
+        if rpc_config.get('large_image_text'):
+            args['large_text'] = rpc_config['large_image_text']
+
+    if rpc_config.get('small_image_url'):
+        args['small_image'] = rpc_config['small_image_url']
+        if rpc_config.get('small_image_text'):
+            args['small_text'] = rpc_config['small_image_text']
+
+    buttons = rpc_config.get('buttons')
+    if isinstance(buttons, str):
+        try:
+            buttons = json.loads(buttons)
+        except ValueError:
+            if validate:
+                raise PresenceConfigError("buttons must be a JSON list")
+            buttons = None
+    if buttons:
+        args['buttons'] = buttons
+
+    live = rpc_config.get('timestamp_type') == 'live'
+    if not live and rpc_config.get('custom_timestamp'):
+        try:
+            args['start'] = int(rpc_config['custom_timestamp'])
+        except (TypeError, ValueError):
+            if validate:
+                raise PresenceConfigError("custom_timestamp must be a Unix timestamp")
+
+    if validate:
+        for arg in ('details', 'state', 'large_text', 'small_text'):
+            if arg in args:
+                _check_length(arg, args[arg], MAX_TEXT_LENGTH)
+        for arg in ('large_image', 'small_image'):
+            if arg in args:
+                _check_image(arg, args[arg])
+        if not isinstance(args.get('buttons', []), list):
+            raise PresenceConfigError("buttons must be a JSON list")
+        if len(args.get('buttons', ())) > MAX_BUTTONS:
+            raise PresenceConfigError(f"At most {MAX_BUTTONS} buttons are allowed")
+        for button in args.get('buttons', ()):
+            if not isinstance(button, dict) or not button.get('label') or not button.get('url'):
+                raise PresenceConfigError("Buttons need a label and a URL")
+            _check_string('Button label', button['label'])
+            _check_string('Button URL', button['url'])
+            _check_length('Button label', button['label'], MAX_BUTTON_LABEL_LENGTH)
+            _check_length('Button URL', button['url'], MAX_BUTTON_URL_LENGTH)
+            if not _is_url(button['url']):
+                raise PresenceConfigError("Button URLs must be http(s) URLs")
+
+    return json.dumps({'args': args, 'live': live}, separators=(',', ':'))
+
+_parse_payload = lru_cache(maxsize=PRESENCE_PAYLOAD_CACHE_SIZE)(json.loads)
+
+def presence_update_args(payload):
+    """Get Presence.update() keyword arguments from a compiled payload"""
+    compiled = _parse_payload(payload)
+    args = dict(compiled['args'])
+    if compiled['live']:
+        args['start'] = int(time.time())
+    return args
+
+def build_update_args(rpc_config):
+    """Build Presence.update() keyword arguments from an RPC config, using its stored payload if it has one"""
+    payload = rpc_config.get('presence_payload') or compile_presence(rpc_config, validate=False)
+    return presence_update_args(payload)
+
+def benchmark(rounds=100000):
+    """Time building update arguments from config fields against loading a stored payload"""
+    import timeit
+    rpc_config = {
+        'app_id': '1419030874640613446', 'rpc_type': 'Playing',
+        'details': 'DrakLeafX Community', 'state': 'Join us!', 'timestamp_type': 'live',
+        'large_image_url': 'https://example.com/large.png', 'large_image_text': 'Large',
+        'small_image_url': 'https://example.com/small.png', 'small_image_text': 'Small',
+        'buttons': json.dumps([{'label': 'DrakLeafX', 'url': 'https://discord.gg/9HC8RANtJ9'}])
+    }
+    stored = dict(rpc_config, presence_payload=compile_presence(rpc_config))
+    results = {}
+    for name, config in (('from fields', rpc_config), ('precompiled', stored)):
+        seconds = min(timeit.repeat(lambda: build_update_args(config), number=rounds, repeat=5))
+        results[name] = seconds / rounds * 1e6
+    return results
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        results = benchmark()
+        for name, micros in results.items():
+            print(f"{name}: {micros:.2f} µs per activation")
+        print(f"speedup: {results['from fields'] / results['precompiled']:.1f}x")
+    else:
+        print(__doc__)
@@ -0,0 +1,193 @@
+"""
+Reusable presence connections
+
+Opening a presence session costs a full IPC handshake with Discord. When a
+session ends cleanly (deactivation, or a switch to another application) the
+engines clear its activity and park the connection in a ConnectionPool under
+its application ID instead of closing it; the next session for the same
+application takes it over and only sends an update. Parked connections are
+closed after RPC_CONNECTION_IDLE_TIMEOUT seconds, and at most
+RPC_CONNECTION_MAX_IDLE are kept per application. A connection belongs to
+one session at a time, since users sharing one would overwrite each other's
+activity; the pool counts checkouts per application instead.
+
+Usage:
+    python presence_pool.py bench  Compare activation latency with and without reuse against a local IPC endpoint
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+RPC_CONNECTION_MAX_IDLE = int(os.getenv('RPC_CONNECTION_MAX_IDLE', '8'))
+RPC_CONNECTION_IDLE_TIMEOUT = float(os.getenv('RPC_CONNECTION_IDLE_TIMEOUT', '300'))
+
+class ConnectionPool:
+    """Thread-safe parked connections per app_id, with per-app checkout counts
+
+    Every acquire() must be paired with one release(), passing the
+    connection to park it or None when it was closed instead.
+    """
+
+    def __init__(self, close, max_idle=RPC_CONNECTION_MAX_IDLE, idle_timeout=RPC_CONNECTION_IDLE_TIMEOUT):
+        self._close = close  # close(connection) shuts a connection for good
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = {}  # app_id -> [(parked_at, connection)], newest last
+        self._in_use = {}  # app_id -> checked-out connections
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.parked = 0
+        self.evicted = 0
+
+    def _expired_locked(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = []
+        for app_id in list(self._idle):
+            idle = self._idle[app_id]
+            while idle and idle[0][0] < cutoff:
+                expired.append(idle.pop(0)[1])
+            if not idle:
+                del self._idle[app_id]
+        return expired
+
+    def _close_all(self, connections):
+        for connection in connections:
+            self.evicted += 1
+            try:
+                self._close(connection)
+            except Exception:
+                pass
+
+    def acquire(self, app_id):
+        """Check out a parked connection for app_id, or None if the caller must open one"""
+        app_id = str(app_id)
+        with self._lock:
+            expired = self._expired_locked()
+            idle = self._idle.get(app_id)
+            connection = idle.pop()[1] if idle else None
+            if idle is not None and not idle:
+                del self._idle[app_id]
+            self._in_use[app_id] = self._in_use.get(app_id, 0) + 1
+            if connection is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._close_all(expired)
+        return connection
+
+    def release(self, app_id, connection=None):
+        """End a checkout, parking connection for reuse if one is given"""
+        app_id = str(app_id)
+        with self._lock:
+            in_use = self._in_use.get(app_id, 0) - 1
+            if in_use > 0:
+                self._in_use[app_id] = in_use
+            else:
+                self._in_use.pop(app_id, None)
+            expired = self._expired_locked()
+            if connection is not None:
+                if self.max_idle > 0:
+                    idle = self._idle.setdefault(app_id, [])
+                    idle.append((time.monotonic(), connection))
+                    self.parked += 1
+                    if len(idle) > self.max_idle:
+                        expired.append(idle.pop(0)[1])
+                else:
+                    expired.append(connection)
+        self._close_all(expired)
+
+    def evict_idle(self):
+        """Close connections parked for longer than idle_timeout"""
+        with self._lock:
+            expired = self._expired_locked()
+        self._close_all(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'in_use': sum(self._in_use.values()),
+                'apps': len(self._in_use.keys() | self._idle.keys()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'parked': self.parked,
+                'evicted': self.evicted
+            }
+
+class _LocalDiscord:
+    """Minimal Discord IPC endpoint answering handshakes, activity commands and pings"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'discord-ipc-0')
+        self.loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(asyncio.start_unix_server(self._serve, self.path))
+        self._ready.set()
+        self.loop.run_forever()
+
+    async def _serve(self, reader, writer):
+        def reply(op, payload):
+            data = json.dumps(payload).encode()
+            writer.write(struct.pack('<II', op, len(data)) + data)
+
+        while True:
+            try:
+                op, length = struct.unpack('<II', await reader.readexactly(8))
+                payload = json.loads(await reader.readexactly(length))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            if op == 0:
+                reply(1, {'cmd': 'DISPATCH', 'evt': 'READY', 'data': {'v': 1}})
+            elif op == 1:
+                reply(1, {'cmd': payload.get('cmd'), 'evt': None, 'nonce': payload.get('nonce'), 'data': {}})
+            elif op == 3:
+                reply(4, payload)
+            elif op == 2:
+                break
+        writer.close()
+
+def benchmark(rounds=300):
+    """Time threads-engine activations that open a new connection against ones that reuse a parked one"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ['XDG_RUNTIME_DIR'] = tmp_dir
+        _LocalDiscord(tmp_dir)
+        from rpc_persistent import PersistentRPCManager
+        rpc_config = {'id': 1, 'app_id': '1419030874640613446', 'details': 'Benchmark', 'timestamp_type': 'live'}
+
+        results = {}
+        for name, max_idle in (('new connection', 0), ('reused connection', RPC_CONNECTION_MAX_IDLE)):
+            manager = PersistentRPCManager()
+            manager.connections.max_idle = max_idle
+            elapsed = 0.0
+            # Keep the per-activation log lines out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(rounds):
+                    started = time.perf_counter()
+                    manager.activate_rpc(1, rpc_config, persist=False)
+                    elapsed += time.perf_counter() - started
+                    manager.deactivate_rpc(1, persist=False)
+            results[name] = elapsed / rounds * 1000
+        return results
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        results = benchmark()
+        for name, millis in results.items():
+            print(f"{name}: {millis:.3f} ms per activation")
+        print(f"speedup: {results['new connection'] / results['reused connection']:.1f}x")
+    else:
+        print(__doc__)
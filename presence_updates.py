@@ -0,0 +1,127 @@
+"""
+Presence update coalescing
+
+Discord accepts about one activity update per PRESENCE_UPDATE_INTERVAL
+seconds per client and silently drops the rest. UpdateCoalescer tracks, per
+session, when the last update was sent and what it showed. An update that
+arrives too soon becomes the session's pending update, replacing any update
+already pending, and the engine sends it once the slot opens. Updates that
+would show exactly what was last sent are dropped.
+"""
+
+import os
+import threading
+import time
+
+PRESENCE_UPDATE_INTERVAL = float(os.getenv('PRESENCE_UPDATE_INTERVAL', '15'))
+
+# UpdateCoalescer.submit() results
+SEND = 'send'  # Send now; already recorded as sent
+QUEUED = 'queued'  # Now pending; caller arranges delivery after delay()
+MERGED = 'merged'  # Replaced the pending update, whose delivery is already arranged
+DROPPED = 'dropped'  # Shows what was last sent
+
+class UpdateCoalescer:
+    """Thread-safe per-key rate limiter that keeps only the newest pending update"""
+
+    def __init__(self, min_interval=PRESENCE_UPDATE_INTERVAL):
+        self.min_interval = min_interval
+        self._state = {}  # key -> [sent_at, signature, pending (args, signature) or None]
+        self._pending = set()  # keys whose pending entry is set
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self.sent = 0
+        self.queued = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def reset(self, key, signature):
+        """Record an update sent outside the coalescer, e.g. on a new connection"""
+        with self._lock:
+            self._state[key] = [time.monotonic(), signature, None]
+            self._pending.discard(key)
+
+    def forget(self, key):
+        with self._lock:
+            self._state.pop(key, None)
+            self._pending.discard(key)
+
+    def submit(self, key, args, signature):
+        """Offer an update; returns SEND, QUEUED, MERGED or DROPPED"""
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                self._state[key] = [now, signature, None]
+                self.sent += 1
+                return SEND
+
+            sent_at, sent_signature, pending = state
+            if signature == sent_signature:
+                # Also cancels a pending change that has since been undone
+                state[2] = None
+                self._pending.discard(key)
+                self.dropped += 1
+                return DROPPED
+            if pending is not None:
+                state[2] = (args, signature)
+                self.merged += 1
+                return MERGED
+            if now - sent_at >= self.min_interval:
+                state[0] = now
+                state[1] = signature
+                self.sent += 1
+                return SEND
+            state[2] = (args, signature)
+            self._pending.add(key)
+            self.queued += 1
+            self._changed.notify_all()
+            return QUEUED
+
+    def delay(self, key):
+        """Seconds until key may send its next update"""
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                return 0.0
+            return max(0.0, state[0] + self.min_interval - time.monotonic())
+
+    def take_pending(self, key):
+        """Take key's pending update arguments and record them as sent, or return None"""
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or state[2] is None:
+                return None
+            args, signature = state[2]
+            state[0] = time.monotonic()
+            state[1] = signature
+            state[2] = None
+            self._pending.discard(key)
+            self.sent += 1
+            return args
+
+    def ready_keys(self):
+        """Keys with a pending update whose slot has opened"""
+        now = time.monotonic()
+        with self._lock:
+            return [key for key in self._pending if now - self._state[key][0] >= self.min_interval]
+
+    def wait(self, timeout):
+        """Block until a pending update may be ready, for at most timeout seconds"""
+        with self._lock:
+            now = time.monotonic()
+            for key in self._pending:
+                timeout = min(timeout, max(0.0, self._state[key][0] + self.min_interval - now))
+            self._changed.wait(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._state),
+                'pending': len(self._pending),
+                'min_interval': self.min_interval,
+                'sent': self.sent,
+                'queued': self.queued,
+                'merged': self.merged,
+                'dropped': self.dropped
+            }
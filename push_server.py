@@ -0,0 +1,202 @@
+"""
+Push channel for RPC configuration changes
+
+Runs an aiohttp server next to the Flask app so thousands of idle clients
+can wait for changes on one event loop instead of one worker thread each.
+
+    GET /api/user/<user_id>/events                  Server-Sent Events stream
+    GET /api/user/<user_id>/rpcs/wait?version=<v>   Long-poll fallback
+
+Both authenticate with the same API key as /api/user/<user_id>/rpcs and
+report the user's rpcs_version; clients refetch the config (with its ETag)
+when it changes. Changes made in this process are pushed immediately, and
+changes made by other processes are picked up by polling the versions of
+connected users every PUSH_POLL_INTERVAL seconds.
+"""
+
+import asyncio
+import json
+import math
+import os
+import threading
+from aiohttp import web
+from database import verify_api_key, get_rpcs_versions, add_rpcs_changed_listener
+
+PUSH_HOST = os.getenv('PUSH_HOST', '0.0.0.0')
+PUSH_PORT = int(os.getenv('PUSH_PORT', '5001'))
+PUSH_POLL_INTERVAL = float(os.getenv('PUSH_POLL_INTERVAL', '2'))
+SSE_KEEPALIVE_INTERVAL = 25
+LONG_POLL_TIMEOUT = 55
+
+class ChangeHub:
+    """Tracks connected users and wakes their streams when rpcs_version changes"""
+
+    def __init__(self):
+        self.loop = None
+        self._versions = {}  # user_id -> last known version
+        self._waiters = {}  # user_id -> set of asyncio.Event
+
+    def subscribe(self, user_id, version):
+        event = asyncio.Event()
+        self._waiters.setdefault(user_id, set()).add(event)
+        self._versions.setdefault(user_id, version)
+        return event
+
+    def unsubscribe(self, user_id, event):
+        waiters = self._waiters.get(user_id)
+        if waiters is None:
+            return
+        waiters.discard(event)
+        if not waiters:
+            del self._waiters[user_id]
+            self._versions.pop(user_id, None)
+
+    def version(self, user_id):
+        return self._versions.get(user_id)
+
+    def _publish(self, versions):
+        for user_id, version in versions.items():
+            if user_id not in self._waiters or self._versions.get(user_id) == version:
+                continue
+            self._versions[user_id] = version
+            for event in self._waiters[user_id]:
+                event.set()
+
+    async def refresh(self, user_ids):
+        """Read current versions from the database and wake streams whose version moved"""
+        if not user_ids:
+            return
+        versions = await self.loop.run_in_executor(None, get_rpcs_versions, list(user_ids))
+        self._publish(versions)
+
+    def poke(self, user_id):
+        """Thread-safe hook for database writes made in this process"""
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self._poke, user_id)
+
+    def _poke(self, user_id):
+        if user_id in self._waiters:
+            asyncio.ensure_future(self.refresh([user_id]))
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(PUSH_POLL_INTERVAL)
+            try:
+                await self.refresh(list(self._waiters))
+            except Exception as e:
+                print(f"Push version poll failed: {e}")
+
+hub = ChangeHub()
+
+async def _authenticate(request):
+    user_id = int(request.match_info['user_id'])
+    api_key = request.headers.get('X-API-Key') or request.query.get('api_key')
+    if not api_key:
+        raise web.HTTPUnauthorized(text=json.dumps({'success': False, 'error': 'API key required'}),
+                                   content_type='application/json')
+    loop = asyncio.get_running_loop()
+    authenticated_user_id = await loop.run_in_executor(None, verify_api_key, api_key)
+    if authenticated_user_id != user_id:
+        raise web.HTTPUnauthorized(text=json.dumps({'success': False, 'error': 'Invalid API key'}),
+                                   content_type='application/json')
+    return user_id
+
+async def _current_version(user_id):
+    version = hub.version(user_id)
+    if version is None:
+        loop = asyncio.get_running_loop()
+        versions = await loop.run_in_executor(None, get_rpcs_versions, [user_id])
+        version = versions.get(user_id, 0)
+    return version
+
+async def events(request):
+    """Stream an 'rpcs' event with the current version, then one per change"""
+    user_id = await _authenticate(request)
+    version = await _current_version(user_id)
+    changed = hub.subscribe(user_id, version)
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    await response.prepare(request)
+    try:
+        await response.write(b'retry: 5000\n\n')
+        while True:
+            changed.clear()
+            version = hub.version(user_id)
+            await response.write(
+                f'id: {version}\nevent: rpcs\ndata: {json.dumps({"version": version})}\n\n'.encode()
+            )
+            while not changed.is_set():
+                try:
+                    await asyncio.wait_for(changed.wait(), SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    await response.write(b': ping\n\n')
+    except ConnectionResetError:
+        pass
+    finally:
+        hub.unsubscribe(user_id, changed)
+    return response
+
+async def wait_for_change(request):
+    """Return as soon as the user's version differs from ?version=, or after a timeout"""
+    user_id = await _authenticate(request)
+    try:
+        known = int(request.query['version'])
+    except (KeyError, ValueError):
+        known = None
+    try:
+        timeout = float(request.query['timeout'])
+    except (KeyError, ValueError):
+        timeout = LONG_POLL_TIMEOUT
+    if not math.isfinite(timeout):
+        timeout = LONG_POLL_TIMEOUT
+    timeout = max(0.0, min(timeout, LONG_POLL_TIMEOUT))
+
+    version = await _current_version(user_id)
+    changed = hub.subscribe(user_id, version)
+    try:
+        if known is not None and hub.version(user_id) == known:
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        version = hub.version(user_id)
+    finally:
+        hub.unsubscribe(user_id, changed)
+    return web.json_response({'success': True, 'version': version, 'changed': version != known})
+
+async def _on_startup(app):
+    hub.loop = asyncio.get_running_loop()
+    app['watcher'] = asyncio.ensure_future(hub.watch())
+
+async def _on_cleanup(app):
+    app['watcher'].cancel()
+
+def create_push_app():
+    app = web.Application()
+    app.router.add_get('/api/user/{user_id:\\d+}/events', events)
+    app.router.add_get('/api/user/{user_id:\\d+}/rpcs/wait', wait_for_change)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    add_rpcs_changed_listener(hub.poke)
+    return app
+
+def run_push_server(host=PUSH_HOST, port=PUSH_PORT):
+    """Run the push server on the current thread's own event loop"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    web.run_app(create_push_app(), host=host, port=port, print=None, handle_signals=False, loop=loop)
+
+def start_push_server(host=PUSH_HOST, port=PUSH_PORT):
+    """Start the push server in a daemon thread"""
+    thread = threading.Thread(target=run_push_server, args=(host, port), daemon=True)
+    thread.start()
+    print(f"Push server running on: http://localhost:{port}")
+    return thread
+
+if __name__ == '__main__':
+    web.run_app(create_push_app(), host=PUSH_HOST, port=PUSH_PORT)
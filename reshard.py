@@ -0,0 +1,171 @@
+"""
+Offline resharding of the SQLite store
+
+Moves every user, with their RPCs, from one shard count to another. Stop
+every app process first; the old files are kept next to the new ones with a
+.pre-reshard suffix. RPC ids are only unique within a shard, so an RPC whose
+id is already taken in its new shard gets a new id (and the user's
+active_rpc_id follows it). Change feed history is dropped, and every shard
+is marked compacted past the highest old position so clients resync with a
+full snapshot. Queued RPC jobs and leases are not carried over.
+
+Usage:
+    python reshard.py OLD NEW       Re-split DATABASE_URL's data from OLD to NEW files, then set DB_SHARDS=NEW
+    python reshard.py bench [N ...] Compare write throughput for several shard counts (default 1 2 4 8)
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from db_backends import SQLiteBackend, create_backend, dict_factory, shard_index, shard_path, WriteQueue
+
+def layout_paths(path, shards):
+    """Files holding a database with the given shard count"""
+    if shards == 1:
+        return [path]
+    return [shard_path(path, index) for index in range(shards)]
+
+def _connect(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = dict_factory
+    return conn
+
+def _insert(cur, table, row):
+    columns = list(row)
+    cur.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})",
+        [row[column] for column in columns]
+    )
+
+def reshard(path, old_shards, new_shards):
+    """Rewrite the database at path from old_shards files into new_shards files"""
+    import database
+
+    old_paths = layout_paths(path, old_shards)
+    missing = [old_path for old_path in old_paths if not os.path.exists(old_path)]
+    if missing:
+        raise FileNotFoundError(f"Missing shard files: {', '.join(missing)}")
+
+    new_paths = layout_paths(path, new_shards)
+    tmp_paths = [f'{new_path}.resharding' for new_path in new_paths]
+    for tmp_path in tmp_paths:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    # Bring the old files up to date and fold their WAL back in before reading them
+    for index, old_path in enumerate(old_paths):
+        backend = SQLiteBackend(old_path)
+        database.init_shard(backend, index, old_shards)
+        backend.close()
+    sources = [_connect(old_path) for old_path in old_paths]
+    for source in sources:
+        source.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    # Every old feed position is treated as compacted in every new shard
+    feed_seq = 0
+    for source in sources:
+        row = source.execute('SELECT MAX(seq) AS seq FROM rpc_changes').fetchone()
+        meta = source.execute('SELECT compacted_through FROM rpc_changes_meta WHERE id = 1').fetchone()
+        feed_seq = max(feed_seq, row['seq'] or 0, meta['compacted_through'])
+
+    for index, tmp_path in enumerate(tmp_paths):
+        backend = SQLiteBackend(tmp_path)
+        database.init_shard(backend, index, new_shards)
+        backend.close()
+    targets = [_connect(tmp_path) for tmp_path in tmp_paths]
+    for target in targets:
+        target.execute('UPDATE rpc_changes_meta SET compacted_through = ? WHERE id = 1', (feed_seq,))
+        target.execute("DELETE FROM sqlite_sequence WHERE name = 'rpc_changes'")
+        target.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('rpc_changes', ?)", (feed_seq,))
+
+    users = rpcs = renumbered = sessions = 0
+    for source in sources:
+        for user in source.execute('SELECT * FROM users'):
+            _insert(targets[shard_index(user['id'], new_shards)].cursor(), 'users', user)
+            users += 1
+        for rpc in source.execute('SELECT * FROM custom_rpcs'):
+            cur = targets[shard_index(rpc['user_id'], new_shards)].cursor()
+            taken = cur.execute('SELECT 1 FROM custom_rpcs WHERE id = ?', (rpc['id'],)).fetchone()
+            if taken:
+                old_id = rpc['id']
+                rpc = dict(rpc, id=None)
+                _insert(cur, 'custom_rpcs', rpc)
+                cur.execute('UPDATE users SET active_rpc_id = ? WHERE id = ? AND active_rpc_id = ?',
+                            (cur.lastrowid, rpc['user_id'], old_id))
+                renumbered += 1
+            else:
+                _insert(cur, 'custom_rpcs', rpc)
+            rpcs += 1
+        # Web sessions are placed by their key the same way users are by ID
+        for web_session in source.execute('SELECT * FROM web_sessions'):
+            _insert(targets[shard_index(web_session['id'], new_shards)].cursor(), 'web_sessions', web_session)
+            sessions += 1
+
+    for connection in targets + sources:
+        connection.commit()
+        connection.close()
+
+    for old_path in old_paths:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(old_path + suffix):
+                os.replace(old_path + suffix, f'{old_path}.pre-reshard{suffix}')
+    for tmp_path, new_path in zip(tmp_paths, new_paths):
+        os.replace(tmp_path, new_path)
+
+    print(f"Moved {users} users, {rpcs} RPCs and {sessions} web sessions from {old_shards} to {new_shards} shard(s) "
+          f"({renumbered} RPC ids renumbered)")
+
+def benchmark(shard_counts=(1, 2, 4, 8), threads=32, writes_per_thread=500):
+    """Measure group-committed RPC creations per second for each shard count"""
+    import database
+
+    results = {}
+    for shards in shard_counts:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            backend = create_backend(f'sqlite:///{os.path.join(tmp_dir, "bench.sqlite")}', shards=shards)
+            database.init_database(backend)
+            writers = {id(shard): WriteQueue(shard) for shard in backend.shards}
+
+            def write_for(user_id):
+                def write(cur):
+                    cur.execute(database.UPSERT_USER_SQL, (user_id, 'bench', '0', '', '', '', '', None))
+                    cur.execute(database.INSERT_CUSTOM_RPC_SQL, (user_id, '1', 'Playing', 'bench', None, 'live',
+                                                                  None, None, None, None, None, None, None))
+                    cur.fetchone()
+                    cur.execute(database.BUMP_RPCS_VERSION_SQL, (user_id,))
+                return write
+
+            def worker(offset):
+                for n in range(writes_per_thread):
+                    user_id = offset * writes_per_thread + n
+                    writers[id(backend.shard_for(user_id))].submit(write_for(user_id)).result()
+
+            workers = [threading.Thread(target=worker, args=(offset,)) for offset in range(threads)]
+            started = time.monotonic()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            results[shards] = threads * writes_per_thread / (time.monotonic() - started)
+            backend.close()
+    return results
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        shard_counts = [int(arg) for arg in sys.argv[2:]] or [1, 2, 4, 8]
+        for shards, rate in benchmark(shard_counts).items():
+            print(f"{shards} shard(s): {rate:.0f} writes/s")
+    elif len(sys.argv) == 3:
+        from database import DATABASE_URL
+        if not DATABASE_URL.startswith('sqlite:///'):
+            sys.exit("Resharding only applies to SQLite databases")
+        reshard(DATABASE_URL[len('sqlite:///'):], int(sys.argv[1]), int(sys.argv[2]))
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+"""
+Asyncio presence engine
+
+Runs every presence session on one event loop in a background thread using
+pypresence's AioPresence, so connects, updates and health checks for many
+users overlap instead of queuing behind one another's blocking IPC calls.
+Each operation has its own timeout. AsyncRPCManager is the thread-safe
+facade used by the Flask routes; select it with RPC_ENGINE=async.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import threading
+from contextlib import asynccontextmanager
+from pypresence import AioPresence
+from database import get_active_rpc_id, set_active_rpc_id, get_rpc_config
+from rpc_persistent import build_update_args, presence_signature
+from health_scheduler import HealthScheduler, ping_presence
+from presence_updates import UpdateCoalescer, SEND, QUEUED
+from presence_pool import ConnectionPool
+from session_registry import SessionRegistry
+from warm_restart import RestoreProgress, load_restore_configs, save_snapshot, ramp_delay, RPC_RESTORE_CONCURRENCY
+
+RPC_CONNECT_TIMEOUT = float(os.getenv('RPC_CONNECT_TIMEOUT', '10'))
+RPC_OP_TIMEOUT = float(os.getenv('RPC_OP_TIMEOUT', '5'))
+RPC_SUBMIT_TIMEOUT = float(os.getenv('RPC_SUBMIT_TIMEOUT', '60'))
+RPC_HEALTH_CONCURRENCY = int(os.getenv('RPC_HEALTH_CONCURRENCY', '100'))
+RPC_HEALTH_TICK = 1.0
+
+class AsyncRPCEngine:
+    """Owns the event loop and the AioPresence sessions; methods ending in _async run on the loop"""
+
+    def __init__(self):
+        self.loop = None
+        # user_id -> SessionRecord with the config the session should show and its AioPresence
+        self.sessions = SessionRegistry()
+        self._user_locks = {}  # user_id -> [asyncio.Lock, holders]
+        self.health = HealthScheduler()
+        self.updates = UpdateCoalescer()
+        self.restore = RestoreProgress()
+        # Connections of ended sessions, kept open for the next session of the same application
+        self.connections = ConnectionPool(close=self._drop_connection)
+        self._thread = None
+        self._started = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the event loop thread once"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._started.set()
+        self.loop.run_forever()
+
+    def submit(self, coro, timeout=RPC_SUBMIT_TIMEOUT):
+        """Run a coroutine on the engine loop from any other thread and return its result"""
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"RPC operation did not finish within {timeout}s")
+
+    async def _db(self, func, *args):
+        """Run a blocking database call off the loop"""
+        return await self.loop.run_in_executor(None, func, *args)
+
+    @asynccontextmanager
+    async def _user_lock(self, user_id):
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_id]
+
+    def _user_busy(self, user_id):
+        entry = self._user_locks.get(user_id)
+        return entry is not None and entry[0].locked()
+
+    def _drop_connection(self, rpc):
+        """Close a connection without closing the shared loop (AioPresence.close would)"""
+        if rpc.sock_writer is None:
+            return
+        try:
+            rpc.send_data(2, {'v': 1, 'client_id': rpc.client_id})
+            rpc.sock_writer.close()
+        except Exception:
+            pass
+
+    def _close_session(self, user_id):
+        """Drop a user's session and close its connection"""
+        self.updates.forget(user_id)
+        rpc = self.sessions.detach(user_id)
+        if rpc is not None:
+            self._drop_connection(rpc)
+            self.connections.release(rpc.client_id)
+
+    async def _park_session(self, user_id):
+        """Drop a user's session, clearing its presence and keeping the connection for reuse if it still answers"""
+        self.updates.forget(user_id)
+        rpc = self.sessions.detach(user_id)
+        if rpc is None:
+            return
+        parked = None
+        try:
+            await asyncio.wait_for(rpc.clear(), RPC_OP_TIMEOUT)
+            parked = rpc
+        except Exception:
+            pass
+        finally:
+            if parked is None:
+                self._drop_connection(rpc)
+            self.connections.release(rpc.client_id, parked)
+
+    async def _open_connection(self, app_id, update_args):
+        """Show update_args on a parked connection for app_id, or on a new one if none is parked or it fails"""
+        rpc = self.connections.acquire(app_id)
+        try:
+            if rpc is not None:
+                try:
+                    await asyncio.wait_for(rpc.update(**update_args), RPC_OP_TIMEOUT)
+                    return rpc
+                except Exception:
+                    # Discord dropped it while it was parked
+                    self._drop_connection(rpc)
+            rpc = AioPresence(app_id, loop=self.loop,
+                              connection_timeout=RPC_CONNECT_TIMEOUT, response_timeout=RPC_OP_TIMEOUT)
+            await asyncio.wait_for(rpc.connect(), RPC_CONNECT_TIMEOUT)
+            await asyncio.wait_for(rpc.update(**update_args), RPC_OP_TIMEOUT)
+            return rpc
+        except BaseException:
+            # Also on cancellation, so a timed-out submit leaks no socket
+            if rpc is not None:
+                self._drop_connection(rpc)
+            self.connections.release(app_id)
+            raise
+
+    async def _connect_locked(self, user_id, rpc_config):
+        """Open a session for rpc_config and schedule its health checks"""
+        app_id = rpc_config.get('app_id')
+        if not app_id:
+            raise Exception("No application ID provided")
+
+        self._close_session(user_id)
+        update_args = build_update_args(rpc_config)
+        rpc = await self._open_connection(app_id, update_args)
+        signature = presence_signature(rpc_config, update_args)
+        self.sessions.attach(user_id, rpc_config, rpc, signature)
+        self.updates.reset(user_id, signature)
+        self.health.add(user_id)
+
+    async def _update_locked(self, user_id, rpc, rpc_config):
+        """Send rpc_config to an open session now, or queue it for the session's next update slot"""
+        update_args = build_update_args(rpc_config)
+        signature = presence_signature(rpc_config, update_args)
+        result = self.updates.submit(user_id, update_args, signature)
+        if result == SEND:
+            await asyncio.wait_for(rpc.update(**update_args), RPC_OP_TIMEOUT)
+        elif result == QUEUED:
+            self.loop.call_later(self.updates.delay(user_id),
+                                 lambda: asyncio.ensure_future(self._flush_update(user_id)))
+        self.sessions.set_config(user_id, rpc_config, signature)
+
+    async def _flush_update(self, user_id):
+        async with self._user_lock(user_id):
+            rpc = self.sessions.connection(user_id)
+            update_args = self.updates.take_pending(user_id)
+            if rpc is None or update_args is None:
+                return
+            try:
+                await asyncio.wait_for(rpc.update(**update_args), RPC_OP_TIMEOUT)
+            except Exception as e:
+                # Leave the reconnect to the session's next health check
+                print(f"Failed to update RPC for user {user_id}: {e}")
+                self._close_session(user_id)
+
+    async def _activate_locked(self, user_id, rpc_config, persist=True):
+        try:
+            rpc = self.sessions.connection(user_id)
+            reused = False
+            if rpc is not None and str(rpc.client_id) == str(rpc_config.get('app_id')):
+                # Same application: update the open session instead of reconnecting
+                try:
+                    await self._update_locked(user_id, rpc, rpc_config)
+                    reused = True
+                except Exception as e:
+                    print(f"RPC session for user {user_id} failed, reconnecting: {e}")
+                    self._close_session(user_id)
+            if not reused:
+                # A session for another application is parked for whoever uses that one next
+                await self._park_session(user_id)
+                await self._connect_locked(user_id, rpc_config)
+            if persist:
+                await self._db(set_active_rpc_id, user_id, rpc_config.get('id'))
+            print(f"✓ RPC activated for user {user_id} with app {rpc_config.get('app_id')}")
+            return True
+        except Exception as e:
+            print(f"Failed to activate RPC for user {user_id}: {e}")
+            await self._deactivate_locked(user_id, persist)
+            raise
+
+    async def _deactivate_locked(self, user_id, persist=True):
+        self.health.remove(user_id)
+        await self._park_session(user_id)
+        self.sessions.remove(user_id)
+        if persist:
+            await self._db(set_active_rpc_id, user_id, None)
+        print(f"✓ RPC deactivated for user {user_id}")
+        return True
+
+    async def activate_async(self, user_id, rpc_config, persist=True):
+        async with self._user_lock(user_id):
+            activated = await self._activate_locked(user_id, rpc_config, persist)
+        await self.evict_async()
+        return activated
+
+    async def deactivate_async(self, user_id, persist=True):
+        async with self._user_lock(user_id):
+            return await self._deactivate_locked(user_id, persist)
+
+    async def _evict_one_async(self, user_id, limit):
+        async with limit:
+            # Users busy right now are left for the next pass
+            if self._user_busy(user_id):
+                return
+            async with self._user_lock(user_id):
+                self.health.remove(user_id)
+                await self._park_session(user_id)
+                self.sessions.evict(user_id)
+
+    async def evict_async(self, idle=False):
+        """Park the connections of sessions beyond RPC_MAX_LIVE_SESSIONS, and with idle of idle ones
+
+        Their records and active_rpc_id stay, so touch() reconnects them.
+        """
+        limit = asyncio.Semaphore(RPC_HEALTH_CONCURRENCY)
+        await asyncio.gather(*(self._evict_one_async(user_id, limit)
+                               for user_id in self.sessions.eviction_candidates(idle)))
+
+    async def _restore_one_async(self, index, rpc_data, limit):
+        """Reconnect one restored session at its ramp-up slot without touching the database"""
+        user_id = rpc_data['user_id']
+        await asyncio.sleep(ramp_delay(index))
+        async with limit:
+            async with self._user_lock(user_id):
+                # The user activated or deactivated something since the restart
+                if self.sessions.connection(user_id) is not None:
+                    return True
+                if rpc_data.get('evicted') or self.sessions.full():
+                    # Connect it when the user is next seen
+                    self.sessions.add_evicted(rpc_data)
+                    return True
+                try:
+                    await self._connect_locked(user_id, rpc_data)
+                    return True
+                except Exception as e:
+                    print(f"Failed to restore RPC for user {user_id}: {e}")
+                    # Keep active_rpc_id and let health checks retry with backoff
+                    self._close_session(user_id)
+                    self.sessions.set_config(user_id, rpc_data)
+                    self.health.add(user_id)
+                    self.health.failed(user_id)
+                    return False
+
+    async def restore_async(self, rpc_configs):
+        limit = asyncio.Semaphore(RPC_RESTORE_CONCURRENCY)
+
+        async def restore(index, rpc_data):
+            self.restore.record(await self._restore_one_async(index, rpc_data, limit))
+
+        await asyncio.gather(*(restore(index, rpc_data) for index, rpc_data in enumerate(rpc_configs)))
+        self.restore.finish()
+
+    async def _check_session(self, user_id, limit):
+        async with limit:
+            # Skip users being activated or deactivated right now
+            if self._user_busy(user_id):
+                self.health.postpone(user_id)
+                return
+            async with self._user_lock(user_id):
+                rpc = self.sessions.connection(user_id)
+                if rpc is not None:
+                    try:
+                        await ping_presence(rpc, RPC_OP_TIMEOUT)
+                        self.health.succeeded(user_id)
+                        self.sessions.succeeded(user_id)
+                        return
+                    except Exception:
+                        self._close_session(user_id)
+
+                # Broken or missing after a failed reconnect: restore from database,
+                # leaving active_rpc_id set so later checks and restarts retry it
+                try:
+                    active_rpc_id = await self._db(get_active_rpc_id, user_id)
+                    rpc_data = await self._db(get_rpc_config, active_rpc_id, user_id) if active_rpc_id else None
+                    if not rpc_data:
+                        self.health.remove(user_id)
+                        self.sessions.remove(user_id)
+                        return
+                    await self._connect_locked(user_id, rpc_data)
+                    print(f"✓ RPC reconnected for user {user_id}")
+                except Exception as e:
+                    print(f"Failed to reconnect RPC for user {user_id}: {e}")
+                    self._close_session(user_id)
+                    self.health.failed(user_id)
+
+    async def health_check_async(self):
+        """Probe the sessions that are due, at most RPC_HEALTH_CONCURRENCY at a time"""
+        limit = asyncio.Semaphore(RPC_HEALTH_CONCURRENCY)
+        await asyncio.gather(*(self._check_session(user_id, limit) for user_id in self.health.pop_due()))
+
+    async def check_and_reconnect_async(self):
+        while True:
+            # Wake at least once a tick so sessions added meanwhile are not missed
+            await asyncio.sleep(min(self.health.next_delay(RPC_HEALTH_TICK), RPC_HEALTH_TICK))
+            try:
+                await self.health_check_async()
+            except Exception as e:
+                print(f"RPC health check failed: {e}")
+            await self.evict_async(idle=True)
+            self.connections.evict_idle()
+
+class AsyncRPCManager:
+    """Blocking API over AsyncRPCEngine, matching PersistentRPCManager"""
+
+    def __init__(self, engine=None):
+        self.engine = engine or AsyncRPCEngine()
+
+    def activate_rpc(self, user_id, rpc_config, persist=True):
+        return self.engine.submit(self.engine.activate_async(user_id, rpc_config, persist))
+
+    def deactivate_rpc(self, user_id, persist=True):
+        return self.engine.submit(self.engine.deactivate_async(user_id, persist))
+
+    def restore_active_rpcs(self, active_rpcs=None, source=None):
+        """Restore active RPCs after restart, ramping up with bounded concurrency
+
+        Restores the given configs, or by default those from load_restore_configs().
+        """
+        if active_rpcs is None:
+            active_rpcs, source = load_restore_configs()
+        self.engine.restore.begin(len(active_rpcs), source)
+        self.engine.submit(self.engine.restore_async(active_rpcs), timeout=None)
+
+    def session_configs(self):
+        """Configs of every health-checked session, plus the ids of evicted ones"""
+        return self.engine.sessions.configs()
+
+    def save_snapshot(self):
+        """Write the configs of every health-checked session for the next start"""
+        save_snapshot(self.session_configs())
+
+    def start_health_checks(self):
+        self.engine.start()
+        asyncio.run_coroutine_threadsafe(self.engine.check_and_reconnect_async(), self.engine.loop)
+
+    def health_stats(self):
+        return self.engine.health.stats()
+
+    def update_stats(self):
+        return self.engine.updates.stats()
+
+    def connection_stats(self):
+        return self.engine.connections.stats()
+
+    def session_stats(self):
+        return self.engine.sessions.stats()
+
+    def touch(self, user_id):
+        """Note that a user is around, reconnecting their session right away if it was evicted"""
+        if self.engine.sessions.touch(user_id):
+            self.engine.health.add(user_id, delay=0)
+
+    def restore_stats(self):
+        return self.engine.restore.stats()
+
+    def active_user_ids(self):
+        return self.engine.sessions.connected_user_ids()
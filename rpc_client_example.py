@@ -14,19 +14,31 @@ Usage:
 
 import os
 import sys
+import json
 import time
 import requests
 from pypresence import Presence
 
 WEBSITE_URL = os.getenv('WEBSITE_URL', 'http://localhost:5000')
+PUSH_URL = os.getenv('PUSH_URL', 'http://localhost:5001')
+POLL_INTERVAL = int(os.getenv('RPC_POLL_INTERVAL', '15'))
+
+# ETag and body of the last successful fetch, reused when the server answers 304
+_last_fetch = {'etag': None, 'data': None}
 
 def fetch_user_rpcs(user_id, api_key):
     """Fetch user's RPC configurations from the website"""
     try:
         headers = {'X-API-Key': api_key}
+        if _last_fetch['etag']:
+            headers['If-None-Match'] = _last_fetch['etag']
         response = requests.get(f'{WEBSITE_URL}/api/user/{user_id}/rpcs', headers=headers)
+        if response.status_code == 304:
+            return _last_fetch['data']
         if response.status_code == 200:
-            return response.json()
+            _last_fetch['etag'] = response.headers.get('ETag')
+            _last_fetch['data'] = response.json()
+            return _last_fetch['data']
         else:
             print(f"Failed to fetch RPCs: {response.status_code}")
             if response.status_code == 401:
@@ -36,6 +48,57 @@ def fetch_user_rpcs(user_id, api_key):
         print(f"Error fetching RPCs: {e}")
         return None
 
+def watch_rpc_changes(user_id, api_key):
+    """Yield whenever the user's RPC configuration may have changed
+
+    Listens on the server's event stream, falls back to long-polling when
+    the stream is unavailable, and to plain polling if the push server is
+    down altogether.
+    """
+    headers = {'X-API-Key': api_key}
+    use_events = True
+    version = None
+    while True:
+        if use_events:
+            try:
+                with requests.get(f'{PUSH_URL}/api/user/{user_id}/events', headers=headers,
+                                  stream=True, timeout=(10, 60)) as response:
+                    if response.status_code == 200:
+                        for line in response.iter_lines(decode_unicode=True):
+                            if line and line.startswith('data:'):
+                                version = json.loads(line[5:])['version']
+                                yield version
+                        continue
+                    use_events = False
+            except requests.RequestException as e:
+                print(f"Event stream unavailable, falling back to long-polling: {e}")
+                use_events = False
+
+        try:
+            params = {'version': version} if version is not None else {}
+            response = requests.get(f'{PUSH_URL}/api/user/{user_id}/rpcs/wait', headers=headers,
+                                    params=params, timeout=70)
+            if response.status_code == 200:
+                data = response.json()
+                if data['changed']:
+                    version = data['version']
+                    yield version
+                continue
+        except requests.RequestException as e:
+            print(f"Push server unavailable, polling instead: {e}")
+
+        time.sleep(POLL_INTERVAL)
+        use_events = True
+        yield None
+
+def build_update_args(rpc_config):
+    """Get Presence.update() arguments from the payload the server compiled for this RPC"""
+    payload = json.loads(rpc_config['presence_payload'])
+    update_args = payload['args']
+    if payload['live']:
+        update_args['start'] = int(time.time())
+    return update_args
+
 def start_rpc(rpc_config):
     """Start Discord RPC with given configuration"""
     try:
@@ -47,36 +110,7 @@ def start_rpc(rpc_config):
         RPC = Presence(app_id)
         RPC.connect()
         
-        update_args = {}
-        
-        if rpc_config.get('details'):
-            update_args['details'] = rpc_config['details']
-        
-        if rpc_config.get('state'):
-            update_args['state'] = rpc_config['state']
-        
-        if rpc_config.get('timestamp_type') == 'live':
-            update_args['start'] = int(time.time())
-        elif rpc_config.get('custom_timestamp'):
-            update_args['start'] = int(rpc_config['custom_timestamp'])
-        
-        if rpc_config.get('large_image_url'):
-            update_args['large_image'] = rpc_config['large_image_url']
-        if rpc_config.get('large_image_text'):
-            update_args['large_text'] = rpc_config['large_image_text']
-        
-        if rpc_config.get('small_image_url'):
-            update_args['small_image'] = rpc_config['small_image_url']
-        if rpc_config.get('small_image_text'):
-            update_args['small_text'] = rpc_config['small_image_text']
-        
-        if rpc_config.get('buttons'):
-            import json
-            buttons = json.loads(rpc_config['buttons']) if isinstance(rpc_config['buttons'], str) else rpc_config['buttons']
-            if buttons:
-                update_args['buttons'] = buttons
-        
-        RPC.update(**update_args)
+        RPC.update(**build_update_args(rpc_config))
         print(f"✓ RPC started for app {app_id}")
         return RPC
         
@@ -84,6 +118,22 @@ def start_rpc(rpc_config):
         print(f"Error starting RPC: {e}")
         return None
 
+def start_from_config(rpcs_data):
+    """Start the first custom RPC, or the default RPC when there are none"""
+    rpcs = rpcs_data['rpcs']
+    default_rpc = rpcs_data.get('default_rpc')
+    
+    print(f"\nFound {len(rpcs)} custom RPC(s)")
+    
+    if rpcs:
+        print("\nStarting first custom RPC...")
+        return start_rpc(rpcs[0])
+    elif default_rpc:
+        print("\nNo custom RPCs, starting default RPC...")
+        return start_rpc(default_rpc)
+    print("No RPCs to start")
+    return None
+
 def main():
     if len(sys.argv) < 3:
         print("Usage: python rpc_client_example.py YOUR_USER_ID YOUR_API_KEY")
@@ -101,31 +151,27 @@ def main():
         print("No RPC configurations found")
         return
     
-    rpcs = rpcs_data['rpcs']
-    default_rpc = rpcs_data.get('default_rpc')
-    
-    print(f"\nFound {len(rpcs)} custom RPC(s)")
-    
-    if rpcs:
-        print("\nStarting first custom RPC...")
-        rpc_instance = start_rpc(rpcs[0])
-    elif default_rpc:
-        print("\nNo custom RPCs, starting default RPC...")
-        rpc_instance = start_rpc(default_rpc)
-    else:
-        print("No RPCs to start")
+    rpc_instance = start_from_config(rpcs_data)
+    if not rpc_instance:
         return
     
-    if rpc_instance:
-        print("\n✓ RPC is now active on your Discord!")
-        print("Press Ctrl+C to stop...")
-        try:
-            while True:
-                time.sleep(15)
-        except KeyboardInterrupt:
-            print("\nStopping RPC...")
-            rpc_instance.close()
-            print("RPC stopped.")
+    print("\n✓ RPC is now active on your Discord!")
+    print("Press Ctrl+C to stop...")
+    try:
+        for _ in watch_rpc_changes(user_id, api_key):
+            # Unchanged configs come back as 304 and the same cached dict
+            latest = fetch_user_rpcs(user_id, api_key)
+            if latest and latest is not rpcs_data:
+                print("\nRPC configuration changed, restarting RPC...")
+                rpcs_data = latest
+                rpc_instance.close()
+                rpc_instance = start_from_config(rpcs_data)
+                if not rpc_instance:
+                    return
+    except KeyboardInterrupt:
+        print("\nStopping RPC...")
+        rpc_instance.close()
+        print("RPC stopped.")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,132 @@
+"""
+Control channel of the RPC service process
+
+When main.py serves HTTP from several worker processes, presence sessions,
+queued RPC jobs and the other background work run in a single RPC service
+process instead, and the HTTP workers run with PROCESS_ROLE=web. Those keep
+queueing activations in the database as before; the manager calls that
+cannot go through the database (telling the service a user was seen, and the
+stats for /health) go to it over the Unix socket at RPC_CONTROL_ADDRESS,
+authenticated with the app's secret key, with the same call protocol as the
+RPC worker pipes.
+"""
+
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from rpc_workers import CallChannel, RPCWorkerError, serve_calls
+
+# 'web' forwards to the RPC service at RPC_CONTROL_ADDRESS; anything else runs the sessions in this process
+PROCESS_ROLE = os.getenv('PROCESS_ROLE', 'all')
+RPC_CONTROL_ADDRESS = os.getenv('RPC_CONTROL_ADDRESS', '')
+RPC_CONTROL_TIMEOUT = float(os.getenv('RPC_CONTROL_TIMEOUT', '5'))
+RPC_CONTROL_RETRY_INTERVAL = float(os.getenv('RPC_CONTROL_RETRY_INTERVAL', '1'))
+
+# Manager methods web workers may call in the RPC service, besides its service_stats
+CONTROL_METHODS = {
+    'touch', 'health_stats', 'update_stats', 'connection_stats', 'session_stats', 'restore_stats', 'active_user_ids'
+}
+
+def _authkey():
+    from config import load_secret_key
+    return load_secret_key().encode()
+
+def serve_control(handlers, address=RPC_CONTROL_ADDRESS):
+    """Answer web workers' calls at address with handlers, from a daemon thread; returns the listener"""
+    if os.path.exists(address):
+        # Left behind by a service that did not shut down cleanly
+        os.unlink(address)
+    listener = Listener(address, family='AF_UNIX', authkey=_authkey())
+
+    def accept():
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                # The listener was closed
+                return
+            except Exception as e:
+                print(f"Rejected an RPC control connection: {e}")
+                continue
+            threading.Thread(target=serve_calls, args=(conn, handlers), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    print(f"✓ RPC control listening on {address}")
+    return listener
+
+class RemoteRPCManager:
+    """Manager API of the RPC service process for web workers
+
+    Activations and deactivations are queued as RPC jobs, which the service
+    runs, so only visits and stats are forwarded. A visit is not waited for;
+    stats come back within RPC_CONTROL_TIMEOUT or report the error.
+    """
+
+    def __init__(self, address=RPC_CONTROL_ADDRESS):
+        self.address = address
+        self._channel = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with self._lock:
+            if self._channel is not None and self._channel.alive:
+                return self._channel
+            if not self.address:
+                raise RPCWorkerError("RPC_CONTROL_ADDRESS is not set")
+            if time.monotonic() < self._retry_at:
+                raise RPCWorkerError(f"RPC service at {self.address} is not reachable")
+            try:
+                conn = Client(self.address, family='AF_UNIX', authkey=_authkey())
+            except Exception as e:
+                self._retry_at = time.monotonic() + RPC_CONTROL_RETRY_INTERVAL
+                raise RPCWorkerError(f"Could not reach the RPC service at {self.address}: {e}")
+            self._channel = CallChannel(conn, 'RPC service')
+            return self._channel
+
+    def _call(self, method, *args):
+        return self._connect().call(method, *args).result(RPC_CONTROL_TIMEOUT)
+
+    def _stats(self, method):
+        try:
+            return self._call(method)
+        except Exception as e:
+            return {'error': str(e)}
+
+    def touch(self, user_id):
+        """Pass the user's visit on without waiting for it; dropped while the service is unreachable"""
+        try:
+            self._connect().call('touch', user_id)
+        except RPCWorkerError:
+            pass
+
+    def health_stats(self):
+        return self._stats('health_stats')
+
+    def update_stats(self):
+        return self._stats('update_stats')
+
+    def connection_stats(self):
+        return self._stats('connection_stats')
+
+    def session_stats(self):
+        return self._stats('session_stats')
+
+    def restore_stats(self):
+        try:
+            return self._call('restore_stats')
+        except Exception as e:
+            return {'ready': False, 'error': str(e)}
+
+    def service_stats(self):
+        """Every stat of the service for /health in one call; raises RPCWorkerError if it is unreachable"""
+        try:
+            return self._call('service_stats')
+        except RPCWorkerError:
+            raise
+        except Exception as e:
+            raise RPCWorkerError(f"RPC service did not answer: {e}")
+
+    def active_user_ids(self):
+        return self._call('active_user_ids')
@@ -0,0 +1,160 @@
+"""
+Background RPC activation jobs
+
+Activating an RPC opens an IPC connection to Discord, which can take seconds
+or hang, so the web routes queue activations and deactivations as jobs in
+the rpc_jobs table and answer 202 with the job ID at once. A dispatcher
+thread claims due jobs and runs them on RPC_JOB_WORKERS threads, one job per
+user at a time. A failed job is retried with exponential backoff until it
+has run RPC_JOB_MAX_ATTEMPTS times. A user's new job supersedes their
+queued ones and waits for one already running, in any process, to finish,
+and repeating the newest pending job returns its ID instead of queueing
+another. Jobs live in the database, so one claimed by a process
+that died runs again once its claim is RPC_JOB_TIMEOUT seconds old.
+Results are read from GET /rpc_jobs/<job_id>; a successful job also
+reaches push clients through the usual RPC change notification.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from database import enqueue_rpc_job, get_due_rpc_jobs, claim_rpc_job, finish_rpc_job, purge_rpc_jobs, get_rpc_by_id
+
+RPC_JOB_WORKERS = int(os.getenv('RPC_JOB_WORKERS', '8'))
+RPC_JOB_MAX_ATTEMPTS = int(os.getenv('RPC_JOB_MAX_ATTEMPTS', '3'))
+RPC_JOB_RETRY_DELAY = float(os.getenv('RPC_JOB_RETRY_DELAY', '2'))
+RPC_JOB_TIMEOUT = float(os.getenv('RPC_JOB_TIMEOUT', '120'))
+RPC_JOB_POLL_INTERVAL = float(os.getenv('RPC_JOB_POLL_INTERVAL', '1'))
+RPC_JOB_RETENTION = float(os.getenv('RPC_JOB_RETENTION', '86400'))
+RPC_JOB_PURGE_INTERVAL = 3600
+
+# Fields of a job shown to its user
+RPC_JOB_FIELDS = ('id', 'kind', 'rpc_id', 'status', 'attempts', 'error', 'created_at', 'updated_at')
+
+def serialize_rpc_job(job):
+    return {field: job[field] for field in RPC_JOB_FIELDS}
+
+class RPCJobRunner:
+    """Runs queued RPC jobs against a manager on a bounded thread pool"""
+
+    def __init__(self, manager, workers=RPC_JOB_WORKERS):
+        self.manager = manager
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rpc-job')
+        self._running = set()  # user_ids with a job running in this process
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.superseded = 0
+
+    def submit_activation(self, user_id, rpc_id):
+        """Queue activating one of user_id's RPCs and return the job ID"""
+        job_id = enqueue_rpc_job(user_id, 'activate', rpc_id)
+        self._wake.set()
+        return job_id
+
+    def submit_deactivation(self, user_id):
+        """Queue deactivating user_id's RPC and return the job ID"""
+        job_id = enqueue_rpc_job(user_id, 'deactivate')
+        self._wake.set()
+        return job_id
+
+    def start(self):
+        """Start the dispatcher thread once"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch, daemon=True)
+                self._thread.start()
+
+    def _dispatch(self):
+        purged_at = time.monotonic()
+        while True:
+            self._wake.wait(RPC_JOB_POLL_INTERVAL)
+            self._wake.clear()
+            try:
+                self._claim_due()
+            except Exception as e:
+                print(f"Failed to dispatch RPC jobs: {e}")
+            if time.monotonic() - purged_at >= RPC_JOB_PURGE_INTERVAL:
+                purged_at = time.monotonic()
+                try:
+                    removed = purge_rpc_jobs(RPC_JOB_RETENTION)
+                    if removed:
+                        print(f"Purged {removed} finished RPC jobs")
+                except Exception as e:
+                    print(f"Failed to purge RPC jobs: {e}")
+
+    def _claim_due(self):
+        with self._lock:
+            free = self.workers - len(self._running)
+        if free <= 0:
+            return
+        for job in get_due_rpc_jobs(free):
+            user_id = job['user_id']
+            with self._lock:
+                if len(self._running) >= self.workers:
+                    return
+                # Keep a user's jobs in order; the next one runs when this one ends
+                if user_id in self._running:
+                    continue
+                self._running.add(user_id)
+            if claim_rpc_job(job, RPC_JOB_TIMEOUT):
+                self._pool.submit(self._run, job)
+            else:
+                with self._lock:
+                    self._running.discard(user_id)
+
+    def _run(self, job):
+        user_id = job['user_id']
+        # claim_rpc_job counted this run; job holds the row as it was before
+        attempts = job['attempts'] + 1
+        status, error, run_at = 'done', None, None
+        try:
+            if job['kind'] == 'activate':
+                rpc_config = get_rpc_by_id(job['rpc_id'], user_id)
+                if rpc_config:
+                    self.manager.activate_rpc(user_id, rpc_config)
+                else:
+                    status, error = 'failed', 'RPC not found'
+            else:
+                self.manager.deactivate_rpc(user_id)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            if attempts < RPC_JOB_MAX_ATTEMPTS:
+                status = 'queued'
+                run_at = time.time() + RPC_JOB_RETRY_DELAY * 2 ** (attempts - 1)
+            else:
+                status = 'failed'
+        try:
+            if not finish_rpc_job(job, status, error, run_at):
+                # A newer job for the user replaced this one while it ran
+                status = 'superseded'
+        except Exception as e:
+            # The claim goes stale and the job runs again
+            print(f"Failed to record RPC job {job['id']} for user {user_id}: {e}")
+        with self._lock:
+            self._running.discard(user_id)
+            if status == 'superseded':
+                self.superseded += 1
+            elif status == 'done':
+                self.succeeded += 1
+            elif status == 'failed':
+                self.failed += 1
+            else:
+                self.retried += 1
+        self._wake.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'running': len(self._running),
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'retried': self.retried,
+                'superseded': self.superseded
+            }
@@ -0,0 +1,390 @@
+"""
+Session ownership leases for running several instances
+
+With RPC_LEASES=1, every instance sharing the database registers itself in
+rpc_instances and only runs presence sessions for users it holds a lease on
+in rpc_leases. Each user has a preferred owner among the live instances,
+picked by rendezvous hashing, so an instance joining or leaving only moves
+its own share of users.
+
+Every RPC_LEASE_RENEW_INTERVAL seconds an instance refreshes its
+registration and renews all its leases (one statement per shard), dropping
+sessions whose lease another instance took after it stalled. Separately it
+applies activations made through other instances (read from the change
+feed), hands users whose preferred owner is now another instance back a
+batch at a time, and claims and restores active users that it prefers and
+nobody holds a live lease on, including those of instances that stopped
+renewing. Leases expire RPC_LEASE_TTL seconds after their last renewal.
+
+Usage:
+    python rpc_leases.py instance                  Hold leases against DATABASE_URL with in-memory sessions instead of Discord
+    python rpc_leases.py status                    Show live instances and how many leases each holds
+    python rpc_leases.py simulate [INSTANCES] [USERS]  Run instances against a temporary SQLite database, then stop one
+"""
+
+import atexit
+import hashlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from database import (
+    get_unleased_rpc_configs, get_feed_positions, get_active_rpc_changes, get_rpc_config, set_active_rpc_id,
+    heartbeat_instance, get_live_instances, get_live_lease_counts, remove_instance, claim_leases, renew_leases,
+    release_lease
+)
+
+RPC_LEASES = os.getenv('RPC_LEASES') == '1'
+RPC_LEASE_TTL = float(os.getenv('RPC_LEASE_TTL', '30'))
+RPC_LEASE_RENEW_INTERVAL = float(os.getenv('RPC_LEASE_RENEW_INTERVAL', '10'))
+RPC_LEASE_HANDOFF_BATCH = int(os.getenv('RPC_LEASE_HANDOFF_BATCH', '1000'))
+RPC_INSTANCE_ID = os.getenv('RPC_INSTANCE_ID') or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+def preferred_owner(user_id, instances):
+    """The instance that should hold user_id's lease, by rendezvous hashing over instances"""
+    # crc32 is linear, which skews rendezvous scores; blake2b spreads users evenly
+    return max(instances, key=lambda instance: hashlib.blake2b(f'{instance}:{user_id}'.encode(), digest_size=8).digest())
+
+class LeasedRPCManager:
+    """Runs sessions only for users this instance holds leases on, matching PersistentRPCManager's API
+
+    Wraps the manager that actually runs sessions (in-process or worker
+    pool), calling it with persist=False whenever the database already
+    records the change.
+    """
+
+    def __init__(self, manager, instance_id=RPC_INSTANCE_ID):
+        self.manager = manager
+        self.instance_id = instance_id
+        self.started_at = time.time()
+        self.instances = [instance_id]
+        # user_id -> rpc_id its local session shows, for every lease held
+        self.owned = {}
+        self.lock = threading.Lock()
+        self._positions = None
+        self._restore = None
+        self._handoff_instances = None
+        self._handoff_queue = []
+        self._stopped = threading.Event()
+        self.renewals = 0
+        self.renew_ms_last = 0.0
+        self.claimed = 0
+        self.handed_off = 0
+        self.lost = 0
+        self.applied = 0
+
+    def _holds(self, user_id):
+        """Whether this instance holds user_id's lease, claiming it if this instance is the preferred owner"""
+        with self.lock:
+            if user_id in self.owned:
+                return True
+        if preferred_owner(user_id, self.instances) != self.instance_id:
+            return False
+        return bool(claim_leases(self.instance_id, [user_id], RPC_LEASE_TTL))
+
+    def _drop(self, user_id):
+        """Close user_id's local session without touching the database"""
+        with self.lock:
+            self.owned.pop(user_id, None)
+        try:
+            self.manager.deactivate_rpc(user_id, persist=False)
+        except Exception as e:
+            print(f"Failed to close RPC session for user {user_id}: {e}")
+
+    def _release(self, user_id):
+        self._drop(user_id)
+        release_lease(self.instance_id, user_id)
+
+    def activate_rpc(self, user_id, rpc_config, persist=True):
+        if self._holds(user_id):
+            with self.lock:
+                self.owned[user_id] = rpc_config.get('id')
+            try:
+                return self.manager.activate_rpc(user_id, rpc_config, persist)
+            except Exception:
+                self._release(user_id)
+                raise
+        # Another instance runs this user's sessions and applies the change from the feed
+        if persist:
+            set_active_rpc_id(user_id, rpc_config.get('id'))
+        return True
+
+    def deactivate_rpc(self, user_id, persist=True):
+        with self.lock:
+            held = user_id in self.owned
+        if held:
+            try:
+                return self.manager.deactivate_rpc(user_id, persist)
+            finally:
+                self._release(user_id)
+        if persist:
+            set_active_rpc_id(user_id, None)
+        return True
+
+    def _renew(self):
+        """Refresh this instance's registration and leases, and drop sessions whose lease was lost"""
+        started = time.monotonic()
+        instances = heartbeat_instance(self.instance_id, self.started_at, RPC_LEASE_TTL)
+        self.instances = instances if self.instance_id in instances else sorted(instances + [self.instance_id])
+        with self.lock:
+            before = dict(self.owned)
+        held = renew_leases(self.instance_id, RPC_LEASE_TTL)
+        for user_id, rpc_id in before.items():
+            if user_id in held:
+                continue
+            with self.lock:
+                # Released or re-claimed meanwhile
+                if self.owned.get(user_id, object()) != rpc_id:
+                    continue
+            print(f"Lost RPC lease for user {user_id} to another instance")
+            self.lost += 1
+            self._drop(user_id)
+        self.renewals += 1
+        self.renew_ms_last = (time.monotonic() - started) * 1000
+
+    def _apply_changes(self):
+        """Bring held sessions in line with activations made through other instances"""
+        if self._positions is None:
+            self._positions = get_feed_positions()
+            return
+        changes, self._positions = get_active_rpc_changes(self._positions)
+        for user_id, rpc_id in changes.items():
+            with self.lock:
+                if user_id not in self.owned or self.owned[user_id] == rpc_id:
+                    continue
+            self.applied += 1
+            if rpc_id is None:
+                self._release(user_id)
+                continue
+            try:
+                self.manager.activate_rpc(user_id, get_rpc_config(rpc_id, user_id), persist=False)
+                with self.lock:
+                    self.owned[user_id] = rpc_id
+            except Exception as e:
+                # Freed leases are claimed again and restored with retries
+                print(f"Failed to apply RPC change for user {user_id}: {e}")
+                self._release(user_id)
+
+    def _hand_off(self):
+        """Give up a batch of users whose preferred owner is now another instance"""
+        if self.instances != self._handoff_instances:
+            self._handoff_instances = self.instances
+            with self.lock:
+                self._handoff_queue = [user_id for user_id in self.owned
+                                       if preferred_owner(user_id, self.instances) != self.instance_id]
+        batch = self._handoff_queue[:RPC_LEASE_HANDOFF_BATCH]
+        del self._handoff_queue[:RPC_LEASE_HANDOFF_BATCH]
+        for user_id in batch:
+            with self.lock:
+                if user_id not in self.owned:
+                    continue
+            self._release(user_id)
+            self.handed_off += 1
+
+    def _claim(self):
+        """Claim and restore unleased active users this instance is the preferred owner of"""
+        # One restore batch at a time; leftovers are claimed next round
+        if self._restore is not None and self._restore.is_alive():
+            return
+        wanted = [rpc_data for rpc_data in get_unleased_rpc_configs()
+                  if preferred_owner(rpc_data['user_id'], self.instances) == self.instance_id]
+        if not wanted:
+            return
+        claimed = set(claim_leases(self.instance_id, [rpc_data['user_id'] for rpc_data in wanted], RPC_LEASE_TTL))
+        active_rpcs = [rpc_data for rpc_data in wanted if rpc_data['user_id'] in claimed]
+        with self.lock:
+            for rpc_data in active_rpcs:
+                self.owned[rpc_data['user_id']] = rpc_data['id']
+        self.claimed += len(active_rpcs)
+        self._restore = threading.Thread(target=self.manager.restore_active_rpcs, args=(active_rpcs, 'leases'), daemon=True)
+        self._restore.start()
+
+    def _maintain(self):
+        self._apply_changes()
+        self._hand_off()
+        self._claim()
+
+    def _every_interval(self, step, name):
+        while not self._stopped.wait(RPC_LEASE_RENEW_INTERVAL):
+            try:
+                step()
+            except Exception as e:
+                print(f"RPC lease {name} failed: {e}")
+
+    def restore_active_rpcs(self):
+        """Register this instance, then claim and restore the users it is the preferred owner of"""
+        self._positions = get_feed_positions()
+        self._renew()
+        atexit.register(self.shutdown)
+        self._claim()
+        if self._restore is not None:
+            self._restore.join()
+
+    def start_health_checks(self):
+        self.manager.start_health_checks()
+        threading.Thread(target=self._every_interval, args=(self._renew, 'renewal'), daemon=True).start()
+        threading.Thread(target=self._every_interval, args=(self._maintain, 'maintenance'), daemon=True).start()
+
+    def shutdown(self):
+        """Unregister and free every lease so other instances take the users over at once"""
+        self._stopped.set()
+        try:
+            remove_instance(self.instance_id)
+        except Exception as e:
+            print(f"Failed to release RPC leases: {e}")
+
+    def session_configs(self):
+        return self.manager.session_configs()
+
+    def save_snapshot(self):
+        self.manager.save_snapshot()
+
+    def health_stats(self):
+        return self.manager.health_stats()
+
+    def update_stats(self):
+        return self.manager.update_stats()
+
+    def connection_stats(self):
+        return self.manager.connection_stats()
+
+    def session_stats(self):
+        return self.manager.session_stats()
+
+    def touch(self, user_id):
+        # Only reaches sessions this instance holds
+        self.manager.touch(user_id)
+
+    def restore_stats(self):
+        return dict(self.manager.restore_stats(), leases=self.stats())
+
+    def active_user_ids(self):
+        return self.manager.active_user_ids()
+
+    def stats(self):
+        with self.lock:
+            owned = len(self.owned)
+        return {
+            'instance': self.instance_id,
+            'instances': len(self.instances),
+            'owned': owned,
+            'claimed': self.claimed,
+            'handed_off': self.handed_off,
+            'lost': self.lost,
+            'applied_changes': self.applied,
+            'renewals': self.renewals,
+            'renew_ms_last': round(self.renew_ms_last, 3)
+        }
+
+class _LocalSessions:
+    """Stand-in for a presence engine that keeps sessions in a dict, for trying leases without Discord"""
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def activate_rpc(self, user_id, rpc_config, persist=True):
+        with self.lock:
+            self.sessions[user_id] = rpc_config
+        if persist:
+            set_active_rpc_id(user_id, rpc_config.get('id'))
+        return True
+
+    def deactivate_rpc(self, user_id, persist=True):
+        with self.lock:
+            self.sessions.pop(user_id, None)
+        if persist:
+            set_active_rpc_id(user_id, None)
+        return True
+
+    def restore_active_rpcs(self, active_rpcs=None, source=None):
+        with self.lock:
+            for rpc_data in active_rpcs or ():
+                self.sessions.setdefault(rpc_data['user_id'], rpc_data)
+
+    def start_health_checks(self):
+        pass
+
+    def restore_stats(self):
+        return {'ready': True}
+
+    def active_user_ids(self):
+        with self.lock:
+            return list(self.sessions)
+
+def run_instance():
+    """Hold leases with in-memory sessions until interrupted, printing the session count each interval"""
+    from database import init_database
+    init_database()
+    manager = LeasedRPCManager(_LocalSessions())
+    manager.restore_active_rpcs()
+    manager.start_health_checks()
+    print(f"Instance {manager.instance_id} started")
+    try:
+        while True:
+            time.sleep(RPC_LEASE_RENEW_INTERVAL)
+            print(f"{manager.instance_id}: {len(manager.active_user_ids())} sessions, {manager.stats()['owned']} leases")
+    except KeyboardInterrupt:
+        pass
+
+def print_status():
+    from database import get_active_rpc_configs
+    leases = get_live_lease_counts()
+    for instance in get_live_instances():
+        print(f"  {instance}: {leases.pop(instance, 0)} leases")
+    for owner, held in leases.items():
+        print(f"  {owner} (not registered): {held} leases")
+    print(f"  active users without a live lease: {len(get_unleased_rpc_configs())} of {len(get_active_rpc_configs())}")
+
+def simulate(instances=3, users=300):
+    """Start instances against a temporary SQLite database, wait for them to share the users, then stop one"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{os.path.join(tmp_dir, "leases.sqlite")}',
+                   RPC_LEASE_TTL='3', RPC_LEASE_RENEW_INTERVAL='1', PYTHONUNBUFFERED='1')
+        env.pop('RPC_INSTANCE_ID', None)
+        script = os.path.abspath(__file__)
+        subprocess.run([sys.executable, script, 'seed', str(users)], env=env, check=True, stdout=subprocess.DEVNULL)
+
+        def status(title):
+            print(title)
+            subprocess.run([sys.executable, script, 'status'], env=env, check=True)
+
+        processes = [subprocess.Popen([sys.executable, script, 'instance'], env=env, stdout=subprocess.DEVNULL)
+                     for _ in range(instances)]
+        try:
+            time.sleep(8)
+            status(f"{instances} instances, {users} active users:")
+            processes.pop().kill()
+            time.sleep(8)
+            status("After killing one instance without a clean shutdown:")
+            processes.append(subprocess.Popen([sys.executable, script, 'instance'], env=env, stdout=subprocess.DEVNULL))
+            time.sleep(8)
+            status("After starting a replacement:")
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+def _seed(users):
+    from database import init_database, create_or_update_user, create_custom_rpc
+    init_database()
+    for user_id in range(1, users + 1):
+        create_or_update_user({'id': user_id, 'username': f'user{user_id}'}, {})
+        set_active_rpc_id(user_id, create_custom_rpc(user_id, {'app_id': '1419030874640613446', 'details': 'Lease test'}))
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'instance':
+        run_instance()
+    elif command == 'status':
+        print_status()
+    elif command == 'simulate':
+        simulate(*[int(arg) for arg in sys.argv[2:4]])
+    elif command == 'seed':
+        _seed(int(sys.argv[2]))
+    else:
+        print(__doc__)
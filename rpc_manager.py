@@ -4,6 +4,7 @@ import time
 import threading
 from pypresence import Presence
 from database import get_user_rpcs
+from presence_payload import build_update_args
 
 # Store active RPC instances
 active_rpcs = {}
@@ -27,33 +28,7 @@ def activate_user_rpc(user_id, rpc_config):
         RPC = Presence(app_id)
         RPC.connect()
         
-        update_args = {}
-        
-        if rpc_config.get('details'):
-            update_args['details'] = rpc_config['details']
-        
-        if rpc_config.get('state'):
-            update_args['state'] = rpc_config['state']
-        
-        if rpc_config.get('timestamp_type') == 'live':
-            update_args['start'] = int(time.time())
-        elif rpc_config.get('custom_timestamp'):
-            update_args['start'] = int(rpc_config['custom_timestamp'])
-        
-        if rpc_config.get('large_image_url'):
-            update_args['large_image'] = rpc_config['large_image_url']
-        if rpc_config.get('large_image_text'):
-            update_args['large_text'] = rpc_config['large_image_text']
-        
-        if rpc_config.get('small_image_url'):
-            update_args['small_image'] = rpc_config['small_image_url']
-        if rpc_config.get('small_image_text'):
-            update_args['small_text'] = rpc_config['small_image_text']
-        
-        if rpc_config.get('buttons'):
-            buttons = json.loads(rpc_config['buttons']) if isinstance(rpc_config['buttons'], str) else rpc_config['buttons']
-            if buttons:
-                update_args['buttons'] = buttons
+        update_args = build_update_args(rpc_config)
         
         RPC.update(**update_args)
         active_rpcs[user_id] = RPC
@@ -1,29 +1,83 @@
+"""
+Presence sessions for the threads engine
+
+PersistentRPCManager keeps one pypresence connection per user, each guarded
+by that user's own lock, so activations for different users run in parallel
+and the health checker skips users that are busy instead of waiting on them.
+"""
+
+import atexit
 import json
+import os
 import time
 import threading
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pypresence import Presence
-from database import get_user_rpcs, get_db
+from database import get_user_rpcs, get_active_rpc_id, set_active_rpc_id, get_active_rpc_configs, get_rpc_config
+from health_scheduler import HealthScheduler, ping_presence
+from presence_updates import UpdateCoalescer, SEND, QUEUED
+from presence_payload import build_update_args
+from presence_pool import ConnectionPool
+from session_registry import SessionRegistry
+from warm_restart import RestoreProgress, load_restore_configs, save_snapshot, ramp_delay, RPC_RESTORE_CONCURRENCY, RPC_SNAPSHOT_PATH
+from rpc_workers import WorkerPoolRPCManager, RPC_WORKERS
+from rpc_leases import LeasedRPCManager, RPC_LEASES
+from rpc_jobs import RPCJobRunner
+from rpc_control import RemoteRPCManager, PROCESS_ROLE
+
+# 'threads' (one blocking Presence per user) or 'async' (rpc_async.AsyncRPCManager)
+RPC_ENGINE = os.getenv('RPC_ENGINE', 'threads')
+RPC_PROBE_TIMEOUT = float(os.getenv('RPC_PROBE_TIMEOUT', '5'))
+RPC_FLUSH_RETRY_INTERVAL = float(os.getenv('RPC_FLUSH_RETRY_INTERVAL', '0.5'))
+
+def presence_signature(rpc_config, update_args):
+    """Identify what a presence shows; a live timer's start time is not part of it"""
+    if rpc_config.get('timestamp_type') == 'live':
+        update_args = {k: v for k, v in update_args.items() if k != 'start'}
+    return json.dumps(update_args, sort_keys=True)
 
 class PersistentRPCManager:
     def __init__(self):
-        self.active_rpcs = {}
-        self.lock = threading.Lock()
-        
+        # user_id -> SessionRecord with the config the session should show and its connection
+        self.sessions = SessionRegistry()
+        # user_id -> [lock, holders]; entries exist only while someone uses them
+        self._user_locks = {}
+        self._user_locks_guard = threading.Lock()
+        self.health = HealthScheduler()
+        self.updates = UpdateCoalescer()
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+        self.restore = RestoreProgress()
+        # Connections of ended sessions, kept open for the next session of the same application
+        self.connections = ConnectionPool(close=self._close_connection)
+
+    @contextmanager
+    def _user_lock(self, user_id, blocking=True):
+        """Serialize work on one user's session; yields False if non-blocking and busy"""
+        with self._user_locks_guard:
+            entry = self._user_locks.get(user_id)
+            if entry is None:
+                entry = self._user_locks[user_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        acquired = entry[0].acquire(blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._user_locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._user_locks[user_id]
+
     def _get_active_rpc_id(self, user_id):
         """Get the active RPC ID for a user from database"""
-        with get_db() as conn:
-            cur = conn.cursor()
-            cur.execute('SELECT active_rpc_id FROM users WHERE id = ?', (user_id,))
-            result = cur.fetchone()
-            return result['active_rpc_id'] if result else None
+        return get_active_rpc_id(user_id)
 
     def _set_active_rpc_id(self, user_id, rpc_id):
         """Set the active RPC ID for a user in database"""
-        with get_db() as conn:
-            cur = conn.cursor()
-            cur.execute('UPDATE users SET active_rpc_id = ? WHERE id = ?', (rpc_id, user_id))
-            conn.commit()
+        set_active_rpc_id(user_id, rpc_id)
 
     def _create_rpc_instance(self, app_id):
         """Create and connect a new RPC instance"""
@@ -35,137 +89,345 @@ class PersistentRPCManager:
             print(f"Failed to connect RPC: {e}")
             return None
 
-    def activate_rpc(self, user_id, rpc_config):
-        """Activate RPC for a user and persist the status"""
-        with self.lock:
+    def _close_connection(self, rpc):
+        try:
+            rpc.close()
+        except Exception:
+            pass
+
+    def _open_connection(self, app_id, update_args):
+        """Show update_args on a parked connection for app_id, or on a new one if none is parked or it fails"""
+        rpc = self.connections.acquire(app_id)
+        if rpc is not None:
             try:
-                app_id = rpc_config.get('app_id')
-                if not app_id:
-                    raise Exception("No application ID provided")
-
-                # Deactivate existing RPC if any
-                self.deactivate_rpc(user_id)
-
-                # Create new RPC instance
-                rpc = self._create_rpc_instance(app_id)
-                if not rpc:
-                    raise Exception("Failed to create RPC instance")
-
-                # Prepare update arguments
-                update_args = {
-                    'details': rpc_config.get('details'),
-                    'state': rpc_config.get('state')
-                }
-
-                # Handle timestamp
-                if rpc_config.get('timestamp_type') == 'live':
-                    update_args['start'] = int(time.time())
-                elif rpc_config.get('custom_timestamp'):
-                    update_args['start'] = int(rpc_config['custom_timestamp'])
-
-                # Handle images
-                if rpc_config.get('large_image_url'):
-                    update_args['large_image'] = rpc_config['large_image_url']
-                    if rpc_config.get('large_image_text'):
-                        update_args['large_text'] = rpc_config['large_image_text']
-
-                if rpc_config.get('small_image_url'):
-                    update_args['small_image'] = rpc_config['small_image_url']
-                    if rpc_config.get('small_image_text'):
-                        update_args['small_text'] = rpc_config['small_image_text']
-
-                # Handle buttons
-                if rpc_config.get('buttons'):
-                    buttons = json.loads(rpc_config['buttons']) if isinstance(rpc_config['buttons'], str) else rpc_config['buttons']
-                    if buttons:
-                        update_args['buttons'] = buttons
-
-                # Update RPC
-                rpc.update(**{k: v for k, v in update_args.items() if v is not None})
-                
-                # Store in memory
-                self.active_rpcs[user_id] = rpc
-                
-                # Persist in database
-                self._set_active_rpc_id(user_id, rpc_config.get('id'))
-                
-                print(f"✓ RPC activated and persisted for user {user_id} with app {app_id}")
-                return True
+                rpc.update(**update_args)
+                return rpc
+            except Exception:
+                # Discord dropped it while it was parked
+                self._close_connection(rpc)
 
-            except Exception as e:
-                print(f"Failed to activate RPC for user {user_id}: {e}")
-                self.deactivate_rpc(user_id)
-                raise e
-
-    def deactivate_rpc(self, user_id):
-        """Deactivate RPC for a user and remove persistent status"""
-        with self.lock:
-            if user_id in self.active_rpcs:
+        rpc = self._create_rpc_instance(app_id)
+        try:
+            if not rpc:
+                raise Exception("Failed to create RPC instance")
+            rpc.update(**update_args)
+            return rpc
+        except Exception:
+            if rpc:
+                self._close_connection(rpc)
+            self.connections.release(app_id)
+            raise
+
+    def activate_rpc(self, user_id, rpc_config, persist=True):
+        """Activate RPC for a user and, unless persist is False, store it as the user's active RPC"""
+        with self._user_lock(user_id):
+            activated = self._activate_locked(user_id, rpc_config, persist)
+        self._evict_sessions()
+        return activated
+
+    def _activate_locked(self, user_id, rpc_config, persist=True):
+        """Activate RPC for a user; caller holds the user's lock"""
+        try:
+            rpc = self.sessions.connection(user_id)
+            reused = False
+            if rpc is not None and str(rpc.client_id) == str(rpc_config.get('app_id')):
+                # Same application: update the open session instead of reconnecting
                 try:
-                    self.active_rpcs[user_id].close()
-                except:
-                    pass
-                del self.active_rpcs[user_id]
+                    self._update_locked(user_id, rpc, rpc_config)
+                    reused = True
+                except Exception as e:
+                    print(f"RPC session for user {user_id} failed, reconnecting: {e}")
+                    self._close_session(user_id)
+            if not reused:
+                # A session for another application is parked for whoever uses that one next
+                self._close_session(user_id, park=True)
+                self._connect_locked(user_id, rpc_config)
+            
+            # Persist in database
+            if persist:
+                self._set_active_rpc_id(user_id, rpc_config.get('id'))
+            
+            print(f"✓ RPC activated for user {user_id} with app {rpc_config.get('app_id')}")
+            return True
+
+        except Exception as e:
+            print(f"Failed to activate RPC for user {user_id}: {e}")
+            self._deactivate_locked(user_id, persist)
+            raise e
+
+    def _connect_locked(self, user_id, rpc_config):
+        """Open a session for rpc_config and schedule its health checks; caller holds the user's lock"""
+        app_id = rpc_config.get('app_id')
+        if not app_id:
+            raise Exception("No application ID provided")
+
+        update_args = build_update_args(rpc_config)
+        rpc = self._open_connection(app_id, update_args)
+
+        signature = presence_signature(rpc_config, update_args)
+        self.sessions.attach(user_id, rpc_config, rpc, signature)
+        self.updates.reset(user_id, signature)
+        self.health.add(user_id)
+
+    def _update_locked(self, user_id, rpc, rpc_config):
+        """Send rpc_config to an open session now, or queue it for the session's next update slot"""
+        update_args = build_update_args(rpc_config)
+        signature = presence_signature(rpc_config, update_args)
+        result = self.updates.submit(user_id, update_args, signature)
+        if result == SEND:
+            rpc.update(**update_args)
+        elif result == QUEUED:
+            self._start_flusher()
+        self.sessions.set_config(user_id, rpc_config, signature)
+
+    def _start_flusher(self):
+        with self._flusher_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_updates, daemon=True)
+                self._flusher.start()
+
+    def _flush_updates(self):
+        """Send queued presence updates as their sessions' update slots open
 
-            # Remove from database
+        Users busy right now, e.g. in a slow connect(), keep their pending
+        update for a later pass instead of holding up everyone else's.
+        """
+        while True:
+            busy = False
+            for user_id in self.updates.ready_keys():
+                with self._user_lock(user_id, blocking=False) as acquired:
+                    if not acquired:
+                        busy = True
+                        continue
+                    rpc = self.sessions.connection(user_id)
+                    update_args = self.updates.take_pending(user_id)
+                    if rpc is None or update_args is None:
+                        continue
+                    try:
+                        rpc.update(**update_args)
+                    except Exception as e:
+                        # Leave the reconnect to the session's next health check
+                        print(f"Failed to update RPC for user {user_id}: {e}")
+                        self._close_session(user_id)
+            if busy:
+                # Their slots are already open, so wait() would return at once
+                time.sleep(RPC_FLUSH_RETRY_INTERVAL)
+            else:
+                self.updates.wait(self.updates.min_interval)
+
+    def deactivate_rpc(self, user_id, persist=True):
+        """Deactivate RPC for a user and, unless persist is False, clear the user's active RPC"""
+        with self._user_lock(user_id):
+            return self._deactivate_locked(user_id, persist)
+
+    def _close_session(self, user_id, park=False):
+        """Drop a user's session; with park, clear its presence and keep the connection for reuse"""
+        self.updates.forget(user_id)
+        rpc = self.sessions.detach(user_id)
+        if rpc is None:
+            return
+        if park:
+            try:
+                rpc.clear()
+            except Exception:
+                park = False
+        if not park:
+            self._close_connection(rpc)
+        self.connections.release(rpc.client_id, rpc if park else None)
+
+    def _deactivate_locked(self, user_id, persist=True):
+        """Deactivate RPC for a user; caller holds the user's lock"""
+        self.health.remove(user_id)
+        self._close_session(user_id, park=True)
+        self.sessions.remove(user_id)
+
+        # Remove from database
+        if persist:
             self._set_active_rpc_id(user_id, None)
-            print(f"✓ RPC deactivated for user {user_id}")
-            return True
+        print(f"✓ RPC deactivated for user {user_id}")
+        return True
+
+    def _evict_sessions(self, idle=False):
+        """Park the connections of sessions beyond RPC_MAX_LIVE_SESSIONS, and with idle of idle ones
 
-    def restore_active_rpcs(self):
-        """Restore active RPCs from database after restart"""
-        print("Restoring active RPCs...")
-        with get_db() as conn:
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT users.id as user_id, custom_rpcs.* 
-                FROM users 
-                JOIN custom_rpcs ON users.active_rpc_id = custom_rpcs.id 
-                WHERE users.active_rpc_id IS NOT NULL
-            ''')
-            active_rpcs = cur.fetchall()
-
-        for rpc_data in active_rpcs:
-            user_id = rpc_data['user_id']
+        Their records and active_rpc_id stay, so touch() reconnects them.
+        Users busy right now are left for the next pass.
+        """
+        for user_id in self.sessions.eviction_candidates(idle):
+            with self._user_lock(user_id, blocking=False) as acquired:
+                if acquired:
+                    self.health.remove(user_id)
+                    self._close_session(user_id, park=True)
+                    self.sessions.evict(user_id)
+
+    def touch(self, user_id):
+        """Note that a user is around, reconnecting their session right away if it was evicted"""
+        if self.sessions.touch(user_id):
+            self.health.add(user_id, delay=0)
+
+    def restore_active_rpcs(self, active_rpcs=None, source=None):
+        """Restore active RPCs after restart, ramping up with bounded concurrency
+
+        Restores the given configs, or by default those from load_restore_configs().
+        """
+        if active_rpcs is None:
+            active_rpcs, source = load_restore_configs()
+        self.restore.begin(len(active_rpcs), source)
+        slots = threading.BoundedSemaphore(RPC_RESTORE_CONCURRENCY)
+
+        def restore(rpc_data):
+            try:
+                self.restore.record(self._restore_rpc(rpc_data['user_id'], rpc_data))
+            finally:
+                slots.release()
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=RPC_RESTORE_CONCURRENCY) as pool:
+            for index, rpc_data in enumerate(active_rpcs):
+                delay = started + ramp_delay(index) - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                slots.acquire()
+                pool.submit(restore, rpc_data)
+        self.restore.finish()
+
+    def _restore_rpc(self, user_id, rpc_data):
+        """Reconnect one restored session without touching the database"""
+        with self._user_lock(user_id):
+            # The user activated or deactivated something since the restart
+            if self.sessions.connection(user_id) is not None:
+                return True
+            if rpc_data.get('evicted') or self.sessions.full():
+                # Connect it when the user is next seen
+                self.sessions.add_evicted(rpc_data)
+                return True
             try:
-                self.activate_rpc(user_id, rpc_data)
+                self._connect_locked(user_id, rpc_data)
+                return True
             except Exception as e:
                 print(f"Failed to restore RPC for user {user_id}: {e}")
+                # Keep active_rpc_id and let health checks retry with backoff
+                self.sessions.set_config(user_id, rpc_data)
+                self.health.add(user_id)
+                self.health.failed(user_id)
+                return False
+
+    def session_configs(self):
+        """Configs of every health-checked session, plus the ids of evicted ones"""
+        return self.sessions.configs()
+
+    def save_snapshot(self):
+        """Write the configs of every health-checked session for the next start"""
+        save_snapshot(self.session_configs())
+
+    def _probe(self, rpc):
+        """Check a session is alive without changing the presence it shows"""
+        rpc.loop.run_until_complete(ping_presence(rpc, RPC_PROBE_TIMEOUT))
+
+    def _check_session(self, user_id):
+        """Probe one session and reconnect it from the database if it is broken"""
+        with self._user_lock(user_id, blocking=False) as acquired:
+            # Skip users being activated or deactivated right now
+            if not acquired:
+                self.health.postpone(user_id)
+                return
+            rpc = self.sessions.connection(user_id)
+            if rpc is not None:
+                try:
+                    self._probe(rpc)
+                    self.health.succeeded(user_id)
+                    self.sessions.succeeded(user_id)
+                    return
+                except Exception:
+                    self._close_session(user_id)
+
+            # Broken or missing after a failed reconnect: restore from database,
+            # leaving active_rpc_id set so later checks and restarts retry it
+            try:
+                active_rpc_id = self._get_active_rpc_id(user_id)
+                rpc_data = get_rpc_config(active_rpc_id, user_id) if active_rpc_id else None
+                if not rpc_data:
+                    self.health.remove(user_id)
+                    self.sessions.remove(user_id)
+                    return
+                self._connect_locked(user_id, rpc_data)
+                print(f"✓ RPC reconnected for user {user_id}")
+            except Exception as e:
+                print(f"Failed to reconnect RPC for user {user_id}: {e}")
+                self.health.failed(user_id)
 
     def check_and_reconnect(self):
-        """Periodically check and reconnect RPCs if needed"""
+        """Run each session's health check when it falls due"""
         while True:
-            with self.lock:
-                for user_id, rpc in list(self.active_rpcs.items()):
-                    try:
-                        # Try to update the presence to check connection
-                        rpc.update(start=int(time.time()))
-                    except:
-                        # If failed, try to restore from database
-                        active_rpc_id = self._get_active_rpc_id(user_id)
-                        if active_rpc_id:
-                            try:
-                                with get_db() as conn:
-                                    cur = conn.cursor()
-                                    cur.execute('SELECT * FROM custom_rpcs WHERE id = ?', (active_rpc_id,))
-                                    rpc_data = cur.fetchone()
-                                    if rpc_data:
-                                        self.activate_rpc(user_id, rpc_data)
-                            except Exception as e:
-                                print(f"Failed to reconnect RPC for user {user_id}: {e}")
-            time.sleep(30)  # Check every 30 seconds
+            for user_id in self.health.pop_due():
+                try:
+                    self._check_session(user_id)
+                except Exception as e:
+                    print(f"RPC health check failed for user {user_id}: {e}")
+                    self.health.failed(user_id)
+            self._evict_sessions(idle=True)
+            self.connections.evict_idle()
+            self.health.wait(self.health.interval)
+
+    def start_health_checks(self):
+        check_thread = threading.Thread(target=self.check_and_reconnect, daemon=True)
+        check_thread.start()
+
+    def health_stats(self):
+        return self.health.stats()
+
+    def update_stats(self):
+        return self.updates.stats()
+
+    def connection_stats(self):
+        return self.connections.stats()
+
+    def session_stats(self):
+        return self.sessions.stats()
+
+    def restore_stats(self):
+        return self.restore.stats()
+
+    def active_user_ids(self):
+        return self.sessions.connected_user_ids()
+
+def create_engine_manager():
+    """Create an in-process manager for RPC_ENGINE"""
+    if RPC_ENGINE == 'async':
+        from rpc_async import AsyncRPCManager
+        return AsyncRPCManager()
+    return PersistentRPCManager()
 
 # Create a global instance
-rpc_manager = PersistentRPCManager()
+if PROCESS_ROLE == 'web':
+    # An HTTP worker: sessions run in the RPC service process, which also runs the queued jobs
+    rpc_manager = RemoteRPCManager()
+else:
+    if RPC_WORKERS > 1:
+        rpc_manager = WorkerPoolRPCManager()
+    else:
+        rpc_manager = create_engine_manager()
+    if RPC_LEASES:
+        # Share the database with other instances, each running only the sessions it holds leases on
+        rpc_manager = LeasedRPCManager(rpc_manager)
+
+# Runs the activations and deactivations queued by the web routes
+rpc_jobs = RPCJobRunner(rpc_manager)
 
 # Start background tasks
 def start_background_tasks():
-    # Start RPC check thread
-    check_thread = threading.Thread(target=rpc_manager.check_and_reconnect, daemon=True)
-    check_thread.start()
-    
-    # Restore active RPCs
-    rpc_manager.restore_active_rpcs()
+    """Start the RPC job runner and restore active RPCs in the background, then start health checks"""
+    if RPC_SNAPSHOT_PATH:
+        atexit.register(rpc_manager.save_snapshot)
+    rpc_jobs.start()
+
+    def run():
+        rpc_manager.restore_active_rpcs()
+        rpc_manager.start_health_checks()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
 
 # Helper functions for the Flask app
 def activate_user_rpc(user_id, rpc_config):
@@ -174,5 +436,27 @@ def activate_user_rpc(user_id, rpc_config):
 def deactivate_user_rpc(user_id):
     return rpc_manager.deactivate_rpc(user_id)
 
+def queue_user_rpc_activation(user_id, rpc_id):
+    return rpc_jobs.submit_activation(user_id, rpc_id)
+
+def queue_user_rpc_deactivation(user_id):
+    return rpc_jobs.submit_deactivation(user_id)
+
 def get_active_rpcs():
-    return list(rpc_manager.active_rpcs.keys())
\ No newline at end of file
+    return rpc_manager.active_user_ids()
+
+# Sections of /health that service_stats() fills in
+SERVICE_STATS = ('rpc_health', 'presence_updates', 'presence_connections', 'rpc_sessions', 'rpc_jobs', 'token_refresh', 'rpc_restore')
+
+def service_stats():
+    """Stats of the sessions, RPC jobs and token refresh this process runs, keyed as /health reports them"""
+    from token_refresh import token_refresher
+    return {
+        'rpc_health': rpc_manager.health_stats(),
+        'presence_updates': rpc_manager.update_stats(),
+        'presence_connections': rpc_manager.connection_stats(),
+        'rpc_sessions': rpc_manager.session_stats(),
+        'rpc_jobs': rpc_jobs.stats(),
+        'token_refresh': token_refresher.stats(),
+        'rpc_restore': rpc_manager.restore_stats()
+    }
\ No newline at end of file
@@ -0,0 +1,301 @@
+"""
+Multi-process presence workers
+
+With RPC_WORKERS > 1 the presence sessions leave the web process and run in
+that many worker processes, each with its own RPC_ENGINE manager and GIL.
+A user's sessions always live in the worker their user_id hashes to (the
+same hash that picks their database shard), and the web process forwards
+manager calls to it over a pipe. A supervisor thread pings every worker and
+replaces one that dies or stops answering, restoring its users' active RPCs
+from the database.
+"""
+
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from db_backends import shard_index
+from database import get_active_rpc_configs, notify_rpcs_changed
+from warm_restart import load_restore_configs, save_snapshot
+
+RPC_WORKERS = int(os.getenv('RPC_WORKERS', '1'))
+RPC_WORKER_THREADS = int(os.getenv('RPC_WORKER_THREADS', '32'))
+RPC_WORKER_TIMEOUT = float(os.getenv('RPC_WORKER_TIMEOUT', '60'))
+RPC_WORKER_CHECK_INTERVAL = float(os.getenv('RPC_WORKER_CHECK_INTERVAL', '5'))
+RPC_WORKER_PING_TIMEOUT = float(os.getenv('RPC_WORKER_PING_TIMEOUT', '10'))
+
+# Manager methods the web process may call in a worker
+WORKER_METHODS = {
+    'activate_rpc', 'deactivate_rpc', 'touch', 'restore_active_rpcs', 'start_health_checks', 'session_configs',
+    'health_stats', 'update_stats', 'connection_stats', 'session_stats', 'restore_stats', 'active_user_ids'
+}
+
+class RPCWorkerError(Exception):
+    """A manager call failed in its worker, or the worker went away"""
+
+def serve_calls(conn, handlers, threads=RPC_WORKER_THREADS):
+    """Answer (request_id, method, args) calls received on conn with handlers[method] until conn closes"""
+    pool = ThreadPoolExecutor(max_workers=threads)
+    send_lock = threading.Lock()
+
+    def handle(request_id, method, args):
+        try:
+            if method == 'ping':
+                reply = (request_id, True, os.getpid())
+            elif method in handlers:
+                reply = (request_id, True, handlers[method](*args))
+            else:
+                reply = (request_id, False, f"Unknown method {method}")
+        except Exception as e:
+            # Sent as text; not every exception survives pickling
+            reply = (request_id, False, str(e))
+        with send_lock:
+            try:
+                conn.send(reply)
+            except (EOFError, OSError):
+                pass
+            except Exception as e:
+                conn.send((request_id, False, f"Unsendable result from {method}: {e}"))
+
+    while True:
+        try:
+            request_id, method, args = conn.recv()
+        except (EOFError, OSError):
+            break
+        pool.submit(handle, request_id, method, args)
+    pool.shutdown(wait=False)
+
+def _serve(index, conn):
+    """Worker process: run manager calls received on conn until the web process goes away"""
+    from rpc_persistent import create_engine_manager
+    manager = create_engine_manager()
+    print(f"✓ RPC worker {index} started (pid {os.getpid()})")
+    serve_calls(conn, {method: getattr(manager, method) for method in WORKER_METHODS})
+    # Sessions die with the process; the next start or a new worker restores them
+    os._exit(0)
+
+class CallChannel:
+    """The calling end of a connection answered by serve_calls()"""
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.alive = True
+        self._pending = {}  # request_id -> Future
+        self._pending_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count()
+        threading.Thread(target=self._read_replies, daemon=True).start()
+
+    def call(self, method, *args):
+        """Send a call; returns a Future for its result"""
+        future = Future()
+        with self._pending_lock:
+            if not self.alive:
+                future.set_exception(RPCWorkerError(f"{self.name} is not running"))
+                return future
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+        try:
+            with self._send_lock:
+                self.conn.send((request_id, method, args))
+        except Exception as e:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            future.set_exception(RPCWorkerError(f"Could not reach {self.name}: {e}"))
+        return future
+
+    def _read_replies(self):
+        while True:
+            try:
+                request_id, ok, result = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RPCWorkerError(result))
+
+        with self._pending_lock:
+            self.alive = False
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(RPCWorkerError(f"{self.name} went away"))
+
+    def close(self):
+        self.conn.close()
+
+class _Worker(CallChannel):
+    """The web process's end of one worker process"""
+
+    def __init__(self, index, context):
+        self.index = index
+        conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(index, child_conn), name=f'rpc-worker-{index}', daemon=True)
+        self.process.start()
+        # Only the child may hold its end, so recv() sees EOF when the child exits
+        child_conn.close()
+        self.started_at = time.time()
+        super().__init__(conn, f'RPC worker {index}')
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+class WorkerPoolRPCManager:
+    """Blocking API over RPC worker processes, matching PersistentRPCManager"""
+
+    def __init__(self, workers=RPC_WORKERS):
+        self.size = workers
+        self.workers = []
+        self.restarts = [0] * workers
+        self._lock = threading.Lock()
+        # Workers must not inherit the web process's threads, locks and connections
+        self._context = multiprocessing.get_context('spawn')
+        self._health_checks = False
+
+    def start(self):
+        """Start the worker processes and their supervisor if not yet running"""
+        with self._lock:
+            if self.workers:
+                return
+            self.workers = [_Worker(index, self._context) for index in range(self.size)]
+        threading.Thread(target=self._supervise, daemon=True).start()
+
+    def worker_index(self, user_id):
+        return shard_index(user_id, self.size)
+
+    def _call(self, user_id, method, *args):
+        self.start()
+        return self.workers[self.worker_index(user_id)].call(method, *args).result(RPC_WORKER_TIMEOUT)
+
+    def activate_rpc(self, user_id, rpc_config, persist=True):
+        try:
+            return self._call(user_id, 'activate_rpc', user_id, rpc_config, persist)
+        finally:
+            # The worker changed active_rpc_id, but the change listeners live here
+            if persist:
+                notify_rpcs_changed(user_id)
+
+    def deactivate_rpc(self, user_id, persist=True):
+        try:
+            return self._call(user_id, 'deactivate_rpc', user_id, persist)
+        finally:
+            if persist:
+                notify_rpcs_changed(user_id)
+
+    def touch(self, user_id):
+        """Pass the user's visit on to their worker without waiting for it"""
+        self.start()
+        self.workers[self.worker_index(user_id)].call('touch', user_id)
+
+    def restore_active_rpcs(self, active_rpcs=None, source=None):
+        """Hand each worker its users' active RPCs to restore and wait for every worker to finish
+
+        Restores the given configs, or by default those from load_restore_configs().
+        """
+        self.start()
+        if active_rpcs is None:
+            active_rpcs, source = load_restore_configs()
+        batches = [[] for _ in range(self.size)]
+        for rpc_data in active_rpcs:
+            batches[self.worker_index(rpc_data['user_id'])].append(rpc_data)
+        restores = [worker.call('restore_active_rpcs', batch, source) for worker, batch in zip(self.workers, batches)]
+        for worker, restore in zip(self.workers, restores):
+            try:
+                restore.result()
+            except Exception as e:
+                print(f"RPC worker {worker.index} failed to restore its RPCs: {e}")
+
+    def _restore_worker(self, worker):
+        """Reconnect a replacement worker's active RPCs from the database"""
+        active_rpcs = [rpc_data for rpc_data in get_active_rpc_configs()
+                       if self.worker_index(rpc_data['user_id']) == worker.index]
+        try:
+            worker.call('restore_active_rpcs', active_rpcs, 'database').result()
+            if self._health_checks:
+                worker.call('start_health_checks').result(RPC_WORKER_TIMEOUT)
+        except Exception as e:
+            print(f"RPC worker {worker.index} failed to restore its RPCs: {e}")
+
+    def start_health_checks(self):
+        self.start()
+        self._health_checks = True
+        for worker in self.workers:
+            worker.call('start_health_checks').result(RPC_WORKER_TIMEOUT)
+
+    def _supervise(self):
+        """Replace workers that exit or stop answering pings"""
+        while True:
+            time.sleep(RPC_WORKER_CHECK_INTERVAL)
+            pings = [(worker, worker.call('ping')) for worker in self.workers]
+            deadline = time.monotonic() + RPC_WORKER_PING_TIMEOUT
+            for worker, ping in pings:
+                try:
+                    ping.result(max(0.0, deadline - time.monotonic()))
+                except Exception:
+                    print(f"RPC worker {worker.index} is not responding; restarting it")
+                    self._restart(worker)
+
+    def _restart(self, worker):
+        worker.stop()
+        replacement = _Worker(worker.index, self._context)
+        with self._lock:
+            self.workers[worker.index] = replacement
+            self.restarts[worker.index] += 1
+        threading.Thread(target=self._restore_worker, args=(replacement,), daemon=True).start()
+
+    def _gather(self, method):
+        """Call method on every worker; None for workers that fail to answer"""
+        self.start()
+        calls = [worker.call(method) for worker in self.workers]
+        deadline = time.monotonic() + RPC_WORKER_PING_TIMEOUT
+        results = []
+        for worker, call in zip(self.workers, calls):
+            try:
+                results.append(call.result(max(0.0, deadline - time.monotonic())))
+            except Exception as e:
+                print(f"RPC worker {worker.index} did not answer {method}: {e}")
+                results.append(None)
+        return results
+
+    def session_configs(self):
+        return [rpc_data for configs in self._gather('session_configs') if configs for rpc_data in configs]
+
+    def save_snapshot(self):
+        """Write the configs of every worker's health-checked sessions for the next start"""
+        save_snapshot(self.session_configs())
+
+    def health_stats(self):
+        stats = self._gather('health_stats')
+        return {'workers': [
+            dict(worker_stats or {}, worker=worker.index, pid=worker.process.pid,
+                 alive=worker.alive, restarts=self.restarts[worker.index])
+            for worker, worker_stats in zip(self.workers, stats)
+        ]}
+
+    def update_stats(self):
+        return {'workers': self._gather('update_stats')}
+
+    def connection_stats(self):
+        return {'workers': self._gather('connection_stats')}
+
+    def session_stats(self):
+        return {'workers': self._gather('session_stats')}
+
+    def restore_stats(self):
+        stats = self._gather('restore_stats')
+        return {'ready': all(worker_stats and worker_stats['ready'] for worker_stats in stats), 'workers': stats}
+
+    def active_user_ids(self):
+        return [user_id for user_ids in self._gather('active_user_ids') if user_ids for user_id in user_ids]
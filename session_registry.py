@@ -0,0 +1,305 @@
+"""
+Bounded presence session registry
+
+Each user with an active RPC has one small SessionRecord. A live record also
+holds the config the session shows and its connection (a pypresence client
+with its socket, buffers and, for the threads engine, its own event loop);
+everything else about the session fits in a few slotted fields. With
+RPC_MAX_LIVE_SESSIONS set, the least recently used sessions beyond the cap
+are evicted. With RPC_SESSION_MEMORY_LIMIT set, so are the least recently
+used sessions while the estimated bytes of all records exceed it; a record
+is estimated from its fields and config, plus RPC_SESSION_CONNECTION_BYTES
+while its connection is open. Sessions nobody has used for
+RPC_SESSION_IDLE_TIMEOUT seconds are evicted too. Eviction closes or parks the connection and drops
+the config but keeps the record and the user's active_rpc_id, so the
+session reconnects from the database when the user is next seen (they open
+the dashboard or their client polls their RPCs).
+
+Usage:
+    python session_registry.py bench [N]  Measure memory per live session and per evicted record against the registry's estimate (default 200 sessions)
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+RPC_MAX_LIVE_SESSIONS = int(os.getenv('RPC_MAX_LIVE_SESSIONS', '0'))
+RPC_SESSION_IDLE_TIMEOUT = float(os.getenv('RPC_SESSION_IDLE_TIMEOUT', '0'))
+# Bytes of session records to stay within per engine (0: no limit), and the bytes one open connection is
+# estimated to hold; see `python session_registry.py bench`
+RPC_SESSION_MEMORY_LIMIT = int(os.getenv('RPC_SESSION_MEMORY_LIMIT', '0'))
+RPC_SESSION_CONNECTION_BYTES = int(os.getenv('RPC_SESSION_CONNECTION_BYTES', '14336'))
+
+class SessionRecord:
+    __slots__ = ('user_id', 'rpc_id', 'app_id', 'payload_hash', 'last_used', 'last_success', 'config', 'connection', 'size')
+
+    def __init__(self, user_id, rpc_id=None, app_id=None):
+        self.user_id = user_id
+        self.rpc_id = rpc_id
+        self.app_id = app_id
+        self.payload_hash = None
+        self.last_used = time.monotonic()
+        self.last_success = None
+        self.config = None
+        self.connection = None
+        # Estimated bytes, as counted in the registry's totals
+        self.size = 0
+
+def record_bytes(record):
+    """Approximate bytes held by an evicted record and its field values"""
+    size = sys.getsizeof(record)
+    for slot in ('user_id', 'rpc_id', 'app_id', 'payload_hash', 'last_used'):
+        value = getattr(record, slot)
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+
+def config_bytes(config):
+    """Approximate bytes held by a session's config dict and its values"""
+    size = sys.getsizeof(config)
+    for key, value in config.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+class SessionRegistry:
+    """Thread-safe session records: live ones in least recently used order, evicted ones aside
+
+    A record is live while the engine wants its session shown, whether or
+    not the connection is currently open.
+    """
+
+    def __init__(self, max_live=RPC_MAX_LIVE_SESSIONS, idle_timeout=RPC_SESSION_IDLE_TIMEOUT,
+                 memory_limit=RPC_SESSION_MEMORY_LIMIT, connection_bytes=RPC_SESSION_CONNECTION_BYTES):
+        self.max_live = max_live
+        self.idle_timeout = idle_timeout
+        self.memory_limit = memory_limit
+        self.connection_bytes = connection_bytes
+        self._live = OrderedDict()  # user_id -> SessionRecord, least recently used first
+        self._evicted = {}  # user_id -> SessionRecord without config or connection
+        self._live_bytes = 0
+        self._evicted_bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.revived = 0
+
+    def _resize(self, record):
+        """Re-estimate a live record after its config or connection changed; caller holds the lock"""
+        size = record_bytes(record)
+        if record.config is not None:
+            size += config_bytes(record.config)
+        if record.connection is not None:
+            size += self.connection_bytes
+        self._live_bytes += size - record.size
+        record.size = size
+
+    def connection(self, user_id):
+        with self._lock:
+            record = self._live.get(user_id)
+            return record.connection if record is not None else None
+
+    def set_config(self, user_id, rpc_config, signature=None):
+        """Record what user_id's session should show and mark it used, reviving an evicted record"""
+        with self._lock:
+            record = self._live.get(user_id)
+            if record is None:
+                record = self._evicted.pop(user_id, None)
+                if record is not None:
+                    self._evicted_bytes -= record.size
+                    record.size = 0
+                    self.revived += 1
+                else:
+                    record = SessionRecord(user_id)
+                self._live[user_id] = record
+            else:
+                self._live.move_to_end(user_id)
+            record.config = dict(rpc_config, user_id=user_id)
+            record.rpc_id = rpc_config.get('id')
+            record.app_id = rpc_config.get('app_id')
+            record.payload_hash = hash(signature) if signature is not None else None
+            record.last_used = time.monotonic()
+            self._resize(record)
+
+    def attach(self, user_id, rpc_config, connection, signature):
+        """Record a session that just connected and showed rpc_config"""
+        self.set_config(user_id, rpc_config, signature)
+        with self._lock:
+            record = self._live[user_id]
+            record.connection = connection
+            record.last_success = time.time()
+            self._resize(record)
+
+    def detach(self, user_id):
+        """Take user_id's connection out of its record and return it"""
+        with self._lock:
+            record = self._live.get(user_id)
+            if record is None:
+                return None
+            connection, record.connection = record.connection, None
+            self._resize(record)
+            return connection
+
+    def succeeded(self, user_id):
+        with self._lock:
+            record = self._live.get(user_id)
+            if record is not None:
+                record.last_success = time.time()
+
+    def remove(self, user_id):
+        with self._lock:
+            record = self._live.pop(user_id, None)
+            if record is not None:
+                self._live_bytes -= record.size
+            record = self._evicted.pop(user_id, None)
+            if record is not None:
+                self._evicted_bytes -= record.size
+
+    def evict(self, user_id):
+        """Drop a live record's config, keeping the record until the user is next seen; detach first"""
+        with self._lock:
+            record = self._live.pop(user_id, None)
+            if record is None:
+                return
+            record.config = None
+            record.connection = None
+            self._live_bytes -= record.size
+            record.size = record_bytes(record)
+            self._evicted_bytes += record.size
+            self._evicted[user_id] = record
+            self.evictions += 1
+
+    def add_evicted(self, rpc_data):
+        """Record a session to connect when its user is next seen, unless user_id already has one"""
+        user_id = rpc_data['user_id']
+        with self._lock:
+            if user_id in self._live or user_id in self._evicted:
+                return
+            record = SessionRecord(user_id, rpc_data.get('id'), rpc_data.get('app_id'))
+            record.size = record_bytes(record)
+            self._evicted_bytes += record.size
+            self._evicted[user_id] = record
+
+    def touch(self, user_id):
+        """Mark user_id's session used; True if it was evicted and should reconnect"""
+        with self._lock:
+            record = self._live.get(user_id)
+            if record is not None:
+                record.last_used = time.monotonic()
+                self._live.move_to_end(user_id)
+                return False
+            return user_id in self._evicted
+
+    def full(self):
+        """Whether another connected session would go over max_live or memory_limit"""
+        with self._lock:
+            if 0 < self.max_live <= len(self._live):
+                return True
+            return 0 < self.memory_limit < self._live_bytes + self._evicted_bytes + self.connection_bytes
+
+    def eviction_candidates(self, idle=False):
+        """Live users to evict, least recently used first
+
+        Those beyond max_live, those whose eviction brings the estimated bytes
+        within memory_limit, and with idle those unused for idle_timeout.
+        """
+        with self._lock:
+            candidates = []
+            excess = len(self._live) - self.max_live if self.max_live > 0 else 0
+            if self.memory_limit > 0:
+                over = self._live_bytes + self._evicted_bytes - self.memory_limit
+            else:
+                over = 0
+            if idle and self.idle_timeout > 0:
+                cutoff = time.monotonic() - self.idle_timeout
+            else:
+                cutoff = None
+            for user_id, record in self._live.items():
+                if len(candidates) < excess or over > 0 or (cutoff is not None and record.last_used < cutoff):
+                    candidates.append(user_id)
+                    # Eviction keeps the record's fields
+                    over -= record.size - record_bytes(record)
+                else:
+                    break
+            return candidates
+
+    def configs(self):
+        """Configs of live sessions, plus what evicted records know, for a restart snapshot"""
+        with self._lock:
+            configs = [record.config for record in self._live.values()]
+            configs.extend({'user_id': record.user_id, 'id': record.rpc_id, 'app_id': record.app_id, 'evicted': True}
+                           for record in self._evicted.values())
+            return configs
+
+    def connected_user_ids(self):
+        with self._lock:
+            return [user_id for user_id, record in self._live.items() if record.connection is not None]
+
+    def stats(self):
+        with self._lock:
+            connected = sum(1 for record in self._live.values() if record.connection is not None)
+            sample = next(iter(self._evicted.values()), None) or next(iter(self._live.values()), None)
+            return {
+                'live': len(self._live),
+                'connected': connected,
+                'evicted': len(self._evicted),
+                'max_live': self.max_live,
+                'memory_limit': self.memory_limit,
+                'live_bytes': self._live_bytes,
+                'evicted_bytes': self._evicted_bytes,
+                'connection_bytes': self.connection_bytes,
+                'evictions': self.evictions,
+                'revived': self.revived,
+                'evicted_record_bytes': record_bytes(sample) if sample is not None else None
+            }
+
+def benchmark(sessions=200):
+    """Measure memory held per connected threads-engine session and per evicted record, and the registry's estimates of both"""
+    import contextlib
+    import gc
+    import tempfile
+    import tracemalloc
+    from presence_pool import _LocalDiscord
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ['XDG_RUNTIME_DIR'] = tmp_dir
+        _LocalDiscord(tmp_dir)
+        from rpc_persistent import PersistentRPCManager
+        manager = PersistentRPCManager()
+        manager.connections.max_idle = 0
+        rpc_config = {'id': 1, 'app_id': '1419030874640613446', 'details': 'Benchmark', 'timestamp_type': 'live'}
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # Warm up imports and caches outside the measurement
+            manager.activate_rpc(0, rpc_config, persist=False)
+            manager.deactivate_rpc(0, persist=False)
+            gc.collect()
+            tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+            for user_id in range(1, sessions + 1):
+                manager.activate_rpc(user_id, rpc_config, persist=False)
+            gc.collect()
+            connected = tracemalloc.get_traced_memory()[0]
+            estimated_connected = manager.sessions.stats()['live_bytes']
+            manager.sessions.max_live = 1
+            manager._evict_sessions()
+            gc.collect()
+            evicted = tracemalloc.get_traced_memory()[0]
+            estimated_evicted = manager.sessions.stats()['evicted_bytes']
+            tracemalloc.stop()
+
+        return {
+            'connected session': (connected - baseline) / sessions,
+            'evicted record': (evicted - baseline) / sessions,
+            'estimated connected session': estimated_connected / sessions,
+            'estimated evicted record': estimated_evicted / (sessions - 1)
+        }
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        sessions = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        for name, size in benchmark(sessions).items():
+            print(f"{name}: {size:.0f} bytes")
+        print(f"(estimates use RPC_SESSION_CONNECTION_BYTES={RPC_SESSION_CONNECTION_BYTES})")
+    else:
+        print(__doc__)
@@ -0,0 +1,229 @@
+"""
+Server-side web sessions in the app's database
+
+Replaces Flask-Session's filesystem store, which kept one file per browser
+forever and read and rewrote it on every request. Sessions live in the
+web_sessions table, keyed by the SHA-256 of the session ID (like API keys,
+the ID itself is only in the browser's cookie) with an index on expiry.
+
+A request that does not change its session writes nothing, unless its
+expiry would move by at least SESSION_TOUCH_INTERVAL seconds; then only the
+expiry is updated. Sessions of logged-in users last PERMANENT_SESSION_LIFETIME;
+others (an abandoned login, say) last SESSION_ANONYMOUS_LIFETIME seconds. Expired
+sessions are deleted every SESSION_PURGE_INTERVAL seconds, SESSION_PURGE_BATCH_SIZE
+rows per transaction.
+
+Usage:
+    python session_store.py bench [SESSIONS]  Compare per-request session cost against a filesystem store (default 100000 sessions)
+"""
+
+import hashlib
+import json
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from database import get_web_session, save_web_session, touch_web_session, delete_web_session, purge_web_sessions
+
+SESSION_ANONYMOUS_LIFETIME = float(os.getenv('SESSION_ANONYMOUS_LIFETIME', '86400'))
+SESSION_TOUCH_INTERVAL = float(os.getenv('SESSION_TOUCH_INTERVAL', '86400'))
+SESSION_PURGE_INTERVAL = float(os.getenv('SESSION_PURGE_INTERVAL', '3600'))
+SESSION_PURGE_BATCH_SIZE = int(os.getenv('SESSION_PURGE_BATCH_SIZE', '1000'))
+
+# IDs come from secrets.token_urlsafe(32); anything else is treated as no session without a lookup
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+class SessionStore:
+    """Loads and saves session dicts by session ID, skipping writes that would change nothing"""
+
+    def __init__(self, serializer=json, touch_interval=SESSION_TOUCH_INTERVAL):
+        self.serializer = serializer
+        self.touch_interval = touch_interval
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0
+        self.touched = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.purged = 0
+
+    @staticmethod
+    def new_id():
+        return secrets.token_urlsafe(32)
+
+    @staticmethod
+    def _key(session_id):
+        return hashlib.sha256(session_id.encode()).hexdigest()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def load(self, session_id):
+        """Get (data, expires_at) of a live session, or None"""
+        row = None
+        if session_id and SESSION_ID_PATTERN.match(session_id):
+            row = get_web_session(self._key(session_id))
+        if row is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return self.serializer.loads(row['data']), row['expires_at']
+
+    def save(self, session_id, data, expires_at, modified, stored_expires_at=None):
+        """Store a session after a request; returns 'saved', 'touched' or 'skipped'
+
+        stored_expires_at is the expiry load() returned, or None for a new session.
+        """
+        if modified or stored_expires_at is None:
+            save_web_session(self._key(session_id), self.serializer.dumps(data), expires_at)
+            self._count('saved')
+            return 'saved'
+        if expires_at - stored_expires_at >= self.touch_interval:
+            touch_web_session(self._key(session_id), expires_at)
+            self._count('touched')
+            return 'touched'
+        self._count('skipped')
+        return 'skipped'
+
+    def delete(self, session_id):
+        delete_web_session(self._key(session_id))
+        self._count('deleted')
+
+    def purge(self, batch_size=SESSION_PURGE_BATCH_SIZE):
+        """Delete expired sessions and return how many there were"""
+        removed = purge_web_sessions(batch_size)
+        with self._lock:
+            self.purged += removed
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'saved': self.saved,
+                'touched': self.touched,
+                'skipped': self.skipped,
+                'deleted': self.deleted,
+                'purged': self.purged
+            }
+
+def _purge_forever(store, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            removed = store.purge()
+            if removed:
+                print(f"Purged {removed} expired web sessions")
+        except Exception as e:
+            print(f"Failed to purge web sessions: {e}")
+
+def start_session_purger(store, interval=SESSION_PURGE_INTERVAL):
+    """Start the background thread that deletes expired sessions"""
+    thread = threading.Thread(target=_purge_forever, args=(store, interval), daemon=True)
+    thread.start()
+    return thread
+
+class _FileSessionStore:
+    """Stand-in for Flask-Session's filesystem store: one pickle per session, rewritten on every request"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, session_id):
+        return os.path.join(self.path, hashlib.md5(session_id.encode()).hexdigest())
+
+    def load(self, session_id):
+        import pickle
+        try:
+            with open(self._file(session_id), 'rb') as f:
+                expires_at, data = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        return (data, expires_at) if expires_at > time.time() else None
+
+    def save(self, session_id, data, expires_at):
+        import pickle
+        import tempfile
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((expires_at, data), f)
+        os.replace(tmp, self._file(session_id))
+
+def _bench(sessions, requests=5000):
+    """Time loading and saving random sessions out of `sessions` stored ones in each store
+
+    Prints microseconds per request for the database store when the session
+    is unchanged (most page views and API polls) and when it changed, and
+    for the filesystem store, which rewrites the file either way.
+    """
+    import random
+    import tempfile
+    from database import init_database
+
+    init_database()
+    store = SessionStore()
+    lifetime = 31536000
+    data = {'_permanent': True, 'user_id': 123456789012345678, 'access_token': secrets.token_urlsafe(22),
+            'api_key': secrets.token_urlsafe(32)}
+    ids = [SessionStore.new_id() for _ in range(sessions)]
+    for index, session_id in enumerate(ids):
+        save_web_session(SessionStore._key(session_id), json.dumps(data), time.time() + lifetime,
+                         wait=index == len(ids) - 1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = _FileSessionStore(os.path.join(tmp_dir, 'flask_session'))
+        for session_id in ids:
+            files.save(session_id, data, time.time() + lifetime)
+
+        sample = random.sample(ids, min(requests, sessions))
+        results = {}
+
+        def run(name, request):
+            started = time.perf_counter()
+            for session_id in sample:
+                request(session_id)
+            results[name] = (time.perf_counter() - started) / len(sample) * 1e6
+
+        def unchanged(session_id):
+            loaded, stored_expires_at = store.load(session_id)
+            store.save(session_id, loaded, time.time() + lifetime, False, stored_expires_at)
+
+        def changed(session_id):
+            loaded, stored_expires_at = store.load(session_id)
+            store.save(session_id, dict(loaded, oauth_state='x'), time.time() + lifetime, True, stored_expires_at)
+
+        def filesystem(session_id):
+            loaded, _ = files.load(session_id)
+            files.save(session_id, loaded, time.time() + lifetime)
+
+        run('database, unchanged', unchanged)
+        run('database, changed', changed)
+        run('filesystem', filesystem)
+
+    print(f"{sessions} stored sessions, {len(sample)} requests:")
+    for name, micros in results.items():
+        print(f"  {name}: {micros:.0f} us per request")
+    print(store.stats())
+
+def benchmark(sessions=100000):
+    """Run _bench in a child process against a temporary SQLite database"""
+    import subprocess
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{os.path.join(tmp_dir, "sessions.sqlite")}')
+        subprocess.run([sys.executable, os.path.abspath(__file__), 'bench-run', str(sessions)], env=env, check=True)
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'bench':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+    elif command == 'bench-run':
+        _bench(int(sys.argv[2]))
+    else:
+        print(__doc__)
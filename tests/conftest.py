@@ -0,0 +1,17 @@
+import os
+import tempfile
+
+import pytest
+
+# The app's modules open their database and secret key at import time, so
+# point them at a scratch directory before any test imports them
+_tmp_dir = tempfile.mkdtemp(prefix='rpc-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'rpc_database.sqlite')}"
+os.environ['SECRET_KEY_PATH'] = os.path.join(_tmp_dir, 'secret_key')
+os.environ.pop('RPC_SNAPSHOT_PATH', None)
+
+@pytest.fixture(scope='session')
+def database():
+    import database
+    database.init_database()
+    return database
@@ -0,0 +1,25 @@
+from cache import ResponseCache, SharedResponseStore
+
+class CountingStore(SharedResponseStore):
+    def __init__(self, path):
+        super().__init__(path)
+        self.writes = 0
+
+    def save(self, user_id, version, body):
+        self.writes += 1
+        super().save(user_id, version, body)
+
+def test_invalidate_leaves_shared_store_to_the_version_check(tmp_path):
+    store = CountingStore(str(tmp_path / 'responses.sqlite'))
+    worker, other_worker = ResponseCache(store=store), ResponseCache(store=store)
+    assert worker.get_or_build(1, 1, lambda: b'v1') == b'v1'
+    assert store.writes == 1
+
+    worker.invalidate(1)
+    assert store.writes == 1
+    assert store.load(1, 1) == b'v1'
+
+    # The user's version moved on: the stored body is not served, and is replaced
+    assert other_worker.get_or_build(1, 2, lambda: b'v2') == b'v2'
+    assert worker.get_or_build(1, 2, lambda: b'rebuilt') == b'v2'
+    assert store.load(1, 1) is None
@@ -0,0 +1,7 @@
+def test_get_rpc_config_only_returns_the_users_own_rpc(database):
+    for user_id in (2001, 2002):
+        database.create_or_update_user({'id': str(user_id), 'username': f'user{user_id}'}, {})
+    rpc_id = database.create_custom_rpc(2001, {'app_id': '123', 'details': 'Mine'})
+
+    assert database.get_rpc_config(rpc_id, 2001)['details'] == 'Mine'
+    assert database.get_rpc_config(rpc_id, 2002) is None
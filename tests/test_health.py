@@ -0,0 +1,50 @@
+import pytest
+
+@pytest.fixture
+def app_module(database):
+    import app
+    return app
+
+@pytest.fixture
+def client(app_module):
+    with app_module.create_app({'TESTING': True}).test_client() as client:
+        yield client
+
+def test_reports_service_stats_in_process(app_module, client):
+    stats = client.get('/health').get_json()
+    assert stats['status'] == 'ok'
+    for key in app_module.SERVICE_STATS:
+        assert key in stats and 'error' not in stats[key]
+
+def test_web_worker_fetches_service_stats_in_one_call(app_module, client, monkeypatch, tmp_path):
+    from rpc_control import RemoteRPCManager, serve_control
+    from rpc_persistent import service_stats
+    calls = []
+
+    def counted_service_stats():
+        calls.append(1)
+        return service_stats()
+
+    address = str(tmp_path / 'control.sock')
+    listener = serve_control({'service_stats': counted_service_stats}, address)
+    monkeypatch.setattr(app_module, 'PROCESS_ROLE', 'web')
+    monkeypatch.setattr(app_module, 'rpc_manager', RemoteRPCManager(address))
+    try:
+        stats = client.get('/health').get_json()
+    finally:
+        listener.close()
+    assert stats['status'] == 'ok'
+    assert len(calls) == 1
+    assert stats['rpc_sessions'] == service_stats()['rpc_sessions']
+
+def test_web_worker_reports_its_own_stats_without_the_service(app_module, client, monkeypatch, tmp_path):
+    from rpc_control import RemoteRPCManager
+    monkeypatch.setattr(app_module, 'PROCESS_ROLE', 'web')
+    monkeypatch.setattr(app_module, 'rpc_manager', RemoteRPCManager(str(tmp_path / 'missing.sock')))
+    response = client.get('/health')
+    stats = response.get_json()
+    assert response.status_code == 200
+    assert stats['status'] == 'degraded'
+    assert stats['ready'] is False
+    assert 'error' in stats['rpc_jobs']
+    assert 'hits' in stats['api_key_cache']['valid']
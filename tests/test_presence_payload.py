@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from presence_payload import compile_presence, presence_update_args, PresenceConfigError
+
+def test_compiles_valid_config():
+    payload = compile_presence({
+        'app_id': '123', 'details': 'Playing', 'state': 'Ranked', 'timestamp_type': 'none',
+        'large_image_url': 'https://example.com/large.png', 'large_image_text': 'Large',
+        'buttons': json.dumps([{'label': 'Join', 'url': 'https://example.com'}])
+    })
+    assert presence_update_args(payload) == {
+        'details': 'Playing', 'state': 'Ranked',
+        'large_image': 'https://example.com/large.png', 'large_text': 'Large',
+        'buttons': [{'label': 'Join', 'url': 'https://example.com'}]
+    }
+
+@pytest.mark.parametrize('field', ['details', 'state', 'large_image_url', 'large_image_text', 'small_image_url', 'small_image_text'])
+@pytest.mark.parametrize('value', [123, 0, 5.5, False, [], {'text': 'x'}])
+def test_rejects_non_string_fields(field, value):
+    with pytest.raises(PresenceConfigError, match=f'{field} must be a string'):
+        compile_presence({'app_id': '123', field: value})
+
+@pytest.mark.parametrize('button', [
+    {'label': 'Join', 'url': 7},
+    {'label': 7, 'url': 'https://example.com'},
+    {'label': ['Join'], 'url': 'https://example.com'},
+])
+def test_rejects_non_string_buttons(button):
+    with pytest.raises(PresenceConfigError, match='must be a string'):
+        compile_presence({'app_id': '123', 'buttons': [button]})
+
+def test_rejects_overlong_text():
+    with pytest.raises(PresenceConfigError, match='details must be at most'):
+        compile_presence({'app_id': '123', 'details': 'x' * 129})
+
+def test_stored_rows_compile_without_validation():
+    payload = compile_presence({'app_id': '123', 'details': 123}, validate=False)
+    assert presence_update_args(payload) == {'details': 123}
+
+@pytest.fixture
+def client(database):
+    from app import create_app
+    app = create_app({'TESTING': True})
+    with app.test_client() as client:
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+        yield client
+
+@pytest.mark.parametrize('body', [
+    {'app_id': '123', 'details': 123},
+    {'app_id': '123', 'large_image_url': 5},
+    {'app_id': '123', 'buttons': [{'name': 'Join', 'url': 7}]},
+    {'app_id': '123', 'buttons': ['Join']},
+    {'app_id': '123', 'buttons': 'Join'},
+    ['app_id', '123'],
+])
+def test_create_rpc_rejects_malformed_config(client, body):
+    response = client.post('/create_rpc', json=body)
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
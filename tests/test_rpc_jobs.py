@@ -0,0 +1,57 @@
+import itertools
+
+import pytest
+
+_user_ids = itertools.count(1000)
+
+@pytest.fixture
+def user_id(database):
+    user_id = next(_user_ids)
+    database.create_or_update_user({'id': str(user_id), 'username': f'user{user_id}'}, {})
+    return user_id
+
+def claim_next(database, user_id):
+    """Claim the user's due job, or return None if it may not run yet"""
+    job = next(job for job in database.get_due_rpc_jobs(100) if job['user_id'] == user_id)
+    return job if database.claim_rpc_job(job, timeout=60) else None
+
+def job_status(database, job_id, user_id):
+    return database.get_rpc_job(job_id, user_id)['status']
+
+def test_new_job_waits_for_running_job(database, user_id):
+    first = database.enqueue_rpc_job(user_id, 'activate', 1)
+    running = claim_next(database, user_id)
+    assert running['id'] == first
+
+    second = database.enqueue_rpc_job(user_id, 'activate', 2)
+    assert job_status(database, first, user_id) == 'running'
+    assert claim_next(database, user_id) is None
+
+    assert database.finish_rpc_job(running, 'done')
+    assert claim_next(database, user_id)['id'] == second
+
+def test_new_job_supersedes_queued_jobs(database, user_id):
+    first = database.enqueue_rpc_job(user_id, 'activate', 1)
+    second = database.enqueue_rpc_job(user_id, 'deactivate')
+    assert job_status(database, first, user_id) == 'superseded'
+    assert claim_next(database, user_id)['id'] == second
+
+def test_retry_superseded_by_newer_job(database, user_id):
+    first = database.enqueue_rpc_job(user_id, 'activate', 1)
+    running = claim_next(database, user_id)
+    second = database.enqueue_rpc_job(user_id, 'activate', 2)
+
+    assert not database.finish_rpc_job(running, 'queued', 'IPC timed out', run_at=0)
+    assert job_status(database, first, user_id) == 'superseded'
+    assert claim_next(database, user_id)['id'] == second
+
+def test_stale_claim_does_not_block_newer_job(database, user_id):
+    database.enqueue_rpc_job(user_id, 'activate', 1)
+    job = next(job for job in database.get_due_rpc_jobs(100) if job['user_id'] == user_id)
+    # Claimed by a process that died: the claim is already stale
+    assert database.claim_rpc_job(job, timeout=-1)
+    second = database.enqueue_rpc_job(user_id, 'activate', 2)
+    claimed = [job['id'] for job in database.get_due_rpc_jobs(100)
+               if job['user_id'] == user_id and database.claim_rpc_job(job, timeout=60)]
+    assert claimed == [second]
+    assert job_status(database, job['id'], user_id) == 'superseded'
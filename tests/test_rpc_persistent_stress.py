@@ -0,0 +1,128 @@
+"""
+Concurrent activations in PersistentRPCManager against stub sessions
+
+Each user activates an RPC, switches it to another application and
+deactivates it, while health checks run every few milliseconds and every
+simulated IPC call takes IPC_DELAY seconds. Run with -s to see the timings.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from health_scheduler import HealthScheduler
+from rpc_persistent import PersistentRPCManager
+
+USERS = 20
+IPC_DELAY = 0.02
+HEALTH_INTERVAL = 0.02
+
+# Sessions of this application never answer
+HUNG_APP_ID = 'hung'
+
+class StubPresence:
+    """Stand-in for pypresence's Presence whose IPC calls take `delay` seconds, or block until `hang` is set"""
+
+    def __init__(self, client_id, delay, hang=None):
+        self.client_id = client_id
+        self.delay = delay
+        self.hang = hang
+
+    def ipc(self):
+        if self.hang is not None:
+            self.hang.wait()
+        else:
+            time.sleep(self.delay)
+
+    def connect(self):
+        self.ipc()
+
+    def update(self, **kwargs):
+        self.ipc()
+
+    def clear(self):
+        self.ipc()
+
+    def close(self):
+        pass
+
+class StubManager(PersistentRPCManager):
+    """PersistentRPCManager over stub sessions, keeping active RPC ids in memory instead of the database"""
+
+    def __init__(self, hang):
+        super().__init__()
+        self.hang = hang
+        self.health = HealthScheduler(interval=HEALTH_INTERVAL, jitter=0.2)
+        self.active_rpc_ids = {}
+
+    def _create_rpc_instance(self, app_id):
+        rpc = StubPresence(app_id, IPC_DELAY, self.hang if app_id == HUNG_APP_ID else None)
+        rpc.connect()
+        return rpc
+
+    def _probe(self, rpc):
+        rpc.ipc()
+
+    def _get_active_rpc_id(self, user_id):
+        return self.active_rpc_ids.get(user_id)
+
+    def _set_active_rpc_id(self, user_id, rpc_id):
+        self.active_rpc_ids[user_id] = rpc_id
+
+def cycle(manager, user_id):
+    manager.activate_rpc(user_id, {'id': 1, 'app_id': 'first', 'details': f'user {user_id}'})
+    manager.activate_rpc(user_id, {'id': 2, 'app_id': 'second', 'details': f'user {user_id}'})
+    manager.deactivate_rpc(user_id)
+
+@pytest.fixture
+def hang():
+    hang = threading.Event()
+    yield hang
+    hang.set()
+
+@pytest.fixture
+def manager(hang):
+    manager = StubManager(hang)
+    manager.start_health_checks()
+    return manager
+
+def test_users_activate_in_parallel(hang, manager):
+    serial_manager = StubManager(hang)
+    serial_manager.start_health_checks()
+    started = time.monotonic()
+    for user_id in range(1, USERS + 1):
+        cycle(serial_manager, user_id)
+    serial = time.monotonic() - started
+
+    checks_before = manager.health.stats()['checks']
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=USERS) as pool:
+        list(pool.map(lambda user_id: cycle(manager, user_id), range(1, USERS + 1)))
+    concurrent = time.monotonic() - started
+    checks = manager.health.stats()['checks'] - checks_before
+
+    print(f"\n{USERS} users: {serial:.2f}s one at a time, {concurrent:.2f}s concurrently "
+          f"({serial / concurrent:.1f}x), {checks} health checks")
+    assert concurrent < serial / 4
+    assert manager.active_rpc_ids == {user_id: None for user_id in range(1, USERS + 1)}
+
+def test_hung_session_does_not_block_other_users(hang, manager):
+    manager.activate_rpc(0, {'id': 1, 'app_id': 'first', 'details': 'user 0'})
+    hung = threading.Thread(target=manager.activate_rpc, args=(0, {'id': 3, 'app_id': HUNG_APP_ID}), daemon=True)
+    hung.start()
+
+    checks_before = manager.health.stats()['checks']
+    with ThreadPoolExecutor(max_workers=USERS) as pool:
+        futures = [pool.submit(cycle, manager, user_id) for user_id in range(1, USERS + 1)]
+        for future in futures:
+            future.result(timeout=10)
+    time.sleep(HEALTH_INTERVAL * 5)
+
+    assert hung.is_alive()
+    assert manager.health.stats()['checks'] > checks_before
+    hang.set()
+    hung.join(5)
+    assert not hung.is_alive()
+    assert manager.active_rpc_ids[0] == 3
@@ -0,0 +1,48 @@
+from session_registry import SessionRegistry, record_bytes
+
+CONNECTION_BYTES = 10000
+
+def connect(registry, user_id):
+    registry.attach(user_id, {'id': user_id, 'app_id': '123', 'details': f'user {user_id}'}, object(), 'signature')
+
+def test_counts_live_and_evicted_bytes():
+    registry = SessionRegistry(connection_bytes=CONNECTION_BYTES)
+    for user_id in range(3):
+        connect(registry, user_id)
+    stats = registry.stats()
+    assert stats['live_bytes'] > 3 * CONNECTION_BYTES
+    assert stats['evicted_bytes'] == 0
+
+    registry.detach(1)
+    registry.evict(1)
+    stats = registry.stats()
+    assert stats['live_bytes'] < 2 * CONNECTION_BYTES + 2000
+    assert stats['evicted_bytes'] == record_bytes(registry._evicted[1])
+
+    connect(registry, 1)
+    for user_id in range(3):
+        registry.detach(user_id)
+        registry.remove(user_id)
+    stats = registry.stats()
+    assert (stats['live_bytes'], stats['evicted_bytes']) == (0, 0)
+
+def test_evicts_least_recently_used_beyond_memory_limit():
+    registry = SessionRegistry(connection_bytes=CONNECTION_BYTES, memory_limit=3 * CONNECTION_BYTES)
+    for user_id in range(5):
+        connect(registry, user_id)
+    registry.touch(0)
+
+    candidates = registry.eviction_candidates()
+    assert candidates == [1, 2, 3]
+    for user_id in candidates:
+        registry.detach(user_id)
+        registry.evict(user_id)
+    stats = registry.stats()
+    assert stats['live_bytes'] + stats['evicted_bytes'] <= registry.memory_limit
+    assert registry.eviction_candidates() == []
+
+def test_full_when_another_connection_would_not_fit():
+    registry = SessionRegistry(connection_bytes=CONNECTION_BYTES, memory_limit=2 * CONNECTION_BYTES)
+    assert not registry.full()
+    connect(registry, 1)
+    assert registry.full()
@@ -0,0 +1,301 @@
+"""
+Background OAuth token refresh
+
+Logins store when the user's Discord access token expires in
+users.token_expiry. Every TOKEN_REFRESH_SCAN_INTERVAL seconds the refresher
+reads the tokens expiring within the next TOKEN_REFRESH_MARGIN seconds plus
+one scan interval from the token_expiry index, and keeps them in a min-heap
+ordered by when they are due, TOKEN_REFRESH_MARGIN before expiry. Due tokens
+are refreshed in batches of TOKEN_REFRESH_BATCH_SIZE on
+TOKEN_REFRESH_CONCURRENCY threads of the pooled Discord HTTP client, at most
+TOKEN_REFRESH_RATE per second, and each batch is saved in one transaction per
+shard. A refresh that fails is retried with exponential backoff from
+TOKEN_REFRESH_RETRY_DELAY; a refresh token Discord rejects stops being
+refreshed until the user logs in again.
+
+Discord rotates the refresh token on every refresh, so new tokens are never
+dropped because they could not be saved. A shard whose save fails is retried
+TOKEN_REFRESH_SAVE_RETRIES times, from TOKEN_REFRESH_SAVE_RETRY_DELAY seconds
+and doubling; tokens still unsaved then are kept in memory, and the user's
+next attempt saves them again instead of refreshing with the used token.
+
+Refreshing needs DISCORD_CLIENT_SECRET; without it the refresher does not start.
+
+Usage:
+    python token_refresh.py bench [USERS]  Refresh USERS expiring tokens against a local stand-in token endpoint (default 2000)
+"""
+
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from database import get_expiring_tokens, get_refresh_tokens, save_token_refreshes, token_expiry_epoch
+from discord_api import DISCORD_TOKEN_URL, discord_http
+from health_scheduler import HealthScheduler
+
+TOKEN_REFRESH_MARGIN = float(os.getenv('TOKEN_REFRESH_MARGIN', '86400'))
+TOKEN_REFRESH_SCAN_INTERVAL = float(os.getenv('TOKEN_REFRESH_SCAN_INTERVAL', '300'))
+TOKEN_REFRESH_BATCH_SIZE = int(os.getenv('TOKEN_REFRESH_BATCH_SIZE', '50'))
+TOKEN_REFRESH_RATE = float(os.getenv('TOKEN_REFRESH_RATE', '10'))
+TOKEN_REFRESH_CONCURRENCY = int(os.getenv('TOKEN_REFRESH_CONCURRENCY', '8'))
+TOKEN_REFRESH_RETRY_DELAY = float(os.getenv('TOKEN_REFRESH_RETRY_DELAY', '60'))
+TOKEN_REFRESH_MAX_BACKOFF = float(os.getenv('TOKEN_REFRESH_MAX_BACKOFF', '3600'))
+TOKEN_REFRESH_SAVE_RETRIES = int(os.getenv('TOKEN_REFRESH_SAVE_RETRIES', '3'))
+TOKEN_REFRESH_SAVE_RETRY_DELAY = float(os.getenv('TOKEN_REFRESH_SAVE_RETRY_DELAY', '1'))
+
+# Discord's answers to a refresh token that will never work again
+REVOKED_ERRORS = {'invalid_grant', 'invalid_client', 'unauthorized_client'}
+
+class TokenRefresher:
+    """Refreshes OAuth tokens ahead of expiry from a heap of due times"""
+
+    def __init__(self, client_id, client_secret, token_url=DISCORD_TOKEN_URL, http=discord_http,
+                 margin=TOKEN_REFRESH_MARGIN, scan_interval=TOKEN_REFRESH_SCAN_INTERVAL,
+                 batch_size=TOKEN_REFRESH_BATCH_SIZE, rate=TOKEN_REFRESH_RATE, concurrency=TOKEN_REFRESH_CONCURRENCY):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self.http = http
+        self.margin = margin
+        self.scan_interval = scan_interval
+        self.batch_size = batch_size
+        self.rate = rate
+        # The heap's backoff schedules retries; due times come from add(key, delay)
+        self.due = HealthScheduler(interval=TOKEN_REFRESH_RETRY_DELAY, jitter=0.1, max_backoff=TOKEN_REFRESH_MAX_BACKOFF)
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='token-refresh')
+        self._lock = threading.Lock()
+        self._thread = None
+        # user_id -> (refresh token used, token response) that Discord issued but no save has stored yet
+        self._unsaved = {}
+        self.scans = 0
+        self.batches = 0
+        self.refreshed = 0
+        self.revoked = 0
+        self.failed = 0
+        self.skipped = 0
+        self.save_failures = 0
+
+    def schedule(self, user_id, expires_at):
+        """Refresh user_id's token margin seconds before the Unix time expires_at"""
+        self.due.add(user_id, delay=max(0.0, expires_at - self.margin - time.time()))
+
+    def scan(self):
+        """Add tokens expiring before the scan after next to the heap; returns how many were added"""
+        added = 0
+        for user_id, expires_at in get_expiring_tokens(time.time() + self.margin + 2 * self.scan_interval):
+            # A user already in the heap keeps their due time and backoff
+            if user_id not in self.due:
+                self.schedule(user_id, expires_at)
+                added += 1
+        with self._lock:
+            self.scans += 1
+        return added
+
+    def start(self):
+        """Start the refresh thread once"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        scanned_at = None
+        while True:
+            if scanned_at is None or time.monotonic() - scanned_at >= self.scan_interval:
+                scanned_at = time.monotonic()
+                try:
+                    self.scan()
+                except Exception as e:
+                    print(f"Failed to scan for expiring OAuth tokens: {e}")
+            self.due.wait(max(0.0, scanned_at + self.scan_interval - time.monotonic()))
+            self.run_due()
+
+    def run_due(self):
+        """Refresh due tokens batch by batch, keeping to the rate limit; returns how many batches ran"""
+        batches = 0
+        while True:
+            started = time.monotonic()
+            user_ids = self.due.pop_due(self.batch_size)
+            if not user_ids:
+                return batches
+            try:
+                self.refresh_batch(user_ids)
+            except Exception as e:
+                print(f"Failed to refresh OAuth tokens: {e}")
+                for user_id in user_ids:
+                    self.due.failed(user_id)
+            batches += 1
+            if self.rate > 0:
+                delay = started + len(user_ids) / self.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def refresh_batch(self, user_ids):
+        """Refresh the tokens of user_ids and save the results together"""
+        rows = get_refresh_tokens([user_id for user_id in user_ids if user_id not in self._unsaved])
+        now = time.time()
+        pending = []
+        held = []
+        skipped = 0
+        for user_id in user_ids:
+            if user_id in self._unsaved:
+                # Refreshed already; only the save is left to retry
+                held.append((user_id,) + self._unsaved.pop(user_id))
+                continue
+            row = rows.get(user_id)
+            expires_at = token_expiry_epoch(row['token_expiry']) if row else None
+            if expires_at is None or not row['refresh_token']:
+                # Gone, revoked or logged in without an expiry
+                self.due.remove(user_id)
+                skipped += 1
+            elif expires_at - self.margin > now:
+                # Refreshed elsewhere, or logged in again, since it was scheduled
+                self.schedule(user_id, expires_at)
+                skipped += 1
+            else:
+                pending.append((user_id, row['refresh_token']))
+
+        results = list(self._pool.map(lambda item: self._refresh(*item), pending))
+        refreshed = held + [(user_id, used, tokens) for user_id, used, tokens, revoked in results if tokens]
+        revoked = [(user_id, used) for user_id, used, tokens, revoked in results if revoked]
+        unsaved = self._save(refreshed, revoked)
+
+        for user_id, used, tokens in refreshed:
+            if user_id in unsaved:
+                self._unsaved[user_id] = (used, tokens)
+                self.due.failed(user_id)
+            else:
+                self.schedule(user_id, now + float(tokens['expires_in']))
+        for user_id, used in revoked:
+            if user_id in unsaved:
+                self.due.failed(user_id)
+            else:
+                self.due.remove(user_id)
+        failed = [user_id for user_id, used, tokens, revoked in results if not tokens and not revoked]
+        for user_id in failed:
+            self.due.failed(user_id)
+        with self._lock:
+            self.batches += 1
+            self.refreshed += sum(1 for user_id, used, tokens in refreshed if user_id not in unsaved)
+            self.revoked += sum(1 for user_id, used in revoked if user_id not in unsaved)
+            self.failed += len(failed)
+            self.skipped += skipped
+
+    def _save(self, refreshed, revoked):
+        """Save refresh results, retrying the shards that fail; returns the user_ids still unsaved"""
+        unsaved = set()
+        for attempt in range(TOKEN_REFRESH_SAVE_RETRIES + 1):
+            if attempt:
+                time.sleep(TOKEN_REFRESH_SAVE_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                unsaved = save_token_refreshes(refreshed, revoked)
+            except Exception as e:
+                print(f"Failed to save refreshed OAuth tokens: {e}")
+                unsaved = {entry[0] for entry in refreshed} | {entry[0] for entry in revoked}
+            if not unsaved:
+                return unsaved
+            with self._lock:
+                self.save_failures += 1
+            refreshed = [entry for entry in refreshed if entry[0] in unsaved]
+            revoked = [entry for entry in revoked if entry[0] in unsaved]
+        print(f"Keeping refreshed OAuth tokens of {len(unsaved)} user(s) until they can be saved")
+        return unsaved
+
+    def _refresh(self, user_id, refresh_token):
+        """Exchange one refresh token; returns (user_id, refresh_token, new tokens or None, revoked)"""
+        try:
+            response = self.http.post(self.token_url, data={
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'grant_type': 'refresh_token',
+                'refresh_token': refresh_token
+            }, headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        except Exception as e:
+            print(f"Failed to refresh OAuth token for user {user_id}: {e}")
+            return user_id, refresh_token, None, False
+        if response.status_code == 200:
+            tokens = response.json()
+            if tokens.get('access_token') and tokens.get('expires_in'):
+                return user_id, refresh_token, tokens, False
+        elif response.status_code in (400, 401):
+            try:
+                error = response.json().get('error')
+            except ValueError:
+                error = None
+            if error in REVOKED_ERRORS:
+                return user_id, refresh_token, None, True
+        print(f"Failed to refresh OAuth token for user {user_id}: {response.status_code} - {response.text}")
+        return user_id, refresh_token, None, False
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'running': self._thread is not None,
+                'scheduled': len(self.due),
+                'scans': self.scans,
+                'batches': self.batches,
+                'refreshed': self.refreshed,
+                'revoked': self.revoked,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'unsaved': len(self._unsaved),
+                'save_failures': self.save_failures
+            }
+        scheduler = self.due.stats()
+        stats['backing_off'] = scheduler['backing_off']
+        stats['lag_ms_max'] = scheduler['lag_ms_max']
+        return stats
+
+token_refresher = TokenRefresher(os.getenv('DISCORD_CLIENT_ID', '1419030874640613446'), os.getenv('DISCORD_CLIENT_SECRET'))
+
+def start_token_refresher():
+    if not token_refresher.client_secret:
+        print("DISCORD_CLIENT_SECRET is not set; OAuth tokens will not be refreshed")
+        return
+    token_refresher.start()
+
+def benchmark(users=2000):
+    """Run _bench in a child process against a temporary SQLite database"""
+    import subprocess
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{os.path.join(tmp_dir, "tokens.sqlite")}')
+        subprocess.run([sys.executable, os.path.abspath(__file__), 'bench-run', str(users)], env=env, check=True)
+
+def _bench(users, latency=0.02):
+    """Refresh users tokens that are about to expire against the stand-in token endpoint
+
+    One in ten users has a revoked refresh token. Prints refreshes per
+    second, how many tokens still expire within the hour, and the
+    refresher's counters.
+    """
+    from database import init_database, create_or_update_user
+    from discord_api import DiscordSession, start_stand_in
+
+    init_database()
+    for user_id in range(1, users + 1):
+        refresh_token = f'revoked-{user_id}' if user_id % 10 == 0 else f'refresh-{user_id}'
+        create_or_update_user({'id': user_id}, {'access_token': 'old', 'refresh_token': refresh_token, 'expires_in': 60},
+                              wait=user_id == users)
+
+    server, base = start_stand_in(latency)
+    refresher = TokenRefresher('bench', 'bench', token_url=f'{base}/oauth2/token', http=DiscordSession(), rate=0)
+    started = time.monotonic()
+    refresher.scan()
+    refresher.run_due()
+    elapsed = time.monotonic() - started
+    server.shutdown()
+
+    print(f"{users} tokens in {elapsed:.2f}s: {users / elapsed:.0f} refreshes/s")
+    print(f"still expiring within the hour: {len(get_expiring_tokens(time.time() + 3600))}")
+    print(refresher.stats())
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'bench':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    elif command == 'bench-run':
+        _bench(int(sys.argv[2]))
+    else:
+        print(__doc__)
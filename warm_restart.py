@@ -0,0 +1,115 @@
+"""
+Warm restart of active presences
+
+Restoring every active RPC at once after a restart opens one IPC connection
+per user in a burst. The engines instead start restores at most
+RPC_RESTORE_RATE per second, each at a jittered point in its slot, with at
+most RPC_RESTORE_CONCURRENCY in flight, and report progress through
+RestoreProgress.
+
+With RPC_SNAPSHOT_PATH set, the configs of live sessions are written there
+on shutdown and read back once on the next start instead of querying the
+database, as long as the file is younger than RPC_SNAPSHOT_MAX_AGE seconds.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from database import get_active_rpc_configs
+
+RPC_RESTORE_CONCURRENCY = int(os.getenv('RPC_RESTORE_CONCURRENCY', '16'))
+RPC_RESTORE_RATE = float(os.getenv('RPC_RESTORE_RATE', '20'))
+RPC_SNAPSHOT_PATH = os.getenv('RPC_SNAPSHOT_PATH')
+RPC_SNAPSHOT_MAX_AGE = float(os.getenv('RPC_SNAPSHOT_MAX_AGE', '3600'))
+
+def ramp_delay(index, rate=RPC_RESTORE_RATE):
+    """Seconds after the restore began at which restore number index should start"""
+    return (index + random.random()) / rate
+
+class RestoreProgress:
+    """Thread-safe counters for one restore run; ready once every restore has finished"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.source = None
+        self.total = 0
+        self.restored = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+        self._report_every = 1
+
+    def begin(self, total, source):
+        with self._lock:
+            self.source = source
+            self.total = total
+            self.restored = 0
+            self.failed = 0
+            self.started_at = time.time()
+            self.finished_at = None
+            self._report_every = max(1, total // 10)
+        print(f"Restoring {total} active RPCs from {source}...")
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.restored += 1
+            else:
+                self.failed += 1
+            done = self.restored + self.failed
+            report = done % self._report_every == 0 or done == self.total
+            failed, total = self.failed, self.total
+        if report:
+            print(f"RPC restore progress: {done}/{total} ({failed} failed)")
+
+    def finish(self):
+        with self._lock:
+            self.finished_at = time.time()
+            elapsed = self.finished_at - self.started_at
+        print(f"✓ RPC restore finished in {elapsed:.1f}s")
+
+    @property
+    def ready(self):
+        return self.finished_at is not None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self.finished_at is not None,
+                'source': self.source,
+                'total': self.total,
+                'restored': self.restored,
+                'failed': self.failed,
+                'duration_s': round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else None
+            }
+
+def load_restore_configs(snapshot_path=RPC_SNAPSHOT_PATH):
+    """Get the RPC configs to restore and where they came from
+
+    A usable snapshot is removed once read, so a later start after an
+    unclean shutdown falls back to the database.
+    """
+    if snapshot_path and os.path.exists(snapshot_path):
+        try:
+            fresh = time.time() - os.path.getmtime(snapshot_path) <= RPC_SNAPSHOT_MAX_AGE
+            if fresh:
+                with open(snapshot_path) as f:
+                    configs = json.load(f)
+            os.remove(snapshot_path)
+            if fresh:
+                return configs, 'snapshot'
+        except (OSError, ValueError) as e:
+            print(f"Ignoring RPC snapshot {snapshot_path}: {e}")
+    return get_active_rpc_configs(), 'database'
+
+def save_snapshot(configs, snapshot_path=RPC_SNAPSHOT_PATH):
+    """Write the configs of live sessions for the next start to restore from"""
+    if not snapshot_path:
+        return
+    tmp_path = f'{snapshot_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(configs, f, default=str)
+    os.replace(tmp_path, snapshot_path)
+    print(f"Saved {len(configs)} active RPCs to {snapshot_path}")